@@ -0,0 +1,137 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from authentication.models import AppUser
+from mitumbaesales.metrics import counter
+from .cache_utils import LocalLRU
+
+TOKEN_LOOKUPS = counter('auth_token_lookup_total', "API token lookups by where they were answered (local, shared, db).", ['source'])
+
+TOKEN_KEY = 'auth:token:{}'
+# Everything on the user except the password hash, which stays out of the cache
+SNAPSHOT_FIELDS = [field.attname for field in AppUser._meta.concrete_fields if field.attname != 'password']
+
+_local = LocalLRU(settings.AUTH_TOKEN_LOCAL_CACHE_SIZE, settings.AUTH_TOKEN_LOCAL_CACHE_TIMEOUT)
+
+
+def _cache_key(key):
+    # Hashed so raw tokens never end up in cache keys (or file names, with CACHE_DIR)
+    return TOKEN_KEY.format(hashlib.sha256(key.encode()).hexdigest()[:32])
+
+
+def _load_snapshot(key):
+    row = (
+        Token.objects.filter(key=key)
+        .values_list('created', *(f'user__{name}' for name in SNAPSHOT_FIELDS))
+        .first()
+    )
+    if row is None:
+        return None
+    return {'created': row[0], 'user': row[1:]}
+
+
+def _remember(key, snapshot):
+    _local.set(key, snapshot)
+    cache.set(_cache_key(key), snapshot, timeout=settings.AUTH_TOKEN_CACHE_TIMEOUT)
+
+
+def get_token_snapshot(key):
+    """
+    {'created', 'user'} for an API token, or None if there is no such token.
+    Looked up in this process's LRU, then the shared cache, then the database.
+    """
+    snapshot = _local.get(key)
+    if snapshot is not None:
+        TOKEN_LOOKUPS.inc(source='local')
+        return snapshot
+    snapshot = cache.get(_cache_key(key))
+    if snapshot is not None:
+        TOKEN_LOOKUPS.inc(source='shared')
+        _local.set(key, snapshot)
+        return snapshot
+    TOKEN_LOOKUPS.inc(source='db')
+    snapshot = _load_snapshot(key)
+    if snapshot is not None:
+        _remember(key, snapshot)
+    return snapshot
+
+
+def invalidate_token(key):
+    """
+    Drops a token's cached snapshot here and in the shared cache, now and
+    again once the surrounding transaction commits (so a request can't
+    re-cache the old row in between). Other processes' LRUs keep their copy
+    for at most AUTH_TOKEN_LOCAL_CACHE_TIMEOUT seconds.
+    """
+    def drop():
+        _local.discard(key)
+        cache.delete(_cache_key(key))
+
+    drop()
+    transaction.on_commit(drop)
+
+
+def invalidate_user_tokens(user_id):
+    """For changes made with QuerySet.update(), which the signal handlers don't see."""
+    for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+def token_expired(created, now=None):
+    """True once a token has gone unused for AUTH_TOKEN_EXPIRY seconds (never, if unset)."""
+    if not settings.AUTH_TOKEN_EXPIRY:
+        return False
+    return created < (now or timezone.now()) - timedelta(seconds=settings.AUTH_TOKEN_EXPIRY)
+
+
+def _slide(key, snapshot, now):
+    """
+    Token.created doubles as "last used": it is moved forward at most once
+    every AUTH_TOKEN_SLIDE_INTERVAL seconds, not on every request.
+    """
+    if snapshot['created'] > now - timedelta(seconds=settings.AUTH_TOKEN_SLIDE_INTERVAL):
+        return snapshot
+    if Token.objects.filter(key=key, created=snapshot['created']).update(created=now):
+        snapshot = {**snapshot, 'created': now}
+        _remember(key, snapshot)
+    else:
+        # Another worker slid it first; pick up its value next time
+        invalidate_token(key)
+    return snapshot
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for TokenAuthentication that answers most requests
+    without the Token + AppUser query. The user it returns is rebuilt from
+    the cached snapshot with the password deferred, so reading the password
+    or saving the user still goes to the database correctly.
+    """
+
+    def authenticate_credentials(self, key):
+        snapshot = get_token_snapshot(key)
+        if snapshot is None:
+            raise AuthenticationFailed(_('Invalid token.'))
+
+        user = AppUser.from_db(DEFAULT_DB_ALIAS, SNAPSHOT_FIELDS, snapshot['user'])
+        if not user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+
+        if settings.AUTH_TOKEN_EXPIRY:
+            now = timezone.now()
+            if token_expired(snapshot['created'], now):
+                raise AuthenticationFailed(_('Token has expired.'))
+            snapshot = _slide(key, snapshot, now)
+
+        token = Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id', 'created'], [key, user.pk, snapshot['created']])
+        token.user = user
+        return user, token
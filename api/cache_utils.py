@@ -0,0 +1,205 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+
+GENERATION_KEY = 'catalogue:generation:{}'
+
+
+def get_generations(*labels):
+    """
+    Current write-generation counter for each label. A missing counter (never
+    set, or evicted) starts from a nanosecond timestamp rather than 1, so it
+    can never collide with a generation that older cache entries were built on.
+    """
+    keys = [GENERATION_KEY.format(label) for label in labels]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump_generation(label):
+    """Invalidates every cached response built on `label` (e.g. 'product')."""
+    key = GENERATION_KEY.format(label)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def acquire_lock(key, timeout):
+    """Best-effort cross-process lock on top of cache.add(); returns a token or None."""
+    token = uuid.uuid4().hex
+    return token if cache.add(key, token, timeout=timeout) else None
+
+
+def release_lock(key, token):
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+class LocalLRU:
+    """Small thread-safe LRU with a per-entry timeout, private to one process."""
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def make_etag(*parts):
+    """Builds a quoted ETag from anything that identifies a response's content."""
+    digest = hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return quote_etag(digest)
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag / Last-Modified validators to a viewset's list and retrieve
+    actions. Validators come from cheap aggregate queries (get_validators),
+    so a matching If-None-Match / If-Modified-Since is answered with a 304
+    before anything is serialized.
+    """
+    # Per-action keyword arguments for django.utils.cache.patch_cache_control
+    cache_control = {}
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Return (version, last_modified datetime) for the action, or None to
+        skip. A last_modified of None sends the ETag alone, for validators
+        over a set of rows, whose newest updated_at can't see a delete.
+        """
+        return None
+
+    def _conditional(self, handler, request, *args, **kwargs):
+        validators = self.get_validators(request, *args, **kwargs)
+        if validators is None:
+            return handler(request, *args, **kwargs)
+
+        version, last_modified = validators
+        etag = make_etag(
+            request.build_absolute_uri(), request.accepted_renderer.format, version,
+            last_modified.isoformat() if last_modified else '',
+        )
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        patch_cache_control(response, **self.cache_control.get(self.action, {}))
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve, request, *args, **kwargs)
+
+
+class CachedResponseMixin:
+    """
+    Caches list/retrieve responses for anonymous GET requests. Keys combine
+    the path, the normalized query string and the generation counters of
+    `cache_models`, so writes invalidate by bumping a counter (api.signals)
+    instead of hunting down keys.
+
+    Expired entries are kept for a short grace period: one request refreshes
+    them under a lock while concurrent requests keep serving the stale copy,
+    and on a cold miss the other requests wait briefly for the first one to
+    fill the entry instead of all hitting the database at once.
+    """
+    cache_models = ()
+
+    def _response_cache_key(self, request, generations):
+        query = sorted((key, value) for key, values in request.query_params.lists() for value in values)
+        signature = make_etag(request.get_host(), request.path, query, request.accepted_renderer.format).strip('"')
+        version = '.'.join(str(generation) for generation in generations)
+        return f"response:{self.basename}:{self.action}:{signature}:{version}"
+
+    def _cached(self, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated or not self.cache_models:
+            return handler(request, *args, **kwargs)
+
+        key = self._response_cache_key(request, get_generations(*self.cache_models))
+        lock_key = f"{key}:lock"
+        entry = cache.get(key)
+        if entry and entry['fresh_until'] > time.time():
+            return Response(entry['data'])
+
+        token = acquire_lock(lock_key, settings.RESPONSE_CACHE_LOCK_TIMEOUT)
+        if token is None:
+            if entry:
+                # Someone else is refreshing it; the stale copy is good enough
+                return Response(entry['data'])
+            deadline = time.time() + settings.RESPONSE_CACHE_LOCK_WAIT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry:
+                    return Response(entry['data'])
+
+        try:
+            response = handler(request, *args, **kwargs)
+            if response.status_code == 200:
+                fresh = settings.RESPONSE_CACHE_TIMEOUT
+                cache.set(
+                    key,
+                    {'data': response.data, 'fresh_until': time.time() + fresh},
+                    timeout=fresh + settings.RESPONSE_CACHE_STALE_GRACE,
+                )
+            return response
+        finally:
+            if token:
+                release_lock(lock_key, token)
+
+    def list(self, request, *args, **kwargs):
+        return self._cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached(super().retrieve, request, *args, **kwargs)
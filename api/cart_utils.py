@@ -0,0 +1,268 @@
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from cart.models import Cart, CartItem
+from product.models import Product, MysteryBox
+
+# Upper bound on operations accepted by one batch request
+MAX_BATCH_OPERATIONS = 100
+# Most units one cart line may hold; keeps quantities and subtotals in column range
+MAX_LINE_QUANTITY = 99
+
+
+def _item_key(product_id=None, mystery_box_id=None):
+    return ('product', product_id) if product_id else ('box', mystery_box_id)
+
+
+def _operation_key(operation):
+    return _item_key(operation.get('product_id'), operation.get('mystery_box_id'))
+
+
+def _too_many(index):
+    return ValidationError({'operations': {index: [f"A cart line holds at most {MAX_LINE_QUANTITY} units."]}})
+
+
+def apply_cart_operations(cart, operations, skip_missing=False):
+    """
+    Applies a list of validated cart operations in one transaction:
+        {'op': 'add' | 'update' | 'remove', 'product_id' | 'mystery_box_id': ..., 'quantity': n}
+    'add' increases the quantity, 'update' sets it (0 removes the line) and
+    'remove' drops the line. Operations run in order against an in-memory
+    copy of the affected lines, which is then written back with one
+    bulk_create, one bulk_update and one delete. Prices and existing lines
+    are loaded with one query each, whatever the number of operations.
+    An 'add' taking a line past MAX_LINE_QUANTITY fails the batch. With
+    skip_missing, operations on unknown products/boxes are dropped and
+    such lines are capped instead (used when merging guest carts).
+    """
+    product_ids = {op['product_id'] for op in operations if op.get('product_id')}
+    box_ids = {op['mystery_box_id'] for op in operations if op.get('mystery_box_id')}
+
+    with transaction.atomic():
+        # Serializes concurrent batches against the same cart
+        Cart.objects.select_for_update().filter(pk=cart.pk).values_list('pk', flat=True).get()
+
+        prices = {
+            ('product', pk): price
+            for pk, price in Product.objects.filter(pk__in=product_ids).values_list('pk', 'price')
+        }
+        prices.update({
+            ('box', pk): price
+            for pk, price in MysteryBox.objects.filter(pk__in=box_ids, is_active=True).values_list('pk', 'price')
+        })
+        if skip_missing:
+            operations = [op for op in operations if op['op'] == 'remove' or _operation_key(op) in prices]
+        errors = {
+            index: ["Product not found."] if op.get('product_id') else ["Mystery box not found or no longer available."]
+            for index, op in enumerate(operations)
+            if op['op'] != 'remove' and _operation_key(op) not in prices
+        }
+        if errors:
+            raise ValidationError({'operations': errors})
+
+        lines = {}
+        stale = []
+        existing = cart.items.filter(Q(product_id__in=product_ids) | Q(mystery_box_id__in=box_ids)).order_by('added_at')
+        for item in existing:
+            key = _item_key(item.product_id, item.mystery_box_id)
+            if key in lines:
+                # Duplicate line for the same product; fold it into the first one
+                lines[key].quantity += item.quantity
+                stale.append(item.pk)
+            else:
+                lines[key] = item
+        stored_pks = {key: item.pk for key, item in lines.items()}
+
+        for index, op in enumerate(operations):
+            key = _operation_key(op)
+            line = lines.get(key)
+            if op['op'] == 'remove':
+                quantity = 0
+            elif op['op'] == 'add':
+                quantity = (line.quantity if line else 0) + op['quantity']
+                if quantity > MAX_LINE_QUANTITY:
+                    if not skip_missing:
+                        raise _too_many(index)
+                    quantity = MAX_LINE_QUANTITY
+            else:
+                quantity = op['quantity']
+
+            if line is None:
+                if not quantity:
+                    continue
+                line = lines[key] = CartItem(
+                    cart=cart, product_id=op.get('product_id'), mystery_box_id=op.get('mystery_box_id'),
+                    unit_price=prices[key],
+                )
+            line.quantity = quantity
+
+        to_create, to_update, to_delete = [], [], stale
+        for key, line in lines.items():
+            line.subtotal = line.quantity * line.unit_price
+            if not line.quantity:
+                if key in stored_pks:
+                    to_delete.append(stored_pks[key])
+            elif key in stored_pks:
+                to_update.append(line)
+            else:
+                to_create.append(line)
+
+        if to_delete:
+            CartItem.objects.filter(pk__in=to_delete).delete()
+        if to_update:
+            CartItem.objects.bulk_update(to_update, ['quantity', 'subtotal'])
+        if to_create:
+            CartItem.objects.bulk_create(to_create)
+        # Bulk writes skip CartItem.save(), so reset the running totals in one UPDATE
+        cart.recalculate_totals()
+    return cart
+
+
+def get_or_create_cart(user):
+    """Carts are created on first use rather than at registration."""
+    return Cart.objects.get_or_create(user=user)[0]
+
+
+# ===================================================================
+# Guest carts
+# ===================================================================
+# Anonymous carts live in a signed cookie, {'p': {product hex: qty}, 'b': {box hex: qty}},
+# so browsing and filling a cart costs no database writes. Prices are never
+# taken from the cookie; they are looked up when the cart is shown or merged.
+
+GUEST_CART_SALT = 'api.cart_utils.guest_cart'
+_GUEST_KINDS = {'product': 'p', 'box': 'b'}
+
+
+def read_guest_cart(request):
+    """{('product' | 'box', UUID): quantity}; a missing, expired or tampered cookie reads as empty."""
+    value = request.COOKIES.get(settings.GUEST_CART_COOKIE_NAME)
+    if not value:
+        return {}
+    try:
+        data = signing.loads(value, salt=GUEST_CART_SALT, max_age=settings.GUEST_CART_MAX_AGE)
+        return {
+            (kind, uuid.UUID(pk)): int(quantity)
+            for kind, short in _GUEST_KINDS.items()
+            for pk, quantity in data.get(short, {}).items()
+            if int(quantity) > 0
+        }
+    except (signing.BadSignature, ValueError, TypeError, AttributeError):
+        return {}
+
+
+def write_guest_cart(response, lines):
+    if not lines:
+        response.delete_cookie(settings.GUEST_CART_COOKIE_NAME, samesite='Lax')
+        return
+    data = {short: {} for short in _GUEST_KINDS.values()}
+    for (kind, pk), quantity in lines.items():
+        data[_GUEST_KINDS[kind]][pk.hex] = quantity
+    response.set_cookie(
+        settings.GUEST_CART_COOKIE_NAME,
+        signing.dumps(data, salt=GUEST_CART_SALT, compress=True),
+        max_age=settings.GUEST_CART_MAX_AGE,
+        httponly=True,
+        secure=not settings.DEBUG,
+        samesite='Lax',
+    )
+
+
+def _guest_prices(keys):
+    product_ids = [pk for kind, pk in keys if kind == 'product']
+    box_ids = [pk for kind, pk in keys if kind == 'box']
+    prices = {}
+    if product_ids:
+        prices.update({('product', pk): price for pk, price in Product.objects.filter(pk__in=product_ids).values_list('pk', 'price')})
+    if box_ids:
+        prices.update({
+            ('box', pk): price
+            for pk, price in MysteryBox.objects.filter(pk__in=box_ids, is_active=True).values_list('pk', 'price')
+        })
+    return prices
+
+
+def apply_guest_operations(lines, operations):
+    """Same semantics as apply_cart_operations, against the cookie contents."""
+    lines = dict(lines)
+    prices = _guest_prices({_operation_key(op) for op in operations if op['op'] != 'remove'})
+    errors = {
+        index: ["Product not found."] if op.get('product_id') else ["Mystery box not found or no longer available."]
+        for index, op in enumerate(operations)
+        if op['op'] != 'remove' and _operation_key(op) not in prices
+    }
+    if errors:
+        raise ValidationError({'operations': errors})
+
+    for index, op in enumerate(operations):
+        key = _operation_key(op)
+        if op['op'] == 'remove':
+            quantity = 0
+        elif op['op'] == 'add':
+            quantity = lines.get(key, 0) + op['quantity']
+            if quantity > MAX_LINE_QUANTITY:
+                raise _too_many(index)
+        else:
+            quantity = op['quantity']
+        if quantity:
+            lines[key] = quantity
+        else:
+            lines.pop(key, None)
+
+    if len(lines) > settings.GUEST_CART_MAX_LINES:
+        raise ValidationError({'operations': [f"A guest cart holds at most {settings.GUEST_CART_MAX_LINES} lines; sign in to add more."]})
+    return lines
+
+
+def guest_cart_summary(lines):
+    """
+    Cart-shaped view of the cookie at current prices, for GuestCartSerializer.
+    Lines whose product or box has since gone are left out.
+    """
+    product_ids = [pk for kind, pk in lines if kind == 'product']
+    box_ids = [pk for kind, pk in lines if kind == 'box']
+    products = Product.objects.select_related('seller', 'category', 'audience', 'size').in_bulk(product_ids) if product_ids else {}
+    boxes = MysteryBox.objects.filter(is_active=True).in_bulk(box_ids) if box_ids else {}
+
+    items = []
+    for (kind, pk), quantity in lines.items():
+        product = products.get(pk) if kind == 'product' else None
+        box = boxes.get(pk) if kind == 'box' else None
+        if product is None and box is None:
+            continue
+        unit_price = (product or box).price
+        items.append({
+            'product': product,
+            'mystery_box_id': box.pk if box else None,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'subtotal': quantity * unit_price,
+        })
+    return {
+        'items': items,
+        'total_price': sum((item['subtotal'] for item in items), Decimal('0')),
+        'item_count': sum(item['quantity'] for item in items),
+    }
+
+
+def merge_guest_cart(request, user):
+    """
+    Materializes the request's guest cart into the user's Cart (quantities
+    are added to what is already there) with one bulk merge. Returns True
+    if there was anything to merge, so the caller can clear the cookie.
+    """
+    lines = read_guest_cart(request)
+    if not lines:
+        return False
+    operations = [
+        {'op': 'add', 'product_id' if kind == 'product' else 'mystery_box_id': pk, 'quantity': quantity}
+        for (kind, pk), quantity in lines.items()
+    ]
+    apply_cart_operations(get_or_create_cart(user), operations, skip_missing=True)
+    return True
@@ -2,6 +2,8 @@ import os
 from groq import Groq
 from .vector_utils import search_similar_products
 from product.models import Product
+from mitumbaesales.middleware import external_call
+from mitumbaesales.tracing import traced
 
 class ShoppingAgent:
     def __init__(self):
@@ -17,6 +19,7 @@ class ShoppingAgent:
             context += f"- {p.name}: {p.price} KES, Condition: {p.condition}, Size: {p.size}\n"
         return context
 
+    @traced('groq.ask_agent')
     def ask_agent(self, user_query, user_name="Customer"):
         context = self.get_shopping_context(user_query)
         
@@ -33,10 +36,11 @@ class ShoppingAgent:
         3. Keep answers short (max 3 sentences).
         """
 
-        response = self.client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with external_call('groq'):
+            response = self.client.chat.completions.create(
+                model="llama-3.3-70b-versatile",
+                messages=[{"role": "user", "content": prompt}]
+            )
         return response.choices[0].message.content
 
 shopping_agent = ShoppingAgent()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, F, Sum, Window
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from cart.models import Cart, CartItem
+from orders.models import IdempotencyRecord, Order, OrderItem
+from .inventory_utils import OutOfStock, reserve_stock
+
+CHECKOUT_SCOPE = 'checkout'
+
+
+class CheckoutError(Exception):
+    """A checkout that can't go ahead; the message is safe to show to the buyer."""
+
+
+class PricesChanged(CheckoutError):
+    """A line's unit_price is no longer what its product or box costs."""
+
+
+class DuplicateRequest(Exception):
+    """Another request with the same Idempotency-Key already completed."""
+
+
+def request_fingerprint(request):
+    """Identifies what was asked for, so a reused key with a different request is rejected."""
+    payload = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method}|{request.path}|{payload}".encode()).hexdigest()
+
+
+def find_idempotent_result(user, scope, key):
+    return IdempotencyRecord.objects.filter(user=user, scope=scope, key=key).first()
+
+
+def place_order(user, render, idempotency_key=None, request_hash=''):
+    """
+    Turns the user's cart into an order in a single transaction:
+        lock the cart -> read every line and the order total (one query, the
+        total summed by the database) -> insert the order -> reserve its
+        stock -> insert its items -> empty the cart.
+    Lines are charged the unit_price stored when they were added, so the
+    order total is the cart total the buyer was shown. If a seller has
+    changed a price since, nothing is ordered: the cart is repriced and
+    PricesChanged asks the buyer to review it.
+    `render(order)` builds the response body; with an idempotency key it is
+    stored in the same transaction, so a retry can never see an order
+    without its recorded result. Returns (order, rendered body).
+    """
+    try:
+        return _place_order(user, render, idempotency_key, request_hash)
+    except PricesChanged:
+        # After the checkout transaction rolled back, so the new prices stick
+        cart = Cart.objects.filter(user=user).first()
+        if cart is not None:
+            cart.reprice()
+        raise
+
+
+def _place_order(user, render, idempotency_key, request_hash):
+    with transaction.atomic():
+        record = None
+        if idempotency_key:
+            try:
+                with transaction.atomic():
+                    # Concurrent duplicates block here until the first commits, then fail
+                    record = IdempotencyRecord.objects.create(
+                        user=user, scope=CHECKOUT_SCOPE, key=idempotency_key, request_hash=request_hash,
+                    )
+            except IntegrityError:
+                raise DuplicateRequest(idempotency_key)
+
+        # Taking the cart row lock with an UPDATE (rather than SELECT ... FOR UPDATE)
+        # also makes SQLite grab its write lock before anything is read
+        if not Cart.objects.filter(user=user).update(updated_at=timezone.now()):
+            raise CheckoutError("Your cart is empty.")
+        cart = Cart.objects.get(user=user)
+
+        lines = list(
+            CartItem.objects.filter(cart=cart)
+            .order_by('added_at')
+            .annotate(
+                box_active=F('mystery_box__is_active'),
+                current_price=Coalesce('product__price', 'mystery_box__price'),
+                seller_id=Coalesce('product__seller_id', 'mystery_box__seller_id'),
+                order_total=Window(Sum('subtotal', output_field=DecimalField(max_digits=12, decimal_places=2))),
+            )
+            .values('product_id', 'mystery_box_id', 'quantity', 'unit_price', 'current_price', 'box_active', 'seller_id', 'order_total')
+        )
+        if not lines:
+            raise CheckoutError("Your cart is empty.")
+        if any(line['mystery_box_id'] and not line['box_active'] for line in lines):
+            raise CheckoutError("A mystery box in your cart is no longer available.")
+        if any(line['unit_price'] != line['current_price'] for line in lines):
+            raise PricesChanged("Prices in your cart have changed. Please review your cart and check out again.")
+
+        order = Order.objects.create(buyer=user, total_price=lines[0]['order_total'])
+        try:
+            reserve_stock(order, lines)
+        except OutOfStock as e:
+            raise CheckoutError(str(e))
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order, product_id=line['product_id'], mystery_box_id=line['mystery_box_id'],
+                quantity=line['quantity'], price=line['unit_price'],
+                seller_id=line['seller_id'], ordered_at=order.created_at,
+            )
+            for line in lines
+        ])
+        cart.clear()
+
+        body = render(order)
+        if record is not None:
+            record.order = order
+            record.response_status = 201
+            record.response_body = body
+            record.save(update_fields=['order', 'response_status', 'response_body'])
+    return order, body
@@ -0,0 +1,111 @@
+"""
+Single-flight coalescing for expensive calls (CLIP image search, Groq chat).
+Concurrent calls with the same content hash share one computation: within a
+process, duplicates wait on the first caller; across processes, the first
+one takes a cache lock and publishes its result in the shared cache for
+SINGLE_FLIGHT_RESULT_TTL seconds, and the others pick it up from there.
+
+    product_ids = coalesce('image_search', content_key(image_bytes), lambda: run_clip(image_bytes))
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from mitumbaesales.metrics import counter
+from .cache_utils import acquire_lock, release_lock
+
+COALESCED_CALLS = counter(
+    'singleflight_calls_total',
+    "Coalesced operations by result: computed (this call did the work), local / shared (reused a result "
+    "computed in this process / another process), fallback (gave up waiting and computed).",
+    ['name', 'result'],
+)
+
+_MISSING = object()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def content_key(*parts):
+    """Hash identifying the input of a call; str parts are UTF-8 encoded."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def coalesce(name, key, compute):
+    """
+    compute()'s result, shared with every concurrent call for the same
+    (name, key). If the computing call raises, the callers waiting on it in
+    this process get the same exception; those in other processes try again
+    themselves. Results must be picklable.
+    """
+    flight_key = f'{name}:{key}'
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(settings.SINGLE_FLIGHT_WAIT):
+            COALESCED_CALLS.inc(name=name, result='local')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        COALESCED_CALLS.inc(name=name, result='fallback')
+        return compute()
+
+    try:
+        flight.result = _shared_flight(name, flight_key, compute)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(flight_key, None)
+        flight.done.set()
+
+
+def _shared_flight(name, flight_key, compute):
+    result_key = f'singleflight:{flight_key}'
+    lock_key = f'{result_key}:lock'
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT
+    while True:
+        result = cache.get(result_key, _MISSING)
+        if result is not _MISSING:
+            COALESCED_CALLS.inc(name=name, result='shared')
+            return result
+        token = acquire_lock(lock_key, settings.SINGLE_FLIGHT_LOCK_TIMEOUT)
+        if token is not None:
+            outcome = 'computed'
+            break
+        if time.monotonic() > deadline:
+            # The other process is stuck or slow; don't make this request wait any longer
+            outcome = 'fallback'
+            break
+        time.sleep(0.05)
+
+    try:
+        result = compute()
+        cache.set(result_key, result, timeout=settings.SINGLE_FLIGHT_RESULT_TTL)
+        COALESCED_CALLS.inc(name=name, result=outcome)
+        return result
+    finally:
+        if token is not None:
+            release_lock(lock_key, token)
@@ -0,0 +1,124 @@
+import csv
+
+import orjson
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from orders.models import OrderItem
+from .renderers import ORJSON_OPTIONS
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+}
+
+EXPORT_COLUMNS = [
+    'order_id', 'ordered_at', 'status', 'buyer', 'seller', 'item_type', 'item_id', 'item_name',
+    'quantity', 'price', 'subtotal',
+]
+
+# A cell starting with one of these is run as a formula by Excel/LibreOffice/Sheets
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class _Echo:
+    """File-like object whose write() hands the line back, so csv.writer can feed a generator."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(user, since=None, until=None):
+    """
+    One .values() row per order line the user bought or sold, newest first,
+    streamed from a server-side cursor so memory stays flat however many
+    lines there are.
+    """
+    if user.user_type == 'Seller':
+        items = OrderItem.objects.filter(seller=user)
+        ordered_at = 'ordered_at'
+    else:
+        items = OrderItem.objects.filter(order__buyer=user)
+        ordered_at = 'order__created_at'
+    if since:
+        items = items.filter(**{f'{ordered_at}__date__gte': since})
+    if until:
+        items = items.filter(**{f'{ordered_at}__date__lte': until})
+
+    return (
+        items.order_by(f'-{ordered_at}', '-order_id', 'id')
+        .annotate(
+            ordered=F(ordered_at),
+            order_status=F('order__status'),
+            buyer_email=F('order__buyer__email'),
+            seller_email=F('seller__email'),
+            item_name=Coalesce('product__name', 'mystery_box__name'),
+        )
+        .values(
+            'order_id', 'ordered', 'order_status', 'buyer_email', 'seller_email',
+            'product_id', 'mystery_box_id', 'item_name', 'quantity', 'price',
+        )
+        .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    )
+
+
+def _records(rows):
+    for row in rows:
+        is_box = row['product_id'] is None
+        yield {
+            'order_id': row['order_id'],
+            'ordered_at': row['ordered'],
+            'status': row['order_status'],
+            'buyer': row['buyer_email'],
+            'seller': row['seller_email'],
+            'item_type': 'mystery_box' if is_box else 'product',
+            'item_id': row['mystery_box_id'] if is_box else row['product_id'],
+            'item_name': row['item_name'],
+            'quantity': row['quantity'],
+            'price': row['price'],
+            'subtotal': row['quantity'] * row['price'],
+        }
+
+
+def _csv_cell(value):
+    """
+    Text that a spreadsheet would evaluate (a product name like
+    '=HYPERLINK(...)') is prefixed with a quote so it opens as plain text.
+    Numbers are left alone, so a negative amount stays a number.
+    """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for record in _records(rows):
+        record['ordered_at'] = record['ordered_at'].isoformat() if record['ordered_at'] else ''
+        yield writer.writerow([_csv_cell(record[column]) for column in EXPORT_COLUMNS])
+
+
+def stream_jsonl(rows):
+    for record in _records(rows):
+        # Decimals go out as strings, as in the JSON API
+        yield orjson.dumps(record, default=str, option=ORJSON_OPTIONS) + b'\n'
+
+
+EXPORT_WRITERS = {'csv': stream_csv, 'jsonl': stream_jsonl}
+
+
+def stream_export(export_format, rows, buffer_size=64 * 1024):
+    """Encoded export in ~64KB chunks rather than one tiny write per line."""
+    buffer, buffered = [], 0
+    for line in EXPORT_WRITERS[export_format](rows):
+        if isinstance(line, str):
+            line = line.encode()
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= buffer_size:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b''.join(buffer)
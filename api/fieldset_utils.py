@@ -0,0 +1,226 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.relations import ManyRelatedField, RelatedField
+
+
+def parse_field_tree(value):
+    """'id,items.name,items.price' -> {'id': {}, 'items': {'name': {}, 'price': {}}}"""
+    if value is None:
+        return None
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in filter(None, (part.strip() for part in path.split('.'))):
+            node = node.setdefault(part, {})
+    return tree
+
+
+class FieldSelection:
+    """
+    The ?fields= / ?expand= protocol for one level of a response.
+
+        fields=id,name,items.name   only these fields (dotted paths reach into relations)
+        expand=items,items.product  embed these relations in full
+
+    A relation that isn't expanded (and has no sub-fields requested) is
+    rendered as its primary key(s). With neither parameter everything is
+    rendered and embedded exactly as before. Names a level doesn't have are
+    rejected with a 400 (see validate()).
+    """
+
+    def __init__(self, fields=None, expand=None, path=''):
+        self.fields = fields
+        self.expand = expand
+        # Dotted prefix of this level, for error messages
+        self.path = path
+
+    @classmethod
+    def from_request(cls, request):
+        if request is None:
+            return cls()
+        fields = parse_field_tree(request.query_params.get('fields'))
+        expand = parse_field_tree(request.query_params.get('expand'))
+        if fields is not None and expand is None:
+            expand = {}
+        return cls(fields, expand)
+
+    @property
+    def is_default(self):
+        return self.fields is None and self.expand is None
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields
+
+    def is_expanded(self, name):
+        if self.expand is None or name in self.expand:
+            return True
+        return bool(self.fields and self.fields.get(name))
+
+    def nested(self, name):
+        fields = (self.fields.get(name) or None) if self.fields is not None else None
+        expand = self.expand.get(name, {}) if self.expand is not None else None
+        return FieldSelection(fields, expand, path=f"{self.path}{name}.")
+
+    def validate(self, known, expandable=()):
+        """
+        Raises a ValidationError naming every requested field that isn't in
+        `known`, sub-fields of something that isn't an expandable relation,
+        and expansions of anything else.
+        """
+        errors = {}
+        unknown = [
+            name for name, children in (self.fields or {}).items()
+            if name not in known or (children and name not in expandable)
+        ]
+        if unknown:
+            errors['fields'] = [f"Unknown field '{self.path}{name}'." for name in unknown]
+        unexpandable = [name for name in (self.expand or {}) if name not in expandable]
+        if unexpandable:
+            errors['expand'] = [f"'{self.path}{name}' can't be expanded." for name in unexpandable]
+        if errors:
+            raise serializers.ValidationError(errors)
+
+
+class SparseFieldsMixin:
+    """
+    Serializer side of FieldSelection. Drops unrequested fields and swaps
+    `expandable_fields` for nested serializers or primary keys.
+
+    `query_map` names the model lookups a field reads when that isn't just
+    its source (e.g. a StringRelatedField or SerializerMethodField), so
+    optimize_queryset() can load exactly those columns.
+    """
+    expandable_fields = {}
+    query_map = {}
+
+    def __init__(self, *args, selection=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if selection is None:
+            request = self.context.get('request')
+            # Writes keep every field so no input is silently dropped
+            if request is None or request.method not in SAFE_METHODS:
+                return
+            selection = FieldSelection.from_request(request)
+        self.selection = selection
+        if not selection.is_default:
+            self.apply_selection(selection)
+
+    def apply_selection(self, selection):
+        selection.validate(self.fields, self.expandable_fields)
+        for name in list(self.fields):
+            if not selection.includes(name) and not self.fields[name].write_only:
+                self.fields.pop(name)
+
+        for name, (serializer_class, options) in self.expandable_fields.items():
+            if name not in self.fields:
+                continue
+            if selection.is_expanded(name):
+                self.fields[name] = serializer_class(read_only=True, selection=selection.nested(name), **options)
+            else:
+                self.fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, **options)
+
+
+def _add_column(model, path, only, select, prefix):
+    """Records a (possibly FK-spanning) lookup; returns False for non-column attributes."""
+    current = model
+    parts = path.split('__')
+    for index, part in enumerate(parts):
+        try:
+            field = current._meta.get_field(part)
+        except FieldDoesNotExist:
+            return False
+        if not field.concrete:
+            return False
+        if field.is_relation and index < len(parts) - 1:
+            select.add(prefix + '__'.join(parts[:index + 1]))
+            only.add(prefix + '__'.join(parts[:index + 1]))
+            current = field.related_model
+    only.add(prefix + path)
+    return True
+
+
+def _plan(model, serializer, prefix, only, select, prefetch):
+    """Walks the fields a serializer will render and collects the loading plan."""
+    complete = True
+    query_map = getattr(serializer, 'query_map', {})
+
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if name in query_map:
+            for path in query_map[name]:
+                complete &= _add_column(model, path, only, select, prefix)
+            continue
+
+        nested = field.child if isinstance(field, serializers.ListSerializer) else field
+        source = field.source
+        if isinstance(nested, serializers.BaseSerializer) or isinstance(field, ManyRelatedField):
+            try:
+                relation = model._meta.get_field(source)
+            except FieldDoesNotExist:
+                complete = False
+                continue
+            related_model = relation.related_model
+            if relation.many_to_many or relation.one_to_many:
+                nested_only, nested_select, nested_prefetch = set(), set(), []
+                nested_complete = True
+                if isinstance(nested, serializers.BaseSerializer):
+                    nested_complete = _plan(related_model, nested, '', nested_only, nested_select, nested_prefetch)
+                if relation.one_to_many:
+                    # The prefetch needs the FK back to the parent to group rows
+                    nested_only.add(relation.field.name)
+                queryset = related_model._default_manager.all().select_related(*nested_select)
+                if nested_complete:
+                    queryset = queryset.only(*nested_only)
+                if nested_prefetch:
+                    queryset = queryset.prefetch_related(*nested_prefetch)
+                prefetch.append(Prefetch(prefix + source, queryset=queryset))
+            else:
+                only.add(prefix + source)
+                select.add(prefix + source)
+                complete &= _plan(related_model, nested, f"{prefix}{source}__", only, select, prefetch)
+        elif isinstance(field, RelatedField):
+            # Primary key only: the FK column is enough
+            complete &= _add_column(model, source, only, select, prefix)
+        elif source == '*':
+            complete = False
+        else:
+            complete &= _add_column(model, source, only, select, prefix)
+    return complete
+
+
+def optimize_queryset(queryset, serializer):
+    """
+    Applies only() / select_related() / prefetch_related() so the queryset
+    loads exactly what `serializer` (already narrowed by its FieldSelection)
+    renders. If some rendered attribute can't be traced back to a column,
+    columns are left undeferred rather than risk a query per row.
+    """
+    only, select, prefetch = set(), set(), []
+    complete = _plan(queryset.model, serializer, '', only, select, prefetch)
+    # Prefetches join back on the primary key even if it isn't rendered
+    only.add(queryset.model._meta.pk.name)
+    if select:
+        queryset = queryset.select_related(*select)
+    if complete:
+        queryset = queryset.only(*only)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+class SparseFieldsViewMixin:
+    """
+    Narrows read querysets to what the request's ?fields= / ?expand= will
+    render. List actions served by a row serializer select their own columns.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        if self.action == 'list' and getattr(self, 'row_serializer_class', None):
+            return queryset
+        return optimize_queryset(queryset, self.get_serializer())
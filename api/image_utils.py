@@ -0,0 +1,130 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from product.models import Product
+from mitumbaesales.tracing import in_current_context
+from .cache_utils import bump_generation
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels for each derivative; never upscaled
+DERIVATIVE_SIZES = {
+    'thumb': 160,
+    'card': 480,
+    'detail': 1080,
+}
+
+# (file extension, Pillow format, save options)
+DERIVATIVE_FORMATS = [
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+]
+
+DERIVATIVE_SEPARATOR = '__'
+
+_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_DERIVATIVE_WORKERS, thread_name_prefix='image-derivatives')
+
+
+def derivative_name(original_name, size, extension):
+    """products/jacket.jpg -> products/jacket__thumb.webp (stored beside the original)."""
+    root, _ = os.path.splitext(original_name)
+    return f"{root}{DERIVATIVE_SEPARATOR}{size}.{extension}"
+
+
+def build_derivatives(original_name, storage=default_storage):
+    """
+    Renders every size/format of one stored image and returns the manifest
+    saved on Product.image_derivatives:
+        {'thumb': {'width': 160, 'height': 160, 'webp': '<name>', 'jpg': '<name>'}, ...}
+    Re-encoding drops EXIF/ICC metadata; orientation is applied first so
+    phone photos don't come out sideways.
+    """
+    largest = max(DERIVATIVE_SIZES.values())
+    with storage.open(original_name, 'rb') as original:
+        image = Image.open(original)
+        # Lets the JPEG decoder downscale while decoding instead of after
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+
+    manifest = {}
+    for size, edge in DERIVATIVE_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        entry = {'width': resized.width, 'height': resized.height}
+        for extension, image_format, options in DERIVATIVE_FORMATS:
+            buffer = BytesIO()
+            resized.save(buffer, image_format, **options)
+            name = derivative_name(original_name, size, extension)
+            # Overwrite in place so names stay deterministic
+            if storage.exists(name):
+                storage.delete(name)
+            entry[extension] = storage.save(name, ContentFile(buffer.getvalue()))
+        manifest[size] = entry
+    return manifest
+
+
+def generate_product_derivatives(product_id):
+    """Builds derivatives for one product and records them without touching other fields."""
+    product = Product.objects.filter(pk=product_id).only('id', 'image').first()
+    if product is None or not product.image:
+        return None
+    manifest = build_derivatives(product.image.name)
+    Product.objects.filter(pk=product_id).update(image_derivatives=manifest, updated_at=timezone.now())
+    # .update() skips post_save, so invalidate cached catalogue responses here
+    bump_generation('product')
+    return manifest
+
+
+def _generate_in_background(product_id):
+    try:
+        generate_product_derivatives(product_id)
+    except Exception as e:
+        logger.error(f"Image derivative generation failed for product {product_id}: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+def schedule_product_derivatives(product):
+    """Queues derivative generation on a worker thread once the upload is committed."""
+    product_id = product.pk
+    transaction.on_commit(lambda: _executor.submit(in_current_context(_generate_in_background, 'image_derivatives.generate'), product_id))
+
+
+def product_image_variants(product, request=None):
+    """URLs for the stored derivatives, keyed by size."""
+    return image_variants_from_manifest(product.image_derivatives, request)
+
+
+def image_variants_from_manifest(manifest, request=None, url_for=None):
+    """`url_for` lets bulk serializers swap in a precomputed storage URL builder."""
+    if url_for is None:
+        def url_for(name):
+            url = default_storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+    variants = {}
+    for size, entry in (manifest or {}).items():
+        variant = {'width': entry.get('width'), 'height': entry.get('height')}
+        for extension, _, _ in DERIVATIVE_FORMATS:
+            if entry.get(extension):
+                variant[extension] = url_for(entry[extension])
+        variants[size] = variant
+    return variants
+
+
+def srcset(variants, extension):
+    """'<url> 160w, <url> 480w, ...' for one format, ready for an <img srcset>."""
+    candidates = sorted(
+        (variant['width'], variant[extension]) for variant in variants.values() if variant.get(extension)
+    )
+    return ', '.join(f"{url} {width}w" for width, url in candidates)
@@ -0,0 +1,189 @@
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from orders.models import Order, OrderStatusChange, StockReservation
+from payments.models import MpesaSTKPush
+from product.models import MysteryBox, Product
+from .cache_utils import bump_generation
+
+logger = logging.getLogger(__name__)
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_name):
+        super().__init__(f"'{product_name}' is out of stock.")
+        self.product_name = product_name
+
+
+def units_needed(lines):
+    """
+    {product_id: units} for cart/order lines (dicts with product_id,
+    mystery_box_id and quantity). A mystery box needs one of each product
+    inside it per box ordered; contents are read in one query.
+    """
+    needed = Counter()
+    box_quantities = Counter()
+    for line in lines:
+        if line['product_id']:
+            needed[line['product_id']] += line['quantity']
+        elif line['mystery_box_id']:
+            box_quantities[line['mystery_box_id']] += line['quantity']
+    if box_quantities:
+        contents = MysteryBox.items.through.objects.filter(mysterybox_id__in=box_quantities).values_list('mysterybox_id', 'product_id')
+        for box_id, product_id in contents:
+            needed[product_id] += box_quantities[box_id]
+    return needed
+
+
+def take_stock(product_id, units):
+    """Atomic conditional decrement: UPDATE ... SET stock = stock - n WHERE stock >= n."""
+    return Product.objects.filter(pk=product_id, stock_quantity__gte=units).update(
+        stock_quantity=F('stock_quantity') - units, updated_at=timezone.now(),
+    ) == 1
+
+
+def return_stock(product_id, units):
+    Product.objects.filter(pk=product_id).update(stock_quantity=F('stock_quantity') + units, updated_at=timezone.now())
+
+
+def reserve_stock(order, lines):
+    """
+    Reserves every unit `lines` need for `order`. Must run inside the
+    checkout transaction: on OutOfStock the caller's rollback undoes the
+    decrements already made. Products are decremented in id order so
+    concurrent checkouts always lock rows in the same sequence.
+    """
+    needed = units_needed(lines)
+    for product_id in sorted(needed):
+        if not take_stock(product_id, needed[product_id]):
+            name = Product.objects.filter(pk=product_id).values_list('name', flat=True).first() or 'An item'
+            raise OutOfStock(name)
+
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=product_id, quantity=units, expires_at=expires_at)
+        for product_id, units in needed.items()
+    ])
+    # .update() skips post_save, so invalidate cached catalogue responses here
+    transaction.on_commit(lambda: bump_generation('product'))
+
+
+def hold_for_payment(order, checkout_request_id):
+    """Ties the order to its STK push and keeps its stock held while the buyer pays."""
+    Order.objects.filter(pk=order.pk).update(mpesa_checkout_id=checkout_request_id, updated_at=timezone.now())
+    order.mpesa_checkout_id = checkout_request_id
+    StockReservation.objects.filter(order=order, status='active').update(
+        expires_at=timezone.now() + timedelta(seconds=settings.STOCK_PAYMENT_HOLD), updated_at=timezone.now(),
+    )
+
+
+def release_reservations(reservations):
+    """
+    Puts reserved units back on sale. Each reservation is claimed with a
+    conditional status update first, so a reservation released twice
+    (e.g. expiry racing a failure callback) only returns its stock once.
+    Returns the number released.
+    """
+    released = 0
+    for reservation in reservations.filter(status='active').only('pk', 'product_id', 'quantity'):
+        with transaction.atomic():
+            claimed = StockReservation.objects.filter(pk=reservation.pk, status='active').update(
+                status='released', updated_at=timezone.now(),
+            )
+            if claimed:
+                return_stock(reservation.product_id, reservation.quantity)
+                released += 1
+    if released:
+        bump_generation('product')
+    return released
+
+
+def cancel_unpaid_order(order_id):
+    """Releases an order's stock and cancels it, unless it has already moved on."""
+    released = release_reservations(StockReservation.objects.filter(order_id=order_id))
+    if Order.objects.filter(pk=order_id, status='pending').update(status='cancelled', updated_at=timezone.now()):
+        OrderStatusChange.objects.create(order_id=order_id, from_status='pending', to_status='cancelled')
+    return released
+
+
+def commit_reservations(order_id):
+    """
+    Makes an order's reserved stock permanent (payment received or order
+    fulfilled). If the hold had already expired, the units are taken again,
+    all of them or none. Returns False if they could not be.
+    """
+    committed = StockReservation.objects.filter(order_id=order_id, status='active').update(
+        status='committed', updated_at=timezone.now(),
+    )
+    stale = StockReservation.objects.filter(order_id=order_id, status='released')
+    if committed or not stale.exists():
+        return True
+    with transaction.atomic():
+        for reservation in stale.select_for_update():
+            if not take_stock(reservation.product_id, reservation.quantity):
+                logger.error(
+                    f"Order {order_id} was paid after its reservation expired and product "
+                    f"{reservation.product_id} is no longer in stock; needs a refund or restock."
+                )
+                transaction.set_rollback(True)
+                return False
+            StockReservation.objects.filter(pk=reservation.pk).update(status='committed', updated_at=timezone.now())
+    bump_generation('product')
+    return True
+
+
+def reopen_paid_order(order_id):
+    """
+    A payment that completes after the order was cancelled for running out
+    of time puts it back to pending, with its stock taken again. An order a
+    seller cancelled, or whose stock has since sold, stays cancelled and is
+    logged for a refund. Returns True if the order was reopened.
+    """
+    with transaction.atomic():
+        if not Order.objects.select_for_update().filter(pk=order_id, status='cancelled').exists():
+            return False
+        if OrderStatusChange.objects.filter(order_id=order_id, to_status='cancelled', changed_by__isnull=False).exists():
+            logger.error(f"Order {order_id} was paid after a seller cancelled it; needs a refund.")
+            return False
+        if not commit_reservations(order_id):
+            return False
+        Order.objects.filter(pk=order_id).update(status='pending', updated_at=timezone.now())
+        OrderStatusChange.objects.create(order_id=order_id, from_status='cancelled', to_status='pending')
+    return True
+
+
+def settle_payment(checkout_request_id, succeeded):
+    """
+    Applies an M-Pesa result to the order the push was made for: a
+    completed payment makes the reservation permanent (reopening an order
+    that expired while the buyer paid), a failed one cancels the order and
+    returns its stock, unless another push already paid it.
+    """
+    order_id = MpesaSTKPush.objects.filter(checkout_request_id=checkout_request_id).values_list('order_id', flat=True).first()
+    if order_id is None:
+        return
+    if succeeded:
+        if Order.objects.filter(pk=order_id, status='cancelled').exists():
+            reopen_paid_order(order_id)
+        else:
+            commit_reservations(order_id)
+    elif not MpesaSTKPush.objects.filter(order_id=order_id, status='Completed').exists():
+        cancel_unpaid_order(order_id)
+
+
+def release_expired_reservations(now=None):
+    """Cancels pending orders whose stock hold ran out and returns the stock. Returns orders cancelled."""
+    now = now or timezone.now()
+    order_ids = list(
+        StockReservation.objects.filter(status='active', expires_at__lt=now, order__status='pending')
+        .values_list('order_id', flat=True).distinct()
+    )
+    for order_id in order_ids:
+        cancel_unpaid_order(order_id)
+    return len(order_ids)
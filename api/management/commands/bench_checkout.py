@@ -0,0 +1,99 @@
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from orders.models import Order
+from product.models import Product
+from api.checkout_utils import CheckoutError, DuplicateRequest, place_order
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrency benchmark: parallel checkouts across many buyers, each sent several times "
+        "with the same Idempotency-Key. Reports throughput, latency and whether any order was duplicated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50, help="Buyers checking out at the same time.")
+        parser.add_argument('--items', type=int, default=5, help="Cart lines per buyer.")
+        parser.add_argument('--duplicates', type=int, default=3, help="Copies of each checkout sent concurrently (double taps).")
+        parser.add_argument('--threads', type=int, default=16, help="Worker threads.")
+        parser.add_argument('--without-key', action='store_true', help="Send duplicates without an Idempotency-Key; only the cart lock stops them.")
+
+    def handle(self, *args, **options):
+        # Threads need committed data, so the synthetic rows are deleted afterwards instead of rolled back
+        tag = uuid.uuid4().hex[:8]
+        seller, buyers = self.seed(tag, options['buyers'], options['items'])
+        try:
+            self.run(buyers, options['duplicates'], options['threads'], not options['without_key'])
+        finally:
+            Order.objects.filter(buyer__in=buyers).delete()
+            Product.objects.filter(seller=seller).delete()
+            AppUser.objects.filter(pk__in=[seller.pk] + [buyer.pk for buyer in buyers]).delete()
+
+    def seed(self, tag, buyer_count, items):
+        seller = AppUser.objects.create_user(username=f'bench-seller-{tag}', email=f'bench-seller-{tag}@example.com', password=None, user_type='Seller')
+        products = Product.objects.bulk_create([
+            Product(seller=seller, name=f'Bench item {i}', slug=f'bench-{tag}-{i}', price=Decimal('250.00'), stock_quantity=10 ** 6)
+            for i in range(items)
+        ])
+        buyers = [
+            AppUser.objects.create_user(username=f'bench-buyer-{tag}-{i}', email=f'bench-buyer-{tag}-{i}@example.com', password=None)
+            for i in range(buyer_count)
+        ]
+        carts = Cart.objects.bulk_create([Cart(user=buyer) for buyer in buyers])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=2, unit_price=product.price, subtotal=2 * product.price)
+            for cart in carts for product in products
+        ])
+        for cart in carts:
+            cart.recalculate_totals()
+        return seller, buyers
+
+    def run(self, buyers, duplicates, threads, use_key):
+        jobs = [(buyer, f'bench-{buyer.pk}' if use_key else None) for buyer in buyers for _ in range(duplicates)]
+        outcomes = {'created': 0, 'replayed': 0, 'empty': 0, 'error': 0}
+        latencies = []
+
+        def checkout(job):
+            buyer, key = job
+            start = time.perf_counter()
+            try:
+                place_order(buyer, lambda order: {'order_id': str(order.pk)}, idempotency_key=key)
+                outcome = 'created'
+            except DuplicateRequest:
+                outcome = 'replayed'
+            except CheckoutError:
+                outcome = 'empty'
+            except Exception as e:
+                self.stderr.write(f"{type(e).__name__}: {e}")
+                outcome = 'error'
+            finally:
+                close_old_connections()
+            return outcome, time.perf_counter() - start
+
+        wall = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for outcome, latency in pool.map(checkout, jobs):
+                outcomes[outcome] += 1
+                latencies.append(latency)
+        wall = time.perf_counter() - wall
+
+        orders = Order.objects.filter(buyer__in=buyers).count()
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(f"requests: {len(jobs)} ({len(buyers)} buyers x {duplicates}), threads: {threads}")
+        self.stdout.write(f"outcomes: {outcomes}")
+        self.stdout.write(f"throughput: {len(jobs) / wall:,.1f} checkouts/sec, "
+                          f"p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+        if orders == len(buyers):
+            self.stdout.write(self.style.SUCCESS(f"orders: {orders} for {len(buyers)} buyers, no duplicates"))
+        else:
+            self.stdout.write(self.style.ERROR(f"orders: {orders} for {len(buyers)} buyers"))
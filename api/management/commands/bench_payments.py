@@ -0,0 +1,179 @@
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import close_old_connections
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from api.checkout_utils import place_order
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from orders.models import Order
+from payments.models import MpesaCallback, MpesaSTKPush
+from payments.services import get_client, reconcile_pending_pushes
+from payments.simulator import add_simulator_arguments, simulator_from_options
+from product.models import Product
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Payment load test: buyers pay for their orders through the STK push endpoint against the Daraja "
+        "simulator, whose callbacks come back through /api/payments/callback/. Reports payments/sec, "
+        "initiation and confirmation latency, and whether every order ended up in the right state."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=200, help="Buyers paying for one order each.")
+        parser.add_argument('--concurrency', type=int, default=8, help="STK push requests in flight.")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for every payment to be confirmed.")
+        parser.add_argument('--reconcile-after', type=float, help="Also run the reconciler for pushes pending this many seconds (for --drop-rate).")
+        parser.add_argument('--base-url', help="Drive an already running server (its MPESA_* settings pointing at "
+                                               "run_daraja_simulator) instead of an in-process one; the simulator options are then ignored.")
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        # The server threads need committed data, so the synthetic rows are deleted afterwards
+        tag = uuid.uuid4().hex[:8]
+        seller, buyers, orders = self.seed(tag, options['payments'])
+        try:
+            if options['base_url']:
+                self.run(options['base_url'].rstrip('/'), buyers, orders, options)
+                return
+            simulator = simulator_from_options(options).start()
+            server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+            server.daemon_threads = True
+            server.set_app(get_internal_wsgi_application())
+            base_url = f"http://127.0.0.1:{server.server_address[1]}"
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            overrides = override_settings(
+                MPESA_CALLBACK_URL=f'{base_url}/api/payments/callback/',
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, '127.0.0.1'],
+                **simulator.settings(),
+            )
+            try:
+                with overrides:
+                    self.run(base_url, buyers, orders, options)
+                    self.stdout.write(f"simulator: {simulator.stats}")
+            finally:
+                server.shutdown()
+                server.server_close()
+                simulator.stop()
+        finally:
+            pushes = MpesaSTKPush.objects.filter(user__in=buyers)
+            MpesaCallback.objects.filter(checkout_request_id__in=pushes.values('checkout_request_id')).delete()
+            pushes.delete()
+            Order.objects.filter(buyer__in=buyers).delete()
+            Product.objects.filter(seller=seller).delete()
+            AppUser.objects.filter(pk__in=[seller.pk] + [buyer.pk for buyer in buyers]).delete()
+
+    def seed(self, tag, buyer_count):
+        seller = AppUser.objects.create_user(username=f'bench-seller-{tag}', email=f'bench-seller-{tag}@example.com', password=None, user_type='Seller')
+        product = Product.objects.create(seller=seller, name='Bench item', slug=f'bench-{tag}', price=Decimal('250.00'), stock_quantity=10 ** 6)
+        buyers = [
+            AppUser.objects.create_user(username=f'bench-buyer-{tag}-{i}', email=f'bench-buyer-{tag}-{i}@example.com', password=None)
+            for i in range(buyer_count)
+        ]
+        carts = Cart.objects.bulk_create([Cart(user=buyer) for buyer in buyers])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1, unit_price=product.price, subtotal=product.price) for cart in carts
+        ])
+        orders = {}
+        for cart, buyer in zip(carts, buyers):
+            cart.recalculate_totals()
+            orders[buyer.pk], _ = place_order(buyer, lambda order: None)
+        return seller, buyers, orders
+
+    def run(self, base_url, buyers, orders, options):
+        tokens = {buyer.pk: Token.objects.create(user=buyer).key for buyer in buyers}
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=options['concurrency']))
+        started, initiation, outcomes = {}, [], {}
+        lock = threading.Lock()
+
+        def pay(buyer):
+            started[buyer.pk] = time.perf_counter()
+            try:
+                response = session.post(
+                    f'{base_url}/api/payments/stk-push/',
+                    json={'phone_number': '254700000000', 'order_id': str(orders[buyer.pk].pk)},
+                    headers={'Authorization': f'Token {tokens[buyer.pk]}'}, timeout=30,
+                )
+                outcome = f'http_{response.status_code}'
+            except requests.exceptions.RequestException as e:
+                outcome = type(e).__name__
+            with lock:
+                initiation.append(time.perf_counter() - started[buyer.pk])
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        wall = time.perf_counter()
+        confirmed, results = {}, {}
+        client = get_client()
+        last_reconcile = last_confirmed = wall
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            futures = [pool.submit(pay, buyer) for buyer in buyers]
+            # Poll for results while the pushes are still going out
+            deadline = wall + options['timeout']
+            while len(confirmed) < len(buyers) and time.perf_counter() < deadline:
+                time.sleep(0.02)
+                rows = (
+                    MpesaSTKPush.objects.filter(user__in=[pk for pk in started if pk not in confirmed])
+                    .exclude(status='Pending').values_list('user_id', 'status')
+                )
+                now = time.perf_counter()
+                for user_id, push_status in rows:
+                    confirmed[user_id] = now - started[user_id]
+                    results[push_status] = results.get(push_status, 0) + 1
+                    last_confirmed = now
+                # Pushes Daraja never accepted will not be confirmed
+                if all(future.done() for future in futures) and len(confirmed) >= outcomes.get('http_200', 0):
+                    break
+                if options['reconcile_after'] is not None and now - last_reconcile > 1:
+                    reconcile_pending_pushes(client, older_than=options['reconcile_after'])
+                    last_reconcile = now
+        close_old_connections()
+
+        initiation.sort()
+        latencies = sorted(confirmed.values())
+        self.stdout.write(f"payments: {len(buyers)}, concurrency: {options['concurrency']}")
+        self.stdout.write(f"initiation: {outcomes}, p50 {statistics.median(initiation) * 1000:.1f} ms, "
+                          f"p95 {percentile(initiation, 0.95) * 1000:.1f} ms")
+        if latencies:
+            elapsed = last_confirmed - wall
+            self.stdout.write(f"confirmed: {results} in {elapsed:.1f}s, {len(latencies) / elapsed:,.1f} payments/sec")
+            self.stdout.write(f"confirmation latency: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+                              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms")
+        checkout_ids = MpesaSTKPush.objects.filter(user__in=buyers).values('checkout_request_id')
+        self.stdout.write(f"callbacks stored: {MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids).count()}")
+        self.check_orders(buyers, len(confirmed))
+
+    def check_orders(self, buyers, confirmed):
+        """Every paid order is committed, every cancelled payment's order is cancelled, nothing applied twice."""
+        paid = set(MpesaSTKPush.objects.filter(user__in=buyers, status='Completed').values_list('checkout_request_id', flat=True))
+        unpaid = set(MpesaSTKPush.objects.filter(user__in=buyers).exclude(status__in=['Completed', 'Pending']).values_list('checkout_request_id', flat=True))
+        orders = Order.objects.filter(buyer__in=buyers)
+        committed = set(orders.filter(reservations__status='committed').values_list('mpesa_checkout_id', flat=True).distinct())
+        cancelled = set(orders.filter(status='cancelled').values_list('mpesa_checkout_id', flat=True))
+        problems = len(paid ^ committed) + len(unpaid ^ cancelled)
+        if confirmed < len(buyers):
+            self.stdout.write(self.style.WARNING(f"unconfirmed: {len(buyers) - confirmed} payments still pending"))
+        if problems:
+            self.stdout.write(self.style.ERROR(f"orders: {problems} out of step with their payment"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"orders: {len(committed)} committed, {len(cancelled)} cancelled, all consistent"))
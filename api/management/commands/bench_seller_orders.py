@@ -0,0 +1,113 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from authentication.models import AppUser
+from orders.models import Order, OrderItem
+from product.models import MysteryBox, Product
+from api.order_utils import seller_order_page
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark: a seller's order feed on a synthetic dataset, comparing the old "
+        "items__product__seller join + DISTINCT (OFFSET paging) with the keyset scan over OrderItem.seller."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1_000_000, help="Synthetic orders to create.")
+        parser.add_argument('--sellers', type=int, default=1000, help="Sellers the orders are spread over.")
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--pages', type=int, default=20, help="Pages to walk for the deep-page timing.")
+        parser.add_argument('--explain', action='store_true', help="Print the query plans.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                # Synthetic data never outlives the benchmark
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, order_count, seller_count, batch=10000):
+        rng = random.Random(37)
+        buyer = AppUser.objects.create_user(username='bench-buyer', email='bench-buyer@example.com', password=None)
+        sellers = AppUser.objects.bulk_create([
+            AppUser(username=f'bench-seller-{i}', email=f'bench-seller-{i}@example.com', user_type='Seller')
+            for i in range(seller_count)
+        ])
+        products = Product.objects.bulk_create([
+            Product(seller=seller, name='Bench item', slug=f'bench-item-{i}', price=Decimal('300.00'))
+            for i, seller in enumerate(sellers)
+        ])
+        boxes = MysteryBox.objects.bulk_create([MysteryBox(seller=seller, price=Decimal('500.00')) for seller in sellers])
+
+        for start in range(0, order_count, batch):
+            orders = Order.objects.bulk_create([
+                Order(buyer=buyer, total_price=Decimal('300.00')) for _ in range(min(batch, order_count - start))
+            ])
+            items = []
+            for order in orders:
+                index = rng.randrange(seller_count)
+                # One line in ten is a mystery box, which the old join never found
+                target = {'mystery_box': boxes[index]} if rng.random() < 0.1 else {'product': products[index]}
+                items.append(OrderItem(
+                    order=order, quantity=1, price=Decimal('300.00'),
+                    seller=sellers[index], ordered_at=order.created_at, **target,
+                ))
+            OrderItem.objects.bulk_create(items)
+        # The busiest seller makes for the longest feed
+        return max(sellers, key=lambda seller: OrderItem.objects.filter(seller=seller).count())
+
+    def timed(self, fn, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, result
+
+    def run(self, options):
+        size = options['page_size']
+        start = time.perf_counter()
+        seller = self.seed(options['orders'], options['sellers'])
+        self.stdout.write(f"Seeded {options['orders']} orders in {time.perf_counter() - start:.1f}s")
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        legacy = Order.objects.filter(items__product__seller=seller).distinct().order_by('-created_at')
+        legacy_total = legacy.count()
+        feed_total = OrderItem.objects.filter(seller=seller).values('order_id').distinct().count()
+        self.stdout.write(f"Busiest seller: {feed_total} orders ({legacy_total} found by the old product-only join)")
+
+        deep = size * (options['pages'] - 1)
+        legacy_first, _ = self.timed(lambda: list(legacy.values_list('pk', flat=True)[:size]))
+        legacy_deep, _ = self.timed(lambda: list(legacy.values_list('pk', flat=True)[deep:deep + size]))
+
+        # Walk to the deep page once to get its cursor, then time fetching it
+        cursor = None
+        for _ in range(options['pages'] - 1):
+            _, cursor = seller_order_page(seller, cursor, size)
+        keyset_first, _ = self.timed(lambda: seller_order_page(seller, None, size))
+        keyset_deep, _ = self.timed(lambda: seller_order_page(seller, cursor, size))
+
+        self.stdout.write(f"{'query':<34}{'page 1 ms':>12}{'page ' + str(options['pages']) + ' ms':>14}")
+        self.stdout.write(f"{'join + DISTINCT, OFFSET':<34}{legacy_first:>12.2f}{legacy_deep:>14.2f}")
+        self.stdout.write(f"{'OrderItem.seller keyset':<34}{keyset_first:>12.2f}{keyset_deep:>14.2f}")
+
+        if options['explain']:
+            self.stdout.write("\nOld plan:\n" + legacy.values_list('pk', flat=True)[:size].explain())
+            keyset = (
+                OrderItem.objects.filter(seller=seller).order_by('-ordered_at', '-order_id')
+                .values_list('ordered_at', 'order_id').distinct()[:size + 1]
+            )
+            self.stdout.write("\nKeyset plan:\n" + keyset.explain())
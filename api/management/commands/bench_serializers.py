@@ -0,0 +1,73 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from authentication.models import AppUser
+from orders.models import Order, OrderItem
+from product.models import Category, Product
+from api.renderers import ORJSONRenderer
+from api.serializers import OrderRowSerializer, OrderSerializer, ProductRowSerializer, ProductSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark: rows/sec for ModelSerializer + json vs .values() row serializers + orjson."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help="Synthetic products/orders to serialize.")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per case; the best one is reported.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], options['repeat'])
+                # Synthetic data never outlives the benchmark
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, rows):
+        seller = AppUser.objects.create_user(username='bench-seller', email='bench-seller@example.com', password=None, user_type='Seller')
+        buyer = AppUser.objects.create_user(username='bench-buyer', email='bench-buyer@example.com', password=None, user_type='Buyer')
+        category, _ = Category.objects.get_or_create(name='Bench')
+        products = Product.objects.bulk_create([
+            Product(
+                seller=seller, category=category, name=f'Bench item {i}', slug=f'bench-item-{i}',
+                description='Synthetic benchmark product.', price=Decimal('499.00'), image='products/jacket.jpg',
+            )
+            for i in range(rows)
+        ])
+        orders = Order.objects.bulk_create([Order(buyer=buyer, total_price=Decimal('998.00')) for _ in range(rows)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=2, price=product.price)
+            for order, product in zip(orders, products)
+        ])
+        return Product.objects.filter(seller=seller).order_by('-created_at'), Order.objects.filter(buyer=buyer).order_by('-created_at')
+
+    def run(self, rows, repeat):
+        products, orders = self.seed(rows)
+        request = Request(APIRequestFactory().get('/api/'))
+        context = {'request': request}
+
+        cases = [
+            ('product list / ModelSerializer + json', lambda: JSONRenderer().render(ProductSerializer(products, many=True, context=context).data)),
+            ('product list / rows + orjson', lambda: ORJSONRenderer().render(ProductRowSerializer(products, context).data)),
+            ('order list / ModelSerializer + json', lambda: JSONRenderer().render(OrderSerializer(orders, many=True, context=context).data)),
+            ('order list / rows + orjson', lambda: ORJSONRenderer().render(OrderRowSerializer(orders, context).data)),
+        ]
+        for name, case in cases:
+            best = min(self.timed(case) for _ in range(repeat))
+            self.stdout.write(f"{name:<42} {rows / best:>12,.0f} rows/sec  ({best * 1000:.1f} ms)")
+
+    def timed(self, case):
+        start = time.perf_counter()
+        case()
+        return time.perf_counter() - start
@@ -0,0 +1,97 @@
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from api.checkout_utils import place_order
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from orders.models import Order
+from payments.models import MpesaSTKPush
+from payments.simulator import DarajaSimulator
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Latency of the STK push endpoint (POST /api/payments/stk-push/) against the Daraja simulator, "
+        "paying for orders. Reports p50/p95/p99 and the SQL queries each request makes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300)
+        parser.add_argument('--threads', type=int, default=1, help="Concurrent requests.")
+        parser.add_argument('--latency', type=float, default=0.0, help="Simulated Daraja latency per call, in seconds.")
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        seller, buyers, orders = self.seed(tag, options['requests'])
+        # No callbacks: they would write while we measure
+        simulator = DarajaSimulator(latency=options['latency'], drop_rate=1).start()
+        try:
+            overrides = override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], MPESA_CALLBACK_URL='http://127.0.0.1/unused', **simulator.settings(),
+            )
+            with overrides:
+                self.run(buyers, orders, options['threads'])
+        finally:
+            simulator.stop()
+            MpesaSTKPush.objects.filter(user__in=buyers).delete()
+            Order.objects.filter(buyer__in=buyers).delete()
+            Product.objects.filter(seller=seller).delete()
+            AppUser.objects.filter(pk__in=[seller.pk] + [buyer.pk for buyer in buyers]).delete()
+
+    def seed(self, tag, count):
+        seller = AppUser.objects.create_user(username=f'bench-seller-{tag}', email=f'bench-seller-{tag}@example.com', password=None, user_type='Seller')
+        product = Product.objects.create(seller=seller, name='Bench item', slug=f'bench-{tag}', price=Decimal('250.00'), stock_quantity=10 ** 6)
+        buyers = [
+            AppUser.objects.create_user(username=f'bench-buyer-{tag}-{i}', email=f'bench-buyer-{tag}-{i}@example.com', password=None)
+            for i in range(count)
+        ]
+        carts = Cart.objects.bulk_create([Cart(user=buyer) for buyer in buyers])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1, unit_price=product.price, subtotal=product.price) for cart in carts
+        ])
+        orders = {}
+        for cart, buyer in zip(carts, buyers):
+            cart.recalculate_totals()
+            orders[buyer.pk], _ = place_order(buyer, lambda order: None)
+        return seller, buyers, orders
+
+    def run(self, buyers, orders, threads):
+        # Warm up the token cache and the shared client outside the measurement
+        client = APIClient()
+        client.force_authenticate(buyers[0])
+        client.post('/api/payments/stk-push/', {'phone_number': '254700000000', 'order_id': str(orders[buyers[0].pk].pk)}, format='json')
+
+        def pay(buyer):
+            client = APIClient()
+            client.force_authenticate(buyer)
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = client.post(
+                        '/api/payments/stk-push/', {'phone_number': '254700000000', 'order_id': str(orders[buyer.pk].pk)}, format='json',
+                    )
+                    latency = time.perf_counter() - start
+                return response.status_code, latency, len(queries)
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(pay, buyers[1:]))
+
+        latencies = sorted(latency for _, latency, _ in results)
+        failures = sum(1 for code, _, _ in results if code != 200)
+        queries = statistics.mean(count for _, _, count in results)
+        point = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+        self.stdout.write(f"requests: {len(results)} ({failures} failed), threads: {threads}")
+        self.stdout.write(f"latency: p50 {point(0.5):.1f} ms, p95 {point(0.95):.1f} ms, p99 {point(0.99):.1f} ms")
+        self.stdout.write(f"queries per request: {queries:.1f}")
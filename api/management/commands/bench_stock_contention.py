@@ -0,0 +1,99 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from orders.models import Order
+from product.models import MysteryBox, Product
+from api.checkout_utils import CheckoutError, place_order
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test: many buyers check out the same hot item at once. Verifies that exactly "
+        "`--stock` orders succeed and stock never goes negative. --naive runs a read-modify-write "
+        "stock check for comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=100, help="Concurrent buyers.")
+        parser.add_argument('--stock', type=int, default=10, help="Units of the hot item.")
+        parser.add_argument('--threads', type=int, default=16, help="Worker threads.")
+        parser.add_argument('--box', action='store_true', help="Buyers check out a mystery box containing the item instead.")
+        parser.add_argument('--naive', action='store_true', help="Check and decrement stock with read-modify-write instead.")
+
+    def handle(self, *args, **options):
+        # Threads need committed data, so the synthetic rows are deleted afterwards instead of rolled back
+        tag = uuid.uuid4().hex[:8]
+        seller, buyers, product = self.seed(tag, options['buyers'], options['stock'], options['box'])
+        try:
+            self.run(buyers, product, options['stock'], options['threads'], options['naive'])
+        finally:
+            Order.objects.filter(buyer__in=buyers).delete()
+            MysteryBox.objects.filter(seller=seller).delete()
+            Product.objects.filter(seller=seller).delete()
+            AppUser.objects.filter(pk__in=[seller.pk] + [buyer.pk for buyer in buyers]).delete()
+
+    def seed(self, tag, buyer_count, stock, box):
+        seller = AppUser.objects.create_user(username=f'bench-seller-{tag}', email=f'bench-seller-{tag}@example.com', password=None, user_type='Seller')
+        product = Product.objects.create(seller=seller, name='Hot item', slug=f'hot-{tag}', price=Decimal('800.00'), stock_quantity=stock)
+        target = {'product': product}
+        if box:
+            filler = Product.objects.create(seller=seller, name='Filler', slug=f'filler-{tag}', price=Decimal('100.00'), stock_quantity=10 ** 6)
+            mystery_box = MysteryBox.objects.create(seller=seller, price=Decimal('500.00'))
+            mystery_box.items.set([product, filler])
+            target = {'mystery_box': mystery_box}
+        buyers = [
+            AppUser.objects.create_user(username=f'bench-buyer-{tag}-{i}', email=f'bench-buyer-{tag}-{i}@example.com', password=None)
+            for i in range(buyer_count)
+        ]
+        for buyer in buyers:
+            CartItem.objects.create(cart=Cart.objects.create(user=buyer), quantity=1, **target)
+        return seller, buyers, product
+
+    def naive_checkout(self, buyer, product):
+        # Deliberately racy: the stock read and the write are separate statements
+        current = Product.objects.get(pk=product.pk)
+        if current.stock_quantity < 1:
+            raise CheckoutError("out of stock")
+        current.stock_quantity -= 1
+        current.save(update_fields=['stock_quantity'])
+        Order.objects.create(buyer=buyer, total_price=current.price)
+
+    def run(self, buyers, product, stock, threads, naive):
+        outcomes = {'ordered': 0, 'sold_out': 0, 'error': 0}
+
+        def checkout(buyer):
+            try:
+                if naive:
+                    self.naive_checkout(buyer, product)
+                else:
+                    place_order(buyer, lambda order: None)
+                return 'ordered'
+            except CheckoutError:
+                return 'sold_out'
+            except Exception as e:
+                self.stderr.write(f"{type(e).__name__}: {e}")
+                return 'error'
+            finally:
+                close_old_connections()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for outcome in pool.map(checkout, buyers):
+                outcomes[outcome] += 1
+        elapsed = time.perf_counter() - start
+
+        remaining = Product.objects.filter(pk=product.pk).values_list('stock_quantity', flat=True).get()
+        orders = Order.objects.filter(buyer__in=buyers).count()
+        self.stdout.write(f"{len(buyers)} buyers, {stock} in stock, {threads} threads, {elapsed:.2f}s")
+        self.stdout.write(f"outcomes: {outcomes}, orders: {orders}, stock left: {remaining}")
+        if orders == min(stock, len(buyers)) and remaining == stock - orders:
+            self.stdout.write(self.style.SUCCESS("No overselling."))
+        else:
+            self.stdout.write(self.style.ERROR(f"Oversold: {orders} orders for {stock} units."))
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from product.models import Product
+from api.image_utils import generate_product_derivatives
+
+
+class Command(BaseCommand):
+    help = "Backfill thumbnail/card/detail WebP and JPEG derivatives for existing product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate even if derivatives already exist.")
+        parser.add_argument('--workers', type=int, default=4, help="Images processed in parallel.")
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='')
+        if not options['force']:
+            products = products.filter(image_derivatives={})
+        product_ids = list(products.values_list('id', flat=True))
+        self.stdout.write(f"Generating derivatives for {len(product_ids)} product(s)...")
+
+        def run(product_id):
+            try:
+                return generate_product_derivatives(product_id)
+            finally:
+                close_old_connections()
+
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(run, product_id): product_id for product_id in product_ids}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Product {futures[future]}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {done} generated, {failed} failed."))
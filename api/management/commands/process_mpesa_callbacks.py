@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.services import callback_backlog, process_callbacks
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply queued M-Pesa STK callbacks from the inbox in batches. Web workers already do this "
+        "right after a callback arrives; run this from cron (or with --loop) to catch anything left over."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Callbacks per transaction (default MPESA_CALLBACK_BATCH_SIZE).")
+        parser.add_argument('--loop', action='store_true', help="Keep running, polling every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=2)
+
+    def handle(self, *args, **options):
+        while True:
+            handled = 0
+            while True:
+                batch = process_callbacks(options['batch_size'])
+                handled += batch
+                if not batch:
+                    break
+            if handled or not options['loop']:
+                self.stdout.write(f"{handled} callback(s) handled; backlog {callback_backlog()}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
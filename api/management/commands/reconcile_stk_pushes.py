@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.services import get_client, pending_backlog, reconcile_pending_pushes
+
+
+class Command(BaseCommand):
+    help = (
+        "Query M-Pesa for STK pushes whose callback never arrived, apply the results and expire "
+        "pushes that stay unresolved. Run from cron, or with --loop as a long-lived worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.MPESA_RECONCILE_AFTER, help="Seconds a push must have been pending.")
+        parser.add_argument('--expire-after', type=int, default=settings.MPESA_STK_EXPIRE_AFTER, help="Seconds after which an unresolved push is failed.")
+        parser.add_argument('--workers', type=int, default=settings.MPESA_RECONCILE_WORKERS, help="Concurrent status queries.")
+        parser.add_argument('--rate', type=float, default=settings.MPESA_RECONCILE_RATE, help="Max status queries per second (0 = unlimited).")
+        parser.add_argument('--limit', type=int, default=500, help="Max pushes checked per pass.")
+        parser.add_argument('--loop', action='store_true', help="Keep running, one pass every --interval seconds.")
+        parser.add_argument('--interval', type=int, default=30)
+
+    def handle(self, *args, **options):
+        client = get_client()
+        while True:
+            start = time.perf_counter()
+            outcomes = reconcile_pending_pushes(
+                client, older_than=options['older_than'], expire_after=options['expire_after'],
+                workers=options['workers'], rate=options['rate'], limit=options['limit'],
+            )
+            summary = ', '.join(f"{count} {outcome}" for outcome, count in outcomes.items() if count) or "nothing to do"
+            self.stdout.write(f"{summary} in {time.perf_counter() - start:.1f}s; backlog {pending_backlog()}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
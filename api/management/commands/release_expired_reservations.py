@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.inventory_utils import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Cancel unpaid orders whose stock reservation expired and put the stock back on sale. Run every minute or so (cron)."
+
+    def handle(self, *args, **options):
+        cancelled = release_expired_reservations()
+        self.stdout.write(self.style.SUCCESS(f"Done: {cancelled} expired order(s) cancelled."))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.simulator import add_simulator_arguments, simulator_from_options
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for Daraja (OAuth, STK push, STK query) that sends callbacks like the "
+        "real one. Point the server's MPESA_* settings at it to test payments without Safaricom."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        simulator = simulator_from_options(options, host=options['host'], port=options['port']).start()
+        self.stdout.write(f"Daraja simulator listening on {simulator.url}. Start the server with:")
+        for name, value in simulator.settings().items():
+            self.stdout.write(f"  export {name}={value or ''}")
+        self.stdout.write("  export MPESA_CALLBACK_URL=<server>/api/payments/callback/")
+        try:
+            while True:
+                time.sleep(10)
+                self.stdout.write(', '.join(f"{stat} {count}" for stat, count in simulator.stats.items()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            simulator.stop()
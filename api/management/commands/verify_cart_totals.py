@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import DecimalField, F, IntegerField, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from cart.models import Cart
+
+
+class Command(BaseCommand):
+    help = "Check the stored Cart.total_price / item_count against the cart items and repair any drift. Meant to run periodically (cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report drifted carts.")
+        parser.add_argument(
+            '--settle', type=int, default=60,
+            help="Skip carts changed in the last N seconds; their item writes may still be in flight.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['settle'])
+        drifted = (
+            Cart.objects.filter(updated_at__lt=cutoff)
+            .annotate(
+                actual_total=Coalesce(Sum('items__subtotal'), Value(0), output_field=DecimalField()),
+                actual_count=Coalesce(Sum('items__quantity'), Value(0), output_field=IntegerField()),
+            )
+            .exclude(total_price=F('actual_total'), item_count=F('actual_count'))
+        )
+
+        fixed = 0
+        for cart in drifted.iterator():
+            self.stdout.write(
+                f"Cart {cart.cart_id}: stored {cart.total_price} / {cart.item_count}, "
+                f"actual {cart.actual_total} / {cart.actual_count}"
+            )
+            if not options['dry_run']:
+                cart.recalculate_totals()
+                fixed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {fixed} cart(s) repaired."))
@@ -0,0 +1,111 @@
+import base64
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from orders.models import ALLOWED_STATUS_TRANSITIONS, Order, OrderItem, OrderStatusChange, StockReservation
+from .inventory_utils import commit_reservations, release_reservations
+
+MAX_BULK_STATUS_ORDERS = 500
+
+
+def encode_cursor(ordered_at, order_id):
+    raw = f"{ordered_at.isoformat()}|{order_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """Inverse of encode_cursor; a mangled cursor is a 400, not a 500."""
+    try:
+        raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+        ordered_at, order_id = raw.split('|')
+        ordered_at = parse_datetime(ordered_at)
+        order_id = uuid.UUID(order_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValidationError({'cursor': "Invalid cursor."})
+    if ordered_at is None:
+        raise ValidationError({'cursor': "Invalid cursor."})
+    return ordered_at, order_id
+
+
+def page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return settings.SELLER_ORDERS_PAGE_SIZE
+    return max(1, min(size, settings.SELLER_ORDERS_MAX_PAGE_SIZE))
+
+
+def seller_order_page(seller, cursor=None, limit=None):
+    """
+    One page of the orders containing `seller`'s products or mystery boxes,
+    newest first. Keyset pagination over OrderItem(seller, ordered_at, order):
+    the page is an index range scan that starts right after the cursor, so
+    page 1000 costs the same as page 1. Returns (order ids, next cursor or None).
+    """
+    limit = limit or settings.SELLER_ORDERS_PAGE_SIZE
+    items = OrderItem.objects.filter(seller=seller)
+    if cursor:
+        ordered_at, order_id = decode_cursor(cursor)
+        items = items.filter(Q(ordered_at__lt=ordered_at) | Q(ordered_at=ordered_at, order_id__lt=order_id))
+    # An order with several of the seller's lines appears once
+    rows = list(
+        items.order_by('-ordered_at', '-order_id').values_list('ordered_at', 'order_id').distinct()[:limit + 1]
+    )
+    next_cursor = encode_cursor(*rows[limit - 1]) if len(rows) > limit else None
+    return [order_id for _, order_id in rows[:limit]], next_cursor
+
+
+def transition_orders(seller, order_ids, new_status):
+    """
+    Moves the given orders to `new_status` for `seller`. Ownership and
+    current status of every order are read (and the rows locked) in one
+    query, the allowed ones are moved with one UPDATE, and each move is
+    appended to the status history. Returns {order_id: {'result', 'status'}}
+    where result is 'updated', 'not_found', 'forbidden' or 'invalid_transition'
+    and status is the order's status afterwards.
+    """
+    order_ids = list(dict.fromkeys(order_ids))
+    with transaction.atomic():
+        rows = (
+            Order.objects.filter(pk__in=order_ids)
+            .select_for_update(of=('self',))
+            .annotate(owned=Exists(OrderItem.objects.filter(order=OuterRef('pk'), seller=seller)))
+            .values_list('pk', 'status', 'owned')
+        )
+        current = {order_id: (order_status, owned) for order_id, order_status, owned in rows}
+
+        results, moving = {}, {}
+        for order_id in order_ids:
+            if order_id not in current:
+                results[order_id] = {'result': 'not_found', 'status': None}
+                continue
+            order_status, owned = current[order_id]
+            if not owned:
+                # Don't reveal the status of someone else's order
+                results[order_id] = {'result': 'forbidden', 'status': None}
+            elif new_status not in ALLOWED_STATUS_TRANSITIONS[order_status]:
+                results[order_id] = {'result': 'invalid_transition', 'status': order_status}
+            else:
+                results[order_id] = {'result': 'updated', 'status': new_status}
+                moving[order_id] = order_status
+
+        if moving:
+            Order.objects.filter(pk__in=moving).update(status=new_status, updated_at=timezone.now())
+            OrderStatusChange.objects.bulk_create([
+                OrderStatusChange(order_id=order_id, from_status=from_status, to_status=new_status, changed_by=seller)
+                for order_id, from_status in moving.items()
+            ])
+            reservations = StockReservation.objects.filter(order_id__in=moving)
+            if new_status == 'cancelled':
+                release_reservations(reservations)
+            elif new_status == 'processed':
+                # Orders paid through M-Pesa are already committed; only the rest need work
+                for order_id in set(reservations.exclude(status='committed').values_list('order_id', flat=True)):
+                    commit_reservations(order_id)
+    return results
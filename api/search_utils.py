@@ -0,0 +1,140 @@
+import re
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+# Index objects created by product/migrations/0006_product_search_index.py
+SQLITE_FTS_TABLE = 'product_product_fts'
+POSTGRES_SEARCH_COLUMN = 'search_vector'
+
+# Keep user input from turning into a huge MATCH / tsquery expression
+MAX_QUERY_TERMS = 8
+
+
+def _query_terms(query):
+    """Splits free text into safe word tokens (no FTS operators or quotes)."""
+    return re.findall(r'\w+', (query or '').lower())[:MAX_QUERY_TERMS]
+
+
+def _to_datetime(value):
+    """SQLite hands back raw timestamp strings from cursor queries."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value is not None and timezone.is_naive(value):
+        value = value.replace(tzinfo=dt_timezone.utc)
+    return value
+
+
+def _postgres_candidates(connection, terms, limit):
+    tsquery = ' & '.join(f"{term}:*" for term in terms)
+    sql = f"""
+        SELECT id, ts_rank_cd({POSTGRES_SEARCH_COLUMN}, to_tsquery('english', %s)) AS relevance, created_at
+        FROM product_product
+        WHERE {POSTGRES_SEARCH_COLUMN} @@ to_tsquery('english', %s)
+        ORDER BY relevance DESC
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [tsquery, tsquery, limit])
+        return cursor.fetchall()
+
+
+def _sqlite_candidates(connection, terms, limit):
+    match = ' '.join(f'"{term}"*' for term in terms)
+    # bm25() is "lower is better", so flip the sign to get a relevance score.
+    # Column weights: product_id (unindexed), name, description, condition_notes
+    sql = f"""
+        SELECT f.product_id, -bm25({SQLITE_FTS_TABLE}, 0.0, 10.0, 4.0, 2.0) AS relevance, p.created_at
+        FROM {SQLITE_FTS_TABLE} f
+        JOIN product_product p ON p.id = f.product_id
+        WHERE {SQLITE_FTS_TABLE} MATCH %s
+        ORDER BY relevance DESC
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match, limit])
+        return [(uuid.UUID(pk), relevance, _to_datetime(created)) for pk, relevance, created in cursor.fetchall()]
+
+
+def rank_candidates(candidates, recency=False, now=None):
+    """
+    Orders (id, relevance, created_at) rows by relevance, optionally
+    boosting newer listings with an exponential decay on their age.
+    """
+    now = now or timezone.now()
+    half_life = settings.SEARCH_RECENCY_HALF_LIFE_DAYS
+    weight = settings.SEARCH_RECENCY_WEIGHT
+
+    def score(row):
+        _, relevance, created_at = row
+        relevance = float(relevance or 0)
+        if not recency or created_at is None:
+            return relevance
+        age_days = max((now - created_at).total_seconds(), 0) / 86400
+        return relevance * (1 + weight * 0.5 ** (age_days / half_life))
+
+    return [row[0] for row in sorted(candidates, key=score, reverse=True)]
+
+
+def search_products(queryset, query, recency=False):
+    """
+    Filters a Product queryset down to keyword matches, ordered by relevance.
+    Uses the tsvector/GIN index on PostgreSQL and the FTS5 table on SQLite;
+    any other backend falls back to a plain icontains scan.
+    """
+    terms = _query_terms(query)
+    if not terms:
+        return queryset.none()
+
+    connection = connections[queryset.db]
+    limit = settings.SEARCH_MAX_RESULTS
+
+    if connection.vendor == 'postgresql':
+        candidates = _postgres_candidates(connection, terms, limit)
+    elif connection.vendor == 'sqlite':
+        candidates = _sqlite_candidates(connection, terms, limit)
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= (
+                Q(name__icontains=term) | Q(description__icontains=term) | Q(condition_notes__icontains=term)
+            )
+        return queryset.filter(condition)
+
+    ranked_ids = rank_candidates(candidates, recency=recency)
+    if not ranked_ids:
+        return queryset.none()
+
+    position = Case(
+        *[When(pk=pk, then=Value(index)) for index, pk in enumerate(ranked_ids)],
+        output_field=IntegerField(),
+    )
+    return queryset.filter(pk__in=ranked_ids).order_by(position)
+
+
+def index_product(product, using='default'):
+    """
+    Refreshes the FTS5 row for one product. PostgreSQL keeps its tsvector
+    column current with a trigger, so this is a no-op there.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SQLITE_FTS_TABLE} WHERE product_id = %s", [product.pk.hex])
+        cursor.execute(
+            f"INSERT INTO {SQLITE_FTS_TABLE} (product_id, name, description, condition_notes) VALUES (%s, %s, %s, %s)",
+            [product.pk.hex, product.name or '', product.description or '', product.condition_notes or ''],
+        )
+
+
+def remove_product_from_index(product, using='default'):
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SQLITE_FTS_TABLE} WHERE product_id = %s", [product.pk.hex])
@@ -1,9 +1,17 @@
+from decimal import Decimal
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
 from rest_framework import serializers
 from product.models import Product, Category, Audience, Size, MysteryBox
-from orders.models import Order, OrderItem
+from orders.models import Order, OrderItem, STATUS_CHOICES
 from reviews.models import Review, RateTrader
 from cart.models import Cart, CartItem
 from authentication.models import AppUser
+from .image_utils import product_image_variants, image_variants_from_manifest, srcset
+from .fieldset_utils import FieldSelection, SparseFieldsMixin
+from .cart_utils import MAX_BATCH_OPERATIONS, MAX_LINE_QUANTITY
+from .order_utils import MAX_BULK_STATUS_ORDERS
 
 
 
@@ -11,7 +19,7 @@ from authentication.models import AppUser
 # User Serializers
 # ===================================================================
 
-class AppUserSerializer(serializers.ModelSerializer):
+class AppUserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the custom AppUser model. Handles user registration and display.
     The password is write-only for security.
@@ -41,7 +49,7 @@ class AppUserSerializer(serializers.ModelSerializer):
 # Product and Category Serializers
 # ===================================================================
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Product model.
     Uses StringRelatedField for readable representations of foreign keys.
@@ -51,12 +59,24 @@ class ProductSerializer(serializers.ModelSerializer):
     category = serializers.StringRelatedField()
     audience = serializers.StringRelatedField()
     size = serializers.StringRelatedField()
+    # Resized copies of `image` (thumb/card/detail), filled in after upload
+    image_variants = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
+
+    query_map = {
+        'seller': ['seller__email'],
+        'category': ['category__name'],
+        'audience': ['audience__name'],
+        'size': ['size__name'],
+        'image_variants': ['image_derivatives'],
+        'image_srcset': ['image_derivatives'],
+    }
 
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'slug', 'description', 'price', 'stock_quantity',
-            'image', 'seller', 'category', 'audience', 'size',
+            'image', 'image_variants', 'image_srcset', 'seller', 'category', 'audience', 'size',
             'created_at', 'updated_at'
         ]
         extra_kwargs = {
@@ -65,13 +85,23 @@ class ProductSerializer(serializers.ModelSerializer):
         }
         read_only_fields = ['slug', 'seller', 'created_at', 'updated_at']
 
+    def get_image_variants(self, obj):
+        return product_image_variants(obj, self.context.get('request'))
 
+    def get_image_srcset(self, obj):
+        variants = product_image_variants(obj, self.context.get('request'))
+        return {'webp': srcset(variants, 'webp'), 'jpg': srcset(variants, 'jpg')}
 
-class MysteryBoxSerializer(serializers.ModelSerializer):
+
+
+class MysteryBoxSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # This nesting shows you the full details of the items inside the box
     items = ProductSerializer(many=True, read_only=True)
     seller_email = serializers.ReadOnlyField(source='seller.email')
 
+    expandable_fields = {'items': (ProductSerializer, {'many': True})}
+    query_map = {'seller_email': ['seller__email']}
+
     class Meta:
         model = MysteryBox
         fields = [
@@ -83,40 +113,78 @@ class MysteryBoxSerializer(serializers.ModelSerializer):
 # Cart and CartItem Serializers
 # ===================================================================
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # Nest a simplified product serializer for better detail in the cart view
     product = ProductSerializer(read_only=True)
     product_id = serializers.UUIDField(write_only=True) # For adding items to cart
 
+    expandable_fields = {'product': (ProductSerializer, {})}
+
     class Meta:
         model = CartItem
         fields = ['cart_item_id', 'product', 'product_id', 'quantity', 'unit_price', 'subtotal']
         read_only_fields = ['cart_item_id', 'unit_price', 'subtotal', 'product']
+        extra_kwargs = {'quantity': {'max_value': MAX_LINE_QUANTITY}}
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # Use the CartItemSerializer to show a list of items in the cart
     items = CartItemSerializer(many=True, read_only=True)
-    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+
+    expandable_fields = {'items': (CartItemSerializer, {'many': True})}
 
     class Meta:
         model = Cart
-        fields = ['cart_id', 'user', 'items', 'total_price', 'updated_at']
+        fields = ['cart_id', 'user', 'items', 'total_price', 'item_count', 'updated_at']
         read_only_fields = ['user']
 
+class CartOperationSerializer(serializers.Serializer):
+    """One add/update/remove step of a batch cart request."""
+    op = serializers.ChoiceField(choices=['add', 'update', 'remove'])
+    product_id = serializers.UUIDField(required=False)
+    mystery_box_id = serializers.UUIDField(required=False)
+    quantity = serializers.IntegerField(min_value=0, max_value=MAX_LINE_QUANTITY, default=1)
+
+    def validate(self, data):
+        if bool(data.get('product_id')) == bool(data.get('mystery_box_id')):
+            raise serializers.ValidationError("Provide either product_id or mystery_box_id.")
+        if data['op'] == 'add' and data['quantity'] < 1:
+            raise serializers.ValidationError({'quantity': "Must be at least 1 when adding."})
+        return data
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=MAX_BATCH_OPERATIONS)
+
+class GuestCartItemSerializer(serializers.Serializer):
+    product = ProductSerializer(read_only=True, allow_null=True)
+    mystery_box_id = serializers.UUIDField(read_only=True, allow_null=True)
+    quantity = serializers.IntegerField(read_only=True)
+    unit_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    subtotal = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+
+class GuestCartSerializer(serializers.Serializer):
+    """Anonymous cart kept in a signed cookie (see api/cart_utils.py)."""
+    items = GuestCartItemSerializer(many=True, read_only=True)
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+    item_count = serializers.IntegerField(read_only=True)
+
 
 # ===================================================================
 # Order and OrderItem Serializers
 # ===================================================================
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Serializer for a single item within an order."""
     product = ProductSerializer(read_only=True)
     subtotal = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+
+    expandable_fields = {'product': (ProductSerializer, {})}
+    query_map = {'subtotal': ['quantity', 'price']}
     class Meta:
         model = OrderItem
         fields = ['product', 'quantity', 'price', 'subtotal']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Main serializer for an Order. It includes nested OrderItems
     to show a complete picture of the order.
@@ -124,10 +192,236 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     buyer = serializers.StringRelatedField(read_only=True)
 
+    expandable_fields = {'items': (OrderItemSerializer, {'many': True})}
+    query_map = {'buyer': ['buyer__email']}
+
     class Meta:
         model = Order
         fields = ['order_id', 'buyer', 'status', 'total_price', 'items', 'created_at']
 
+class OrderStatusSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=STATUS_CHOICES)
+
+class BulkOrderStatusSerializer(OrderStatusSerializer):
+    """Many orders moved to one status by their seller."""
+    order_ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=MAX_BULK_STATUS_ORDERS)
+
+
+# ===================================================================
+# Fast read serializers for hot list endpoints
+# ===================================================================
+# The ModelSerializers above remain the write (and detail) path. These
+# render the same JSON straight from .values() rows, which skips model
+# instantiation, per-field introspection and the per-row queries behind
+# StringRelatedField / nested serializers.
+
+TWO_PLACES = Decimal('0.01')
+
+
+def _decimal(value):
+    return None if value is None else '{:f}'.format(Decimal(value).quantize(TWO_PLACES))
+
+
+class RowContext:
+    """Lookups shared by every row of one response, resolved once instead of per value."""
+
+    def __init__(self, request):
+        self.request = request
+        self.timezone = timezone.get_current_timezone()
+        # FileSystemStorage URLs are just MEDIA_URL + the quoted name
+        self.media_prefix = None
+        if isinstance(default_storage, FileSystemStorage):
+            base = default_storage.base_url
+            self.media_prefix = request.build_absolute_uri(base) if request else base
+
+    def datetime(self, value):
+        if value is None:
+            return None
+        value = value.astimezone(self.timezone).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+    def media_url(self, name):
+        if not name:
+            return None
+        if self.media_prefix is not None:
+            return self.media_prefix + filepath_to_uri(name).lstrip('/')
+        url = default_storage.url(name)
+        return self.request.build_absolute_uri(url) if self.request else url
+
+
+def _column(column, convert=None):
+    """Row field spec reading one column, optionally converted."""
+    if convert is None:
+        return ((column,), lambda row, ctx, prefix: row[prefix + column])
+    return ((column,), lambda row, ctx, prefix: convert(row[prefix + column]))
+
+
+def select_row_fields(spec, selection, expandable=()):
+    selection.validate(spec, expandable)
+    return {name: field for name, field in spec.items() if selection.includes(name)}
+
+
+def row_columns(fields, prefix=''):
+    return list(dict.fromkeys(prefix + column for columns, _ in fields.values() for column in columns))
+
+
+def render_row(fields, row, ctx, prefix=''):
+    return {name: render(row, ctx, prefix) for name, (_, render) in fields.items()}
+
+
+class ValuesRowSerializer:
+    """
+    Read-only, many=True serializer over a queryset's .values() rows.
+    `row_fields` maps each output field to (columns it needs, render function);
+    ?fields= / ?expand= decide which of them are fetched and rendered.
+    """
+    row_fields = {}
+    # Fields that can be embedded with ?expand= instead of rendered as primary keys
+    expandable_fields = ()
+
+    def __init__(self, queryset, context=None, selection=None):
+        self.queryset = queryset
+        self.context = context or {}
+        self.row_context = RowContext(self.context.get('request'))
+        self.selection = selection or FieldSelection.from_request(self.context.get('request'))
+        self.fields = select_row_fields(self.row_fields, self.selection, self.expandable_fields)
+
+    def get_rows(self):
+        return list(self.queryset.values(*row_columns(self.fields)))
+
+    def to_representation(self, row):
+        return render_row(self.fields, row, self.row_context)
+
+    @property
+    def data(self):
+        return [self.to_representation(row) for row in self.get_rows()]
+
+
+def _image_variants(row, ctx, prefix):
+    return image_variants_from_manifest(row[prefix + 'image_derivatives'], url_for=ctx.media_url)
+
+
+def _image_srcset(row, ctx, prefix):
+    variants = _image_variants(row, ctx, prefix)
+    return {'webp': srcset(variants, 'webp'), 'jpg': srcset(variants, 'jpg')}
+
+
+# Same output as ProductSerializer
+PRODUCT_ROW_FIELDS = {
+    'id': _column('id', str),
+    'name': _column('name'),
+    'slug': _column('slug'),
+    'description': _column('description'),
+    'price': _column('price', _decimal),
+    'stock_quantity': _column('stock_quantity'),
+    'image': (('image',), lambda row, ctx, prefix: ctx.media_url(row[prefix + 'image'])),
+    'image_variants': (('image_derivatives',), _image_variants),
+    'image_srcset': (('image_derivatives',), _image_srcset),
+    'seller': _column('seller__email'),
+    'category': _column('category__name'),
+    'audience': _column('audience__name'),
+    'size': _column('size__name'),
+    'created_at': (('created_at',), lambda row, ctx, prefix: ctx.datetime(row[prefix + 'created_at'])),
+    'updated_at': (('updated_at',), lambda row, ctx, prefix: ctx.datetime(row[prefix + 'updated_at'])),
+}
+
+
+class ProductRowSerializer(ValuesRowSerializer):
+    row_fields = PRODUCT_ROW_FIELDS
+
+
+class MysteryBoxRowSerializer(ValuesRowSerializer):
+    """Boxes plus their items in at most two queries."""
+    expandable_fields = ('items',)
+    row_fields = {
+        'id': _column('id', str),
+        'name': _column('name'),
+        'description': _column('description'),
+        'price': _column('price', _decimal),
+        'items': (('id',), lambda row, ctx, prefix: row['items']),
+        'seller_email': _column('seller__email'),
+        'is_active': _column('is_active'),
+        'created_at': (('created_at',), lambda row, ctx, prefix: ctx.datetime(row['created_at'])),
+    }
+
+    def get_rows(self):
+        rows = super().get_rows()
+        if 'items' not in self.fields:
+            return rows
+
+        box_ids = [row['id'] for row in rows]
+        items = {}
+        if self.selection.is_expanded('items'):
+            product_fields = select_row_fields(PRODUCT_ROW_FIELDS, self.selection.nested('items'))
+            item_rows = Product.objects.filter(contained_in_box__in=box_ids).values(
+                'contained_in_box', *row_columns(product_fields)
+            )
+            for item in item_rows:
+                items.setdefault(item['contained_in_box'], []).append(render_row(product_fields, item, self.row_context))
+        else:
+            # Collapsed to primary keys: only the M2M join table is read
+            links = MysteryBox.items.through.objects.filter(mysterybox_id__in=box_ids).values_list('mysterybox_id', 'product_id')
+            for box_id, product_id in links:
+                items.setdefault(box_id, []).append(str(product_id))
+        for row in rows:
+            row['items'] = items.get(row['id'], [])
+        return rows
+
+
+ORDER_ITEM_ROW_FIELDS = {
+    'product': (('product_id',), lambda row, ctx, prefix: row['product']),
+    'quantity': _column('quantity'),
+    'price': _column('price', _decimal),
+    'subtotal': (('quantity', 'price'), lambda row, ctx, prefix: _decimal(row['quantity'] * row['price'])),
+}
+
+
+class OrderRowSerializer(ValuesRowSerializer):
+    """Orders plus their line items (and products) in at most two queries."""
+    expandable_fields = ('items',)
+    row_fields = {
+        'order_id': _column('order_id', str),
+        'buyer': _column('buyer__email'),
+        'status': _column('status'),
+        'total_price': _column('total_price', _decimal),
+        'items': (('order_id',), lambda row, ctx, prefix: row['items']),
+        'created_at': (('created_at',), lambda row, ctx, prefix: ctx.datetime(row['created_at'])),
+    }
+
+    def get_rows(self):
+        rows = super().get_rows()
+        if 'items' not in self.fields:
+            return rows
+
+        order_ids = [row['order_id'] for row in rows]
+        items = {}
+        if not self.selection.is_expanded('items'):
+            # Collapsed to primary keys
+            for order_id, item_id in OrderItem.objects.filter(order_id__in=order_ids).values_list('order_id', 'id'):
+                items.setdefault(order_id, []).append(item_id)
+        else:
+            item_selection = self.selection.nested('items')
+            item_fields = select_row_fields(ORDER_ITEM_ROW_FIELDS, item_selection, ('product',))
+            product_fields = None
+            if 'product' in item_fields and item_selection.is_expanded('product'):
+                product_fields = select_row_fields(PRODUCT_ROW_FIELDS, item_selection.nested('product'))
+
+            columns = ['order_id'] + row_columns(item_fields)
+            if product_fields is not None:
+                columns += row_columns(product_fields, prefix='product__')
+            for item in OrderItem.objects.filter(order_id__in=order_ids).values(*columns):
+                if 'product' in item_fields:
+                    if item['product_id'] is None:
+                        item['product'] = None
+                    elif product_fields is None:
+                        item['product'] = str(item['product_id'])
+                    else:
+                        item['product'] = render_row(product_fields, item, self.row_context, prefix='product__')
+                items.setdefault(item['order_id'], []).append(render_row(item_fields, item, self.row_context))
+        for row in rows:
+            row['items'] = items.get(row['order_id'], [])
+        return rows
+
 
 # ===================================================================
 # Offer, Discount, and Review Serializers
@@ -143,10 +437,12 @@ class OrderSerializer(serializers.ModelSerializer):
 #         model = Discount
 #         fields = '__all__'
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     buyer = serializers.StringRelatedField(read_only=True)
     product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
 
+    query_map = {'buyer': ['buyer__email']}
+
     class Meta:
         model = Review
         fields = ['id', 'buyer', 'product', 'rating', 'comment', 'created_at']
@@ -165,10 +461,12 @@ class ReviewSerializer(serializers.ModelSerializer):
 
         return data
 
-class RateTraderSerializer(serializers.ModelSerializer):
+class RateTraderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     buyer = serializers.StringRelatedField(read_only=True)
     seller = serializers.PrimaryKeyRelatedField(queryset=AppUser.objects.filter(user_type='Seller'))
 
+    query_map = {'buyer': ['buyer__email']}
+
     class Meta:
         model = RateTrader
         fields = ['id', 'buyer', 'seller', 'rating', 'comment', 'created_at']
@@ -182,17 +480,3 @@ class RateTraderSerializer(serializers.ModelSerializer):
         if request.user == data['seller']:
             raise serializers.ValidationError("You cannot rate yourself.")
         return data
-    
-
-# api/serializers.py
-class MpesaSTKPushInitiateSerializer(serializers.Serializer):
-    phone_number = serializers.CharField(max_length=12)
-    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=1)
-    reference = serializers.CharField(max_length=100, required=False)
-    description = serializers.CharField(max_length=255, required=False)
-
-    def validate_phone_number(self, value):
-        # Ensure it starts with 254
-        if not value.startswith('254') or len(value) != 12:
-            raise serializers.ValidationError("Use format 2547XXXXXXXX")
-        return value
@@ -0,0 +1,71 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from authentication.models import AppUser
+from product.models import Audience, Category, MysteryBox, Product, Size
+from reviews.models import RateTrader
+from .authentication import invalidate_token, invalidate_user_tokens
+from .cache_utils import bump_generation
+from .search_utils import index_product, remove_product_from_index
+
+
+@receiver(post_save, sender=Product)
+def update_product_search_index(sender, instance, using, **kwargs):
+    """Keep the keyword search index in step with every product save."""
+    index_product(instance, using=using)
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_search_index(sender, instance, using, **kwargs):
+    remove_product_from_index(instance, using=using)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Audience)
+@receiver([post_save, post_delete], sender=Size)
+def invalidate_product_responses(sender, **kwargs):
+    # Category/audience/size names are rendered inside product responses
+    bump_generation('product')
+
+
+@receiver([post_save, post_delete], sender=MysteryBox)
+@receiver(m2m_changed, sender=MysteryBox.items.through)
+def invalidate_mystery_box_responses(sender, **kwargs):
+    bump_generation('mysterybox')
+
+
+@receiver(m2m_changed, sender=MysteryBox.items.through)
+def touch_mystery_boxes(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """Changing a box's items doesn't save the box; touch it so its ETag moves on."""
+    if not reverse:
+        box_ids = [instance.pk] if action in ('post_add', 'post_remove', 'post_clear') else None
+    elif action in ('post_add', 'post_remove'):
+        box_ids = pk_set
+    elif action == 'pre_clear':
+        # Afterwards there's no telling which boxes the product was in
+        box_ids = list(instance.contained_in_box.values_list('pk', flat=True))
+    else:
+        box_ids = None
+    if box_ids:
+        MysteryBox.objects.using(using).filter(pk__in=box_ids).update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=RateTrader)
+def invalidate_rate_trader_responses(sender, **kwargs):
+    bump_generation('ratetrader')
+
+
+@receiver([post_save, post_delete], sender=Token)
+def invalidate_token_snapshot(sender, instance, **kwargs):
+    # Logout and token regeneration
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=AppUser)
+def invalidate_user_token_snapshots(sender, instance, created, **kwargs):
+    # Password changes, deactivation and role changes all alter the cached snapshot
+    if not created:
+        invalidate_user_tokens(instance.pk)
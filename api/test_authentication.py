@@ -0,0 +1,126 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from authentication.models import AppUser
+from . import authentication
+from .authentication import CachedTokenAuthentication, _slide, get_token_snapshot, invalidate_user_tokens, token_expired
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        authentication._local.clear()
+        self.user = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = CachedTokenAuthentication()
+
+    def authenticate(self):
+        return self.auth.authenticate_credentials(self.token.key)
+
+    def set_created(self, created):
+        Token.objects.filter(pk=self.token.pk).update(created=created)
+        authentication.invalidate_token(self.token.key)
+
+    def test_repeat_requests_make_no_queries(self):
+        with self.assertNumQueries(1):
+            self.authenticate()
+        with self.assertNumQueries(0):
+            user, token = self.authenticate()
+        self.assertEqual((user.pk, user.email, token.key), (self.user.pk, 'buyer@example.com', self.token.key))
+        self.assertIn('password', user.get_deferred_fields())
+
+        # Another process: nothing in its LRU, but the shared cache answers
+        authentication._local.clear()
+        with self.assertNumQueries(0):
+            self.authenticate()
+
+    def test_unknown_token(self):
+        with self.assertRaisesMessage(AuthenticationFailed, 'Invalid token.'):
+            self.auth.authenticate_credentials('0' * 40)
+
+    def test_deactivation_invalidates(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaisesMessage(AuthenticationFailed, 'User inactive or deleted.'):
+            self.authenticate()
+
+    def test_queryset_update_needs_explicit_invalidation(self):
+        self.authenticate()
+        AppUser.objects.filter(pk=self.user.pk).update(user_type='Seller')
+        self.assertEqual(self.authenticate()[0].user_type, 'Buyer')
+        invalidate_user_tokens(self.user.pk)
+        self.assertEqual(self.authenticate()[0].user_type, 'Seller')
+
+    def test_deleting_token_invalidates(self):
+        key = self.token.key
+        self.authenticate()
+        self.token.delete()
+        with self.assertRaisesMessage(AuthenticationFailed, 'Invalid token.'):
+            self.auth.authenticate_credentials(key)
+
+    def test_regenerated_token_replaces_old_one(self):
+        key = self.token.key
+        self.authenticate()
+        self.token.delete()
+        new_token = Token.objects.create(user=self.user)
+        self.assertEqual(self.auth.authenticate_credentials(new_token.key)[0].pk, self.user.pk)
+        self.assertIsNone(get_token_snapshot(key))
+
+    @override_settings(AUTH_TOKEN_EXPIRY=0)
+    def test_no_expiry_by_default(self):
+        self.set_created(timezone.now() - timedelta(days=365))
+        self.assertEqual(self.authenticate()[0].pk, self.user.pk)
+
+    @override_settings(AUTH_TOKEN_EXPIRY=3600)
+    def test_expiry_boundary(self):
+        now = timezone.now()
+        self.assertFalse(token_expired(now - timedelta(seconds=3600), now))
+        self.assertTrue(token_expired(now - timedelta(seconds=3600, microseconds=1), now))
+
+        self.set_created(now - timedelta(seconds=3590))
+        self.authenticate()
+        self.set_created(now - timedelta(seconds=3601))
+        with self.assertRaisesMessage(AuthenticationFailed, 'Token has expired.'):
+            self.authenticate()
+
+    @override_settings(AUTH_TOKEN_EXPIRY=3600, AUTH_TOKEN_SLIDE_INTERVAL=600)
+    def test_slide_boundary(self):
+        now = timezone.now()
+        created = now - timedelta(seconds=600)
+        self.set_created(created)
+        snapshot = get_token_snapshot(self.token.key)
+
+        just_inside = created + timedelta(microseconds=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(_slide(self.token.key, {**snapshot, 'created': just_inside}, now)['created'], just_inside)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(_slide(self.token.key, snapshot, now)['created'], now)
+        self.assertEqual(Token.objects.get(pk=self.token.pk).created, now)
+        self.assertEqual(get_token_snapshot(self.token.key)['created'], now)
+
+    @override_settings(AUTH_TOKEN_EXPIRY=3600, AUTH_TOKEN_SLIDE_INTERVAL=600)
+    def test_slide_keeps_active_token_alive(self):
+        self.set_created(timezone.now() - timedelta(seconds=3000))
+        self.authenticate()
+        created = Token.objects.get(pk=self.token.pk).created
+        self.assertGreater(created, timezone.now() - timedelta(seconds=5))
+        # Slid recently: no UPDATE on the next request
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate()[1].created, created)
+
+    @override_settings(AUTH_TOKEN_EXPIRY=3600, AUTH_TOKEN_SLIDE_INTERVAL=600)
+    def test_concurrent_slide_loses_gracefully(self):
+        self.set_created(timezone.now() - timedelta(seconds=1000))
+        stale = get_token_snapshot(self.token.key)
+        # Another worker slid it in the meantime
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now())
+        _slide(self.token.key, stale, timezone.now())
+        self.assertIsNone(authentication._local.get(self.token.key))
+        self.assertEqual(get_token_snapshot(self.token.key)['created'], Token.objects.get(pk=self.token.pk).created)
@@ -0,0 +1,179 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from authentication.models import AppUser
+from product.models import MysteryBox, Product
+from .cache_utils import GENERATION_KEY, acquire_lock, get_generations, release_lock
+from .renderers import ORJSONRenderer
+from .views import ProductViewSet
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.dress = Product.objects.create(seller=self.seller, name='Dress', slug='dress', price=Decimal('45.50'))
+        self.box = MysteryBox.objects.create(seller=self.seller, price=Decimal('90.00'))
+        self.box.items.set([self.jacket, self.dress])
+        self.api = APIClient()
+        self.product_url = f'/api/products/{self.jacket.pk}/'
+        self.box_url = f'/api/mystery-boxes/{self.box.pk}/'
+
+    def test_validators_on_retrieve_and_list(self):
+        for url in (self.product_url, '/api/products/', self.box_url, '/api/mystery-boxes/'):
+            response = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['ETag'].startswith('"'))
+            # Only a single product's updated_at covers everything it shows
+            self.assertEqual('Last-Modified' in response, url == self.product_url)
+            self.assertIn('Accept', response['Vary'])
+            self.assertIn('public', response['Cache-Control'])
+
+    def test_if_none_match(self):
+        etag = self.api.get(self.product_url)['ETag']
+        response = self.api.get(self.product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.content)
+
+        self.assertEqual(self.api.get(self.product_url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.api.get(self.product_url)['Last-Modified']
+        self.assertEqual(self.api.get(self.product_url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        Product.objects.filter(pk=self.jacket.pk).update(updated_at=timezone.now() + timedelta(seconds=5))
+        self.assertEqual(self.api.get(self.product_url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_delete_is_seen_by_list_validators(self):
+        since = self.api.get(self.product_url)['Last-Modified']
+        etags = {url: self.api.get(url)['ETag'] for url in ('/api/products/', '/api/mystery-boxes/')}
+        self.dress.delete()
+        for url, etag in etags.items():
+            with self.subTest(url=url):
+                self.assertEqual(self.api.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+                self.assertEqual(self.api.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+
+    def test_edit_changes_etag(self):
+        etag = self.api.get(self.product_url)['ETag']
+        self.jacket.name = 'Denim jacket'
+        self.jacket.save()
+        response = self.api.get(self.product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['name'], 'Denim jacket')
+
+    def test_etag_depends_on_representation(self):
+        json_etag = self.api.get(self.product_url, HTTP_ACCEPT='application/json')['ETag']
+        self.assertEqual(self.api.get(self.product_url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=json_etag).status_code, 304)
+        browsable = self.api.get(self.product_url, HTTP_ACCEPT='text/html')
+        self.assertNotEqual(browsable['ETag'], json_etag)
+
+    def test_unknown_product_is_404(self):
+        self.assertEqual(self.api.get('/api/products/00000000-0000-0000-0000-000000000000/').status_code, 404)
+
+    def test_box_membership_changes_etag(self):
+        for change in (
+            lambda: self.box.items.remove(self.dress),
+            lambda: self.box.items.add(self.dress),
+            lambda: self.dress.contained_in_box.remove(self.box),
+            lambda: self.box.items.clear(),
+        ):
+            before = self.api.get(self.box_url)
+            change()
+            after = self.api.get(self.box_url, HTTP_IF_NONE_MATCH=before['ETag'])
+            self.assertEqual(after.status_code, 200)
+            self.assertNotEqual(after['ETag'], before['ETag'])
+            self.assertEqual(len(after.json()['items']), self.box.items.count())
+
+    def test_box_item_swap_changes_etag(self):
+        # Same item count and the same newest item timestamp: only the box itself can tell
+        hat = Product.objects.create(seller=self.seller, name='Hat', slug='hat', price=Decimal('10.00'))
+        Product.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        MysteryBox.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        before = self.api.get(self.box_url)
+        self.box.items.set([self.jacket, hat])
+        after = self.api.get(self.box_url, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual({item['name'] for item in after.json()['items']}, {'Jacket', 'Hat'})
+
+    def test_box_item_edit_changes_list_etag(self):
+        etag = self.api.get('/api/mystery-boxes/')['ETag']
+        self.jacket.price = Decimal('80.00')
+        self.jacket.save()
+        self.assertEqual(self.api.get('/api/mystery-boxes/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.api = APIClient()
+        self.url = f'/api/products/{self.jacket.pk}/'
+
+    def rename_quietly(self, name):
+        # A bare UPDATE: no signal, so no generation bump and the same updated_at
+        Product.objects.filter(pk=self.jacket.pk).update(name=name)
+
+    def cache_key(self):
+        request = Request(APIRequestFactory().get(self.url))
+        request.accepted_renderer = ORJSONRenderer()
+        view = ProductViewSet(basename='product', action='retrieve')
+        return view._response_cache_key(request, get_generations('product'))
+
+    def test_anonymous_get_is_served_from_cache(self):
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Jacket')
+        self.rename_quietly('Renamed')
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Jacket')
+        self.assertIsNotNone(cache.get(self.cache_key()))
+
+    def test_write_bumps_generation(self):
+        self.api.get(self.url)
+        generation = cache.get(GENERATION_KEY.format('product'))
+        key = self.cache_key()
+
+        self.jacket.name = 'Denim jacket'
+        self.jacket.save()
+        self.assertNotEqual(cache.get(GENERATION_KEY.format('product')), generation)
+        self.assertNotEqual(self.cache_key(), key)
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Denim jacket')
+
+    def test_authenticated_requests_bypass_cache(self):
+        self.api.get(self.url)
+        self.rename_quietly('Renamed')
+        self.api.force_authenticate(self.seller)
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Renamed')
+
+        # ...and don't fill it either
+        cache.clear()
+        self.api.get(self.url)
+        self.assertIsNone(cache.get(self.cache_key()))
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_stale_entry_served_while_lock_held(self):
+        self.api.get(self.url)
+        self.rename_quietly('Renamed')
+        lock_key = f"{self.cache_key()}:lock"
+
+        token = acquire_lock(lock_key, 10)
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Jacket')
+        release_lock(lock_key, token)
+
+        # Unlocked, the expired entry is refreshed
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Renamed')
+        self.assertIsNone(cache.get(lock_key))
+
+    @override_settings(RESPONSE_CACHE_LOCK_WAIT=0)
+    def test_cold_miss_with_lock_held_still_answers(self):
+        lock_key = f"{self.cache_key()}:lock"
+        token = acquire_lock(lock_key, 10)
+        self.assertEqual(self.api.get(self.url).json()['name'], 'Jacket')
+        self.assertEqual(cache.get(lock_key), token)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from .cache_utils import acquire_lock
+from .coalesce_utils import COALESCED_CALLS, coalesce, content_key
+
+WORKERS = 5
+
+
+class BlockingCall:
+    """compute() stand-in that holds every caller until release() and counts the calls."""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def release(self):
+        self.released.set()
+
+
+def run_in_threads(count, function):
+    """Starts `count` threads calling function(); returns (threads, outcomes) to join on."""
+    outcomes = [None] * count
+
+    def run(index):
+        try:
+            outcomes[index] = ('result', function())
+        except Exception as e:
+            outcomes[index] = ('error', e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(5)
+
+
+@override_settings(SINGLE_FLIGHT_WAIT=5)
+class CoalesceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        COALESCED_CALLS.reset()
+
+    def test_followers_share_the_leaders_result(self):
+        call = BlockingCall(result=['a', 'b'])
+        leader, leader_outcome = run_in_threads(1, lambda: coalesce('test', 'same', call))
+        self.assertTrue(call.started.wait(5))
+        followers, outcomes = run_in_threads(WORKERS, lambda: coalesce('test', 'same', lambda: ['computed again']))
+        # Give the followers time to start waiting on the leader
+        time.sleep(0.2)
+        call.release()
+        join(leader + followers)
+
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(leader_outcome + outcomes, [('result', ['a', 'b'])] * (WORKERS + 1))
+        self.assertEqual(COALESCED_CALLS.value(name='test', result='computed'), 1)
+        self.assertEqual(COALESCED_CALLS.value(name='test', result='local'), WORKERS)
+
+    def test_different_keys_run_separately(self):
+        first, second = BlockingCall(result=1), BlockingCall(result=2)
+        threads, outcomes = run_in_threads(1, lambda: coalesce('test', 'first', first))
+        more, more_outcomes = run_in_threads(1, lambda: coalesce('test', 'second', second))
+        self.assertTrue(first.started.wait(5) and second.started.wait(5))
+        first.release()
+        second.release()
+        join(threads + more)
+        self.assertEqual(outcomes + more_outcomes, [('result', 1), ('result', 2)])
+
+    def test_leader_exception_reaches_local_waiters(self):
+        error = RuntimeError("CLIP is down")
+        call = BlockingCall(error=error)
+        leader, leader_outcome = run_in_threads(1, lambda: coalesce('test', 'failing', call))
+        self.assertTrue(call.started.wait(5))
+        followers, outcomes = run_in_threads(WORKERS, lambda: coalesce('test', 'failing', lambda: 'computed again'))
+        time.sleep(0.2)
+        call.release()
+        join(leader + followers)
+
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(leader_outcome + outcomes, [('error', error)] * (WORKERS + 1))
+        # Nothing is cached from a failure: the next call computes afresh
+        self.assertEqual(coalesce('test', 'failing', lambda: 'recovered'), 'recovered')
+
+    @override_settings(SINGLE_FLIGHT_WAIT=0.1)
+    def test_local_waiter_falls_back_after_timeout(self):
+        call = BlockingCall(result='slow')
+        leader, leader_outcome = run_in_threads(1, lambda: coalesce('test', 'slow', call))
+        self.assertTrue(call.started.wait(5))
+        self.assertEqual(coalesce('test', 'slow', lambda: 'own'), 'own')
+        self.assertEqual(COALESCED_CALLS.value(name='test', result='fallback'), 1)
+        call.release()
+        join(leader)
+        self.assertEqual(leader_outcome, [('result', 'slow')])
+
+    @override_settings(SINGLE_FLIGHT_WAIT=0.1)
+    def test_shared_lock_holder_times_out(self):
+        # Another process holds the lock and never publishes a result
+        acquire_lock(f"singleflight:test:{content_key('stuck')}:lock", 60)
+        start = time.monotonic()
+        self.assertEqual(coalesce('test', content_key('stuck'), lambda: 'own'), 'own')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(COALESCED_CALLS.value(name='test', result='fallback'), 1)
+
+    def test_result_published_by_another_process_is_reused(self):
+        cache.set('singleflight:test:published', {'ids': [1]})
+        self.assertEqual(coalesce('test', 'published', lambda: self.fail("should not compute")), {'ids': [1]})
+        self.assertEqual(COALESCED_CALLS.value(name='test', result='shared'), 1)
+
+    def test_sequential_calls_reuse_result_within_ttl(self):
+        calls = []
+        for _ in range(3):
+            self.assertEqual(coalesce('test', 'repeat', lambda: calls.append(1) or len(calls)), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_content_key(self):
+        self.assertEqual(content_key(b'image', 'text'), content_key('image', b'text'))
+        self.assertNotEqual(content_key('ab', 'c'), content_key('a', 'bc'))
@@ -0,0 +1,115 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from authentication.models import AppUser
+from orders.models import Order, OrderItem
+from product.models import MysteryBox, Product
+from .fieldset_utils import optimize_queryset
+from .serializers import MysteryBoxRowSerializer, MysteryBoxSerializer, OrderRowSerializer, ProductSerializer
+
+
+def request(params):
+    return Request(APIRequestFactory().get('/api/', params))
+
+
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', description='Denim', price=Decimal('100.00'))
+        self.dress = Product.objects.create(seller=self.seller, name='Dress', slug='dress', price=Decimal('45.50'))
+        self.box = MysteryBox.objects.create(seller=self.seller, price=Decimal('90.00'))
+        self.box.items.set([self.jacket, self.dress])
+        order = Order.objects.create(buyer=self.buyer, total_price=Decimal('100.00'))
+        OrderItem.objects.create(order=order, product=self.jacket, quantity=1, price=Decimal('100.00'), seller=self.seller, ordered_at=timezone.now())
+        self.api = APIClient()
+
+    def get(self, url, **params):
+        return self.api.get(url, params)
+
+    def test_fields_narrow_list_and_detail(self):
+        rows = self.get('/api/products/', fields='id,name,price').json()
+        self.assertEqual([set(row) for row in rows], [{'id', 'name', 'price'}] * 2)
+        detail = self.get(f'/api/products/{self.jacket.pk}/', fields='name,seller').json()
+        self.assertEqual(detail, {'name': 'Jacket', 'seller': 'seller@example.com'})
+
+    def test_relations_collapse_to_primary_keys(self):
+        expected_items = {str(self.jacket.pk), str(self.dress.pk)}
+        for url in ('/api/mystery-boxes/', f'/api/mystery-boxes/{self.box.pk}/'):
+            with self.subTest(url=url):
+                body = self.get(url, fields='id,items').json()
+                box = body[0] if isinstance(body, list) else body
+                self.assertEqual(set(box), {'id', 'items'})
+                self.assertEqual(set(box['items']), expected_items)
+
+    def test_sub_fields_and_expand(self):
+        box = self.get(f'/api/mystery-boxes/{self.box.pk}/', fields='id,items.name').json()
+        self.assertEqual(sorted(box['items'], key=lambda item: item['name']), [{'name': 'Dress'}, {'name': 'Jacket'}])
+
+        box = self.get('/api/mystery-boxes/', fields='id,items', expand='items').json()[0]
+        self.assertIn('description', box['items'][0])
+
+        self.api.force_authenticate(self.buyer)
+        order = self.get('/api/orders/', fields='total_price,items.quantity,items.product.name').json()[0]
+        self.assertEqual(order, {'total_price': '100.00', 'items': [{'quantity': 1, 'product': {'name': 'Jacket'}}]})
+
+    def test_without_parameters_everything_is_embedded(self):
+        box = self.get(f'/api/mystery-boxes/{self.box.pk}/').json()
+        self.assertEqual({item['name'] for item in box['items']}, {'Jacket', 'Dress'})
+        self.assertIn('seller_email', box)
+
+    def test_unknown_fields_are_rejected(self):
+        cases = [
+            ('/api/products/', {'fields': 'id,colour'}, 'fields', "Unknown field 'colour'."),
+            (f'/api/products/{self.jacket.pk}/', {'fields': 'colour'}, 'fields', "Unknown field 'colour'."),
+            ('/api/products/', {'fields': 'name.first'}, 'fields', "Unknown field 'name'."),
+            ('/api/products/', {'expand': 'name'}, 'expand', "'name' can't be expanded."),
+            ('/api/mystery-boxes/', {'fields': 'id,items.colour'}, 'fields', "Unknown field 'items.colour'."),
+            (f'/api/mystery-boxes/{self.box.pk}/', {'fields': 'id,items.colour'}, 'fields', "Unknown field 'items.colour'."),
+            ('/api/mystery-boxes/', {'expand': 'items.seller'}, 'expand', "'items.seller' can't be expanded."),
+        ]
+        for url, params, parameter, message in cases:
+            with self.subTest(url=url, params=params):
+                response = self.api.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()[parameter], [message])
+
+    def test_row_serializer_queries(self):
+        boxes = MysteryBox.objects.all()
+        with self.assertNumQueries(1):
+            MysteryBoxRowSerializer(boxes, context={'request': request({'fields': 'id,name'})}).data
+        # Collapsed items read only the join table; expanded ones the products
+        for params in ({'fields': 'id,items'}, {'fields': 'id,items.name'}):
+            with self.assertNumQueries(2), CaptureQueriesContext(connection) as queries:
+                MysteryBoxRowSerializer(boxes, context={'request': request(params)}).data
+            self.assertNotIn('description', queries[0]['sql'])
+            self.assertEqual('product_product' in queries[1]['sql'], 'items.name' in params['fields'])
+
+        with self.assertNumQueries(2), CaptureQueriesContext(connection) as queries:
+            OrderRowSerializer(Order.objects.all(), context={'request': request({'fields': 'order_id,items.product.name'})}).data
+        self.assertNotIn('total_price', queries[0]['sql'])
+        self.assertNotIn('"product_product"."price"', queries[1]['sql'])
+
+    def test_model_serializer_loads_only_selected_columns(self):
+        context = {'request': request({'fields': 'id,name,seller'})}
+        serializer = ProductSerializer(context=context)
+        with self.assertNumQueries(1), CaptureQueriesContext(connection) as queries:
+            ProductSerializer(optimize_queryset(Product.objects.all(), serializer), many=True, context=context).data
+        sql = queries[0]['sql']
+        self.assertIn('"authentication_appuser"."email"', sql)
+        self.assertNotIn('description', sql)
+
+        context = {'request': request({'fields': 'id,items.name'})}
+        serializer = MysteryBoxSerializer(context=context)
+        with self.assertNumQueries(2), CaptureQueriesContext(connection) as queries:
+            data = MysteryBoxSerializer(optimize_queryset(MysteryBox.objects.all(), serializer), many=True, context=context).data
+        self.assertEqual(len(data[0]['items']), 2)
+        self.assertNotIn('"product_product"."description"', queries[1]['sql'])
@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from authentication.models import AppUser
+from product.models import Product
+from .cache_utils import get_generations
+from .image_utils import build_derivatives, generate_product_derivatives
+
+
+def jpeg(width, height, orientation=None):
+    buffer = BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    Image.new('RGB', (width, height), 'navy').save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+
+    def store(self, name, content):
+        return default_storage.save(name, SimpleUploadedFile(name, content))
+
+    def test_sizes_and_formats(self):
+        manifest = build_derivatives(self.store('products/jacket.jpg', jpeg(2000, 1000)))
+        self.assertEqual(
+            {size: (entry['width'], entry['height']) for size, entry in manifest.items()},
+            {'thumb': (160, 80), 'card': (480, 240), 'detail': (1080, 540)},
+        )
+        self.assertEqual(manifest['thumb']['webp'], 'products/jacket__thumb.webp')
+        for entry in manifest.values():
+            for extension, image_format in (('webp', 'WEBP'), ('jpg', 'JPEG')):
+                with default_storage.open(entry[extension]) as stored:
+                    image = Image.open(stored)
+                    self.assertEqual(image.format, image_format)
+                    self.assertEqual(image.size, (entry['width'], entry['height']))
+
+    def test_small_images_are_not_upscaled(self):
+        manifest = build_derivatives(self.store('products/sock.jpg', jpeg(100, 50)))
+        self.assertTrue(all((entry['width'], entry['height']) == (100, 50) for entry in manifest.values()))
+
+    def test_exif_orientation_is_applied(self):
+        # Orientation 6: stored landscape, shown rotated a quarter turn
+        manifest = build_derivatives(self.store('products/phone.jpg', jpeg(800, 400, orientation=6)))
+        self.assertEqual((manifest['card']['width'], manifest['card']['height']), (240, 480))
+
+    def test_generate_records_manifest_and_bumps_generation(self):
+        product = Product.objects.create(
+            seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'),
+            image=SimpleUploadedFile('jacket.jpg', jpeg(1200, 900)),
+        )
+        updated_at = Product.objects.get(pk=product.pk).updated_at
+        generation, = get_generations('product')
+
+        manifest = generate_product_derivatives(product.pk)
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives, manifest)
+        self.assertEqual(set(manifest), {'thumb', 'card', 'detail'})
+        self.assertGreater(product.updated_at, updated_at)
+        self.assertNotEqual(get_generations('product'), [generation])
+
+    def test_generate_skips_products_without_image(self):
+        product = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.assertIsNone(generate_product_derivatives(product.pk))
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives, {})
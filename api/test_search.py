@@ -0,0 +1,70 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authentication.models import AppUser
+from product.models import Product
+from .search_utils import rank_candidates, search_products
+
+
+def names(queryset):
+    return [product.name for product in queryset]
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.jacket = self.product('Denim jacket', 'Blue jacket with brass buttons')
+        self.shirt = self.product('Cotton shirt', 'Goes well with a denim jacket')
+        self.dress = self.product('Summer dress', 'Floral print')
+
+    def product(self, name, description=''):
+        return Product.objects.create(
+            seller=self.seller, name=name, slug=name.lower().replace(' ', '-'),
+            description=description, price=Decimal('10.00'),
+        )
+
+    def search(self, query, recency=False):
+        return names(search_products(Product.objects.all(), query, recency=recency))
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('denim jacket'), ['Denim jacket', 'Cotton shirt'])
+        self.assertEqual(self.search('jacket'), ['Denim jacket', 'Cotton shirt'])
+
+    def test_prefix_match(self):
+        self.assertEqual(self.search('flor'), ['Summer dress'])
+
+    def test_save_reindexes(self):
+        self.dress.name = 'Summer jacket'
+        self.dress.save()
+        self.assertIn('Summer jacket', self.search('jacket'))
+        self.assertEqual(self.search('dress'), [])
+
+    def test_delete_removes_from_index(self):
+        self.jacket.delete()
+        self.assertEqual(self.search('jacket'), ['Cotton shirt'])
+        self.assertEqual(self.search('brass'), [])
+
+    def test_empty_or_odd_queries_return_nothing(self):
+        for query in ('', '   ', None, '"', '*', 'AND OR NOT', '"denim" NEAR(', '%_\'--', 'zzzz'):
+            with self.subTest(query=query):
+                self.assertEqual(self.search(query), [])
+
+    def test_recency_boost(self):
+        now = timezone.now()
+        older = (1, 1.0, now - timedelta(days=60))
+        newer = (2, 0.9, now)
+        self.assertEqual(rank_candidates([older, newer], now=now), [1, 2])
+        self.assertEqual(rank_candidates([older, newer], recency=True, now=now), [2, 1])
+
+    def test_list_endpoint(self):
+        api = APIClient()
+        response = api.get('/api/products/', {'search': 'denim jacket'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product['name'] for product in response.json()], ['Denim jacket', 'Cotton shirt'])
+        self.assertEqual(api.get('/api/products/', {'search': '"'}).json(), [])
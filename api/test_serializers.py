@@ -0,0 +1,90 @@
+import json
+from decimal import Decimal
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from authentication.models import AppUser
+from orders.models import Order, OrderItem
+from product.models import Audience, Category, MysteryBox, Product, Size
+from .renderers import ORJSONRenderer
+from .serializers import (
+    MysteryBoxRowSerializer, MysteryBoxSerializer, OrderRowSerializer, OrderSerializer,
+    ProductRowSerializer, ProductSerializer,
+)
+
+# Each query string must render identically through both serializers
+PRODUCT_SELECTIONS = [{}, {'fields': 'id,name,price'}, {'fields': 'image,image_variants,seller,category'}]
+BOX_SELECTIONS = [{}, {'fields': 'id,name,price'}, {'fields': 'id,items'}, {'expand': 'items'}, {'fields': 'id,items.name,items.price'}]
+ORDER_SELECTIONS = [
+    {}, {'fields': 'order_id,total_price,items'}, {'expand': 'items'},
+    {'fields': 'order_id,items.price,items.product.name'}, {'expand': 'items,items.product'},
+]
+
+
+def rendered(data):
+    # Compared as the client sees them: a UUID and its string render the same
+    return json.loads(ORJSONRenderer().render(data))
+
+
+class RowSerializerParityTests(TestCase):
+    """The .values() row serializers must render exactly what the ModelSerializers do."""
+
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(
+            seller=seller, name='Jacket', slug='jacket', description='Denim', price=Decimal('1250.5'),
+            stock_quantity=3, category=Category.objects.create(name='Outerwear'),
+            audience=Audience.objects.create(name='Women'), size=Size.objects.create(name='M'),
+            image=SimpleUploadedFile('jacket.jpg', b'not really a jpeg'),
+            image_derivatives={
+                'thumb': {'width': 160, 'height': 120, 'webp': 'products/jacket__thumb.webp', 'jpg': 'products/jacket__thumb.jpg'},
+                'card': {'width': 480, 'height': 360, 'webp': 'products/jacket__card.webp', 'jpg': 'products/jacket__card.jpg'},
+            },
+        )
+        self.addCleanup(self.jacket.image.delete, save=False)
+        self.sock = Product.objects.create(seller=seller, name='Sock', slug='sock', price=Decimal('50.00'))
+        box = MysteryBox.objects.create(seller=seller, price=Decimal('300.00'))
+        box.items.set([self.jacket])
+        MysteryBox.objects.create(seller=seller, name='Empty box', price=Decimal('10.00'), is_active=False)
+
+        order = Order.objects.create(buyer=buyer, total_price=Decimal('1600.50'), status='paid')
+        OrderItem.objects.create(order=order, product=self.jacket, quantity=1, price=Decimal('1250.50'), seller=seller, ordered_at=timezone.now())
+        OrderItem.objects.create(order=order, mystery_box=box, quantity=1, price=Decimal('300.00'), seller=seller, ordered_at=timezone.now())
+        OrderItem.objects.create(order=order, product=self.sock, quantity=1, price=Decimal('50.00'), seller=seller, ordered_at=timezone.now())
+        Order.objects.create(buyer=buyer, total_price=Decimal('0.00'))
+
+    def request(self, params):
+        return Request(APIRequestFactory().get('/api/', params))
+
+    def assertParity(self, model_serializer, row_serializer, queryset, selections):
+        for params in selections + [{'fields': 'name,does_not_exist'}, {'expand': 'seller'}]:
+            with self.subTest(params=params):
+                context = {'request': self.request(params)}
+                try:
+                    expected = rendered(model_serializer(queryset, many=True, context=context).data)
+                except ValidationError as error:
+                    # ...and reject the same unknown names
+                    with self.assertRaises(ValidationError) as row_error:
+                        row_serializer(queryset, context=context).data
+                    self.assertEqual(row_error.exception.detail, error.detail)
+                    continue
+                self.assertEqual(rendered(row_serializer(queryset, context=context).data), expected)
+
+    def test_product_rows(self):
+        self.assertParity(ProductSerializer, ProductRowSerializer, Product.objects.order_by('name'), PRODUCT_SELECTIONS)
+
+    def test_mystery_box_rows(self):
+        self.assertParity(MysteryBoxSerializer, MysteryBoxRowSerializer, MysteryBox.objects.order_by('name'), BOX_SELECTIONS)
+
+    def test_order_rows(self):
+        self.assertParity(OrderSerializer, OrderRowSerializer, Order.objects.order_by('total_price'), ORDER_SELECTIONS)
+
+    def test_without_request(self):
+        queryset = Product.objects.order_by('name')
+        self.assertEqual(rendered(ProductRowSerializer(queryset).data), rendered(ProductSerializer(queryset, many=True).data))
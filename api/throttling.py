@@ -0,0 +1,129 @@
+"""
+Per-user, per-endpoint rate limits for the expensive endpoints (LLM chat,
+CLIP image search, product uploads that call Groq vision, STK pushes).
+
+A view opts in with a scope, and `DEFAULT_THROTTLE_RATES` gives the budget
+for the scope, optionally per user type ('chat:Seller' before 'chat',
+'image_search:anon' for anonymous clients). A scope without a rate is not
+limited. Counting is a sliding window over two fixed-window counters in the
+shared cache: usually a single incr per decision, as the previous window's
+count is final and kept in process memory.
+
+    class ChatAssistantView(RateLimitHeadersMixin, APIView):
+        throttle_classes = [UserTypeScopedThrottle]
+        throttle_scope = 'chat'
+"""
+import math
+
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from mitumbaesales.metrics import counter
+from .cache_utils import LocalLRU
+
+# Counts of windows that have ended no longer change, so each process keeps them
+_finished_windows = LocalLRU(maxsize=10000, timeout=3600)
+
+THROTTLE_DECISIONS = counter('api_throttle_total', "Rate-limit decisions by scope and result (allowed, throttled).", ['scope', 'result'])
+
+
+class UserTypeScopedThrottle(SimpleRateThrottle):
+    """
+    Scope comes from `view.throttle_scopes[view.action]` (viewsets) or
+    `view.throttle_scope`. Authenticated users are counted per user,
+    anonymous clients per IP address.
+    """
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+
+    def __init__(self):
+        # The rate depends on the scope and user, known only in allow_request
+        pass
+
+    def get_scope(self, view):
+        scopes = getattr(view, 'throttle_scopes', None)
+        if scopes is not None:
+            return scopes.get(getattr(view, 'action', None))
+        return getattr(view, 'throttle_scope', None)
+
+    def get_user_type(self, request):
+        if request.user and request.user.is_authenticated:
+            return getattr(request.user, 'user_type', None) or 'user'
+        return 'anon'
+
+    def get_rate_for(self, scope, user_type):
+        # Read on every call (not SimpleRateThrottle's import-time copy) so setting overrides apply
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        return rates.get(f'{scope}:{user_type}', rates.get(scope))
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{self.get_ident(request)}'
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        self.scope = self.get_scope(view)
+        if not self.scope:
+            return True
+        self.rate = self.get_rate_for(self.scope, self.get_user_type(request))
+        if self.rate is None:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.key = self.get_cache_key(request, view)
+
+        now = self.timer()
+        window = int(now // self.duration)
+        elapsed = now - window * self.duration
+        current_key, previous_key = f'{self.key}:{window}', f'{self.key}:{window - 1}'
+        previous = _finished_windows.get(previous_key)
+        if previous is None:
+            previous = self.cache.get(previous_key, 0)
+            _finished_windows.set(previous_key, previous)
+        try:
+            current = self.cache.incr(current_key)
+        except ValueError:
+            # First request of this window; the counter outlives it to serve as the next one's `previous`
+            current = 1 if self.cache.add(current_key, 1, timeout=2 * self.duration) else self.cache.incr(current_key)
+
+        # The previous window's count, weighted by how much of it still overlaps the sliding window
+        weight = (self.duration - elapsed) / self.duration
+        used = previous * weight + current
+        allowed = used <= self.num_requests
+
+        if allowed:
+            self.wait_time = None
+        else:
+            # A refused request doesn't use up budget, so retrying clients get back in
+            self.cache.decr(current_key)
+            if current > self.num_requests:
+                self.wait_time = self.duration - elapsed
+            else:
+                # Wait until enough of the previous window has slid out
+                self.wait_time = (used - self.num_requests) / previous * self.duration
+        THROTTLE_DECISIONS.inc(scope=self.scope, result='allowed' if allowed else 'throttled')
+        self.record(request, remaining=max(0, math.floor(self.num_requests - used)), reset=self.duration - elapsed)
+        return allowed
+
+    def record(self, request, remaining, reset):
+        # Read back by RateLimitHeadersMixin; with several throttles the tightest one wins
+        status = getattr(request, 'rate_limit', None)
+        if status is None or remaining < status['remaining']:
+            request.rate_limit = {'limit': self.num_requests, 'remaining': remaining, 'reset': math.ceil(reset), 'scope': self.scope}
+
+    def wait(self):
+        return self.wait_time
+
+
+class RateLimitHeadersMixin:
+    """Reports the throttle's budget in X-RateLimit-* headers, on refusals (429) too."""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        status = getattr(request, 'rate_limit', None)
+        if status is not None:
+            response['X-RateLimit-Limit'] = str(status['limit'])
+            response['X-RateLimit-Remaining'] = str(status['remaining'])
+            response['X-RateLimit-Reset'] = str(status['reset'])
+            response['X-RateLimit-Scope'] = status['scope']
+        return response
@@ -1,5 +1,6 @@
 from django.urls import path,include
 from rest_framework.routers import DefaultRouter
+from payments.views import InitiateSTKPushView, mpesa_callback
 from .views import (
     ProductViewSet,
     OrderViewSet,
@@ -10,11 +11,10 @@ from .views import (
     RateTraderViewSet,  
     CartViewSet,  
     CartItemViewSet, 
+    GuestCartView,
     AppUserViewSet,
     MysteryBoxViewSet,
     ChatAssistantView,
-    InitiateSTKPushView,
-    mpesa_callback,
     ChatAssistantView,  
 )
 
@@ -31,6 +31,7 @@ router.register(r'mystery-boxes', MysteryBoxViewSet)
 urlpatterns=[
     path('', include(router.urls)),
     path('chat/', ChatAssistantView.as_view(), name='chat_assistant'),
+    path('guest-cart/', GuestCartView.as_view(), name='guest_cart'),
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
@@ -1,31 +1,44 @@
 import chromadb
 from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
 import os
+from mitumbaesales.middleware import external_call
+from mitumbaesales.tracing import traced
 
 # This creates a 'vector_db' folder in your project to store the fingerprints
 client = chromadb.PersistentClient(path="./vector_db")
 
+class TimedOpenCLIPEmbeddingFunction(OpenCLIPEmbeddingFunction):
+    """Reports CLIP inference separately from the Chroma call that triggers it."""
+
+    def __call__(self, input):
+        with traced('clip.embed', {'clip.inputs': len(input)}), external_call('clip'):
+            return super().__call__(input)
+
 # We use a standard embedding function that understands images
 # This might download a small model the first time you run it
-embedding_function = OpenCLIPEmbeddingFunction()
+embedding_function = TimedOpenCLIPEmbeddingFunction()
 
 collection = client.get_or_create_collection(
     name="product_images",
     embedding_function=embedding_function
 )
 
+@traced('chroma.add')
 def add_product_to_vector_db(product_id, image_path, metadata):
     """Stores the image fingerprint in ChromaDB"""
-    collection.add(
-        ids=[str(product_id)],
-        uris=[image_path],
-        metadatas=[metadata]
-    )
+    with external_call('chroma'):
+        collection.add(
+            ids=[str(product_id)],
+            uris=[image_path],
+            metadatas=[metadata]
+        )
 
+@traced('chroma.query')
 def search_similar_products(image_path, n_results=5):
     """Finds the most similar images in the database"""
-    results = collection.query(
-        query_uris=[image_path],
-        n_results=n_results
-    )
+    with external_call('chroma'):
+        results = collection.query(
+            query_uris=[image_path],
+            n_results=n_results
+        )
     return results
\ No newline at end of file
@@ -1,9 +1,10 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.db.models import Sum
+from django.db.models import Sum, Max, Count
+from django.core.exceptions import ValidationError
 from product.models import Product
-from orders.models import Order, OrderItem, STATUS_CHOICES
+from orders.models import Order, OrderItem
 from rest_framework import viewsets, generics, permissions, status, serializers
 from rest_framework.permissions import IsAuthenticated
 from reviews.models import Review, RateTrader
@@ -15,10 +16,26 @@ from .chat_utils import shopping_agent
 from .ai_utils import ai_brain
 from product.models import Category, Audience, Product, Size, MysteryBox
 from django.shortcuts import get_object_or_404
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.conf import settings
 from .vector_utils import add_product_to_vector_db, search_similar_products
-from payments.mpesa_api import MpesaAPIClient
-from payments.models import MpesaSTKPush
-from .serializers import MpesaSTKPushInitiateSerializer
+from .search_utils import search_products
+from .throttling import RateLimitHeadersMixin, UserTypeScopedThrottle
+from .authentication import token_expired
+from .coalesce_utils import coalesce, content_key
+from .cache_utils import ConditionalGetMixin, CachedResponseMixin
+from .fieldset_utils import SparseFieldsViewMixin, optimize_queryset
+from .order_utils import page_size, seller_order_page, transition_orders
+from .export_utils import EXPORT_FORMATS, export_rows, stream_export
+from .checkout_utils import (
+    CHECKOUT_SCOPE, CheckoutError, DuplicateRequest, find_idempotent_result, place_order, request_fingerprint,
+)
+from .cart_utils import (
+    apply_cart_operations, get_or_create_cart, merge_guest_cart,
+    read_guest_cart, write_guest_cart, apply_guest_operations, guest_cart_summary,
+)
+from .image_utils import schedule_product_derivatives
 from .serializers import (
     OrderSerializer,
     ProductSerializer,
@@ -26,8 +43,15 @@ from .serializers import (
     RateTraderSerializer,
     CartSerializer,
     CartItemSerializer,
+    CartBatchSerializer,
+    OrderStatusSerializer,
+    BulkOrderStatusSerializer,
+    GuestCartSerializer,
     AppUserSerializer,
     MysteryBoxSerializer,
+    ProductRowSerializer,
+    MysteryBoxRowSerializer,
+    OrderRowSerializer,
 )
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -35,18 +59,18 @@ from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from datetime import datetime
 import logging
+import os
+import tempfile
 
-from payments.mpesa_api import MpesaAPIClient
-from payments.models import MpesaSTKPush
-from .serializers import MpesaSTKPushInitiateSerializer
 from .permissions import IsSellerOrReadOnly, IsOwnerOrAdmin
 
+logger = logging.getLogger(__name__)
 
 # ===================================================================
 # Authentication Views
 # ===================================================================
 
-class AppUserViewSet(viewsets.ModelViewSet):
+class AppUserViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = AppUser.objects.all()
     serializer_class = AppUserSerializer
     # Only admins should be able to list/manage all users
@@ -69,13 +93,20 @@ class LoginView(APIView):
 
         if user:
             token, created = Token.objects.get_or_create(user=user)
-            return Response({
+            if token_expired(token.created):
+                token.delete()
+                token = Token.objects.create(user=user)
+            response = Response({
                 'token': token.key,
                 'user_id': user.pk,
                 'username': user.username,
                 'email': user.email,
                 'user_type': user.user_type # user_type is now directly on the user model
             }, status=status.HTTP_200_OK)
+            # Anything put in the cart before signing in moves to the user's cart
+            if merge_guest_cart(request, user):
+                write_guest_cart(response, {})
+            return response
         else:
             return Response({'error': 'Invalid Credentials'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -88,8 +119,7 @@ class RegisterView(APIView):
         serializer = AppUserSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.save()
-            # Automatically create a cart for the new user
-            Cart.objects.create(user=user)
+            # The cart is created on first use (see get_or_create_cart)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -110,8 +140,22 @@ class LogoutView(APIView):
 # Core E-commerce Views
 # ===================================================================
 
-class OrderViewSet(viewsets.ModelViewSet):
+class RowListMixin:
+    """
+    Serves `list` through a .values()-based row serializer. The regular
+    serializer_class is still used for retrieve and all writes.
+    """
+    row_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.row_serializer_class(queryset, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+
+class OrderViewSet(SparseFieldsViewMixin, RowListMixin, viewsets.ModelViewSet):
     serializer_class = OrderSerializer
+    row_serializer_class = OrderRowSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
@@ -124,69 +168,201 @@ class OrderViewSet(viewsets.ModelViewSet):
             # Correctly filter by the buyer field on the Order model
             return Order.objects.filter(buyer=user).order_by('-created_at')
         elif user.user_type == 'Seller':
-            # Find orders that have items where the product's seller is the current user
-            return Order.objects.filter(items__product__seller=user).distinct().order_by('-created_at')
+            # Orders with a line sold by this user, via the denormalized OrderItem.seller
+            return Order.objects.filter(pk__in=OrderItem.objects.filter(seller=user).values('order_id')).order_by('-created_at')
         return Order.objects.none() # Return nothing if user type is not set
 
+    def list(self, request, *args, **kwargs):
+        """
+        Sellers get their feed a page at a time (?limit=, default 50); the
+        next page's URL is in the Link header so the body stays a plain list.
+        """
+        if request.user.user_type != 'Seller':
+            return super().list(request, *args, **kwargs)
+
+        order_ids, next_cursor = seller_order_page(
+            request.user, request.query_params.get('cursor'), page_size(request.query_params.get('limit')),
+        )
+        queryset = self.filter_queryset(Order.objects.filter(pk__in=order_ids).order_by('-created_at', '-order_id'))
+        response = Response(self.row_serializer_class(queryset, context=self.get_serializer_context()).data)
+        if next_cursor:
+            query = request.query_params.copy()
+            query['cursor'] = next_cursor
+            response['Link'] = f'<{request.build_absolute_uri(request.path)}?{query.urlencode()}>; rel="next"'
+        return response
+
     def create(self, request, *args, **kwargs):
-        """Create an order from the user's cart."""
+        """
+        Create an order from the user's cart. Clients should send an
+        Idempotency-Key header (e.g. a UUID per checkout attempt): retries
+        with the same key return the original order instead of a new one.
+        """
         user = request.user
-        cart = get_object_or_404(Cart, user=user)
-        cart_items = cart.items.all()
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and not 0 < len(key) <= 255:
+            return Response({"error": "Idempotency-Key must be 1-255 characters."}, status=status.HTTP_400_BAD_REQUEST)
+        request_hash = request_fingerprint(request)
 
-        if not cart_items.exists():
-            return Response({"error": "Your cart is empty."}, status=status.HTTP_400_BAD_REQUEST)
+        if key:
+            record = find_idempotent_result(user, CHECKOUT_SCOPE, key)
+            if record is not None:
+                return self._replay(record, request_hash)
 
-        # Create the order
-        order = Order.objects.create(buyer=user, total_price=cart.total_price)
+        guest_cart_merged = merge_guest_cart(request, user)
 
-        # Create order items from cart items
-        order_items_to_create = []
-        for cart_item in cart_items:
-            order_items_to_create.append(
-                OrderItem(order=order, product=cart_item.product, quantity=cart_item.quantity, price=cart_item.product.price)
-            )
-        OrderItem.objects.bulk_create(order_items_to_create)
-
-        # Clear the cart
-        cart_items.delete()
+        def render(order):
+            order = optimize_queryset(Order.objects.filter(pk=order.pk), self.get_serializer()).get()
+            return self.get_serializer(order).data
 
-        # Serialize the newly created order and return it
-        serializer = self.get_serializer(order)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        try:
+            order, body = place_order(user, render, idempotency_key=key, request_hash=request_hash)
+        except CheckoutError as e:
+            response = Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except DuplicateRequest:
+            # A concurrent request with this key finished first
+            response = self._replay(find_idempotent_result(user, CHECKOUT_SCOPE, key), request_hash)
+        else:
+            response = Response(body, status=status.HTTP_201_CREATED)
+
+        if guest_cart_merged:
+            # The cookie's lines are in the database cart now, whatever became of the checkout;
+            # keeping the cookie would merge them a second time
+            write_guest_cart(response, {})
+        return response
+
+    def _replay(self, record, request_hash):
+        if record.request_hash != request_hash:
+            return Response(
+                {"error": "This Idempotency-Key was already used for a different request."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        return Response(record.response_body, status=record.response_status, headers={'Idempotent-Replayed': 'true'})
 
     def perform_create(self, serializer):
         # This method is now bypassed by the custom create method above.
         # We leave it empty or pass, as it's not used for creating orders from carts.
         pass
 
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Streams every order line the user sold (sellers) or bought (buyers)
+        as ?export_format=csv (default) or jsonl, optionally limited to
+        ?since= / ?until= dates (YYYY-MM-DD). `format` is left alone
+        because DRF uses it for content negotiation.
+        """
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return Response({"error": f"export_format must be one of: {', '.join(EXPORT_FORMATS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        dates = {}
+        for name in ('since', 'until'):
+            value = request.query_params.get(name)
+            if value:
+                try:
+                    dates[name] = parse_date(value)
+                except ValueError:
+                    dates[name] = None
+                if dates[name] is None:
+                    return Response({"error": f"{name} must be a date (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            stream_export(export_format, export_rows(request.user, **dates)),
+            content_type=EXPORT_FORMATS[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+        return response
+
     @action(detail=True, methods=['patch'], permission_classes=[IsAuthenticated])
     def update_status(self, request, pk=None):
         """Allows a seller to update the status of an order."""
         order = self.get_object()
-        new_status = request.data.get('status')
-        if new_status and new_status in dict(STATUS_CHOICES).keys():
-            # Check if the user is a seller for at least one item in the order
-            if not order.items.filter(product__seller=request.user).exists():
-                return Response({"detail": "You are not the seller for any item in this order."}, status=status.HTTP_403_FORBIDDEN)
+        serializer = OrderStatusSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"detail": "Invalid status or status not provided."}, status=status.HTTP_400_BAD_REQUEST)
+
+        outcome = transition_orders(request.user, [order.pk], serializer.validated_data['status'])[order.pk]
+        if outcome['result'] == 'forbidden':
+            return Response({"detail": "You are not the seller for any item in this order."}, status=status.HTTP_403_FORBIDDEN)
+        if outcome['result'] == 'invalid_transition':
+            return Response(
+                {"detail": f"An order that is {outcome['status']} can't be moved to {serializer.validated_data['status']}."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        order.refresh_from_db()
+        return Response(self.get_serializer(order).data, status=status.HTTP_200_OK)
 
-            order.status = new_status
-            order.save()
-            serializer = self.get_serializer(order)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response({"detail": "Invalid status or status not provided."}, status=status.HTTP_400_BAD_REQUEST)
+    @action(detail=False, methods=['post'])
+    def bulk_status(self, request):
+        """
+        Moves many orders to one status: {"order_ids": [...], "status": "processed"}.
+        Each order gets its own result, so one bad ID doesn't fail the rest.
+        """
+        if request.user.user_type != 'Seller':
+            return Response({"detail": "Only sellers can update order status."}, status=status.HTTP_403_FORBIDDEN)
+        serializer = BulkOrderStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
+        outcomes = transition_orders(request.user, serializer.validated_data['order_ids'], serializer.validated_data['status'])
+        results = [{'order_id': order_id, **outcome} for order_id, outcome in outcomes.items()]
+        return Response({
+            'updated': sum(result['result'] == 'updated' for result in results),
+            'results': results,
+        }, status=status.HTTP_200_OK)
 
-class ProductViewSet(viewsets.ModelViewSet):
+
+class ProductViewSet(RateLimitHeadersMixin, ConditionalGetMixin, CachedResponseMixin, SparseFieldsViewMixin, RowListMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all().order_by('-created_at')
     serializer_class = ProductSerializer
+    row_serializer_class = ProductRowSerializer
     permission_classes = [IsSellerOrReadOnly]
+    # Uploads run Groq vision on the image; image search runs CLIP
+    throttle_classes = [UserTypeScopedThrottle]
+    throttle_scopes = {'create': 'product_upload', 'search_by_image': 'image_search'}
+    cache_models = ('product',)
+    cache_control = {
+        'list': {'public': True, 'max_age': 30},
+        'retrieve': {'public': True, 'max_age': 60},
+    }
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Row count + newest updated_at is enough to tell if a product list
+        changed. Both go in the ETag only: a delete doesn't move the newest
+        updated_at, so a list's Last-Modified would let If-Modified-Since
+        answer 304 after one.
+        """
+        if self.action == 'list':
+            stats = self.filter_queryset(self.get_queryset()).order_by().aggregate(
+                count=Count('pk'), last_modified=Max('updated_at')
+            )
+            return (stats['count'], stats['last_modified']), None
+        try:
+            updated_at = Product.objects.filter(pk=kwargs.get('pk')).values_list('updated_at', flat=True).first()
+        except (ValueError, ValidationError):
+            return None
+        # Unknown product: let retrieve() produce the 404
+        return (kwargs.get('pk'), updated_at) if updated_at else None
+
+    def get_queryset(self):
+        """
+        Supports keyword search on the list endpoint:
+        ?search=denim jacket ranks by relevance, &recency=true favours newer listings.
+        """
+        queryset = super().get_queryset()
+        query = self.request.query_params.get('search')
+        if self.action == 'list' and query:
+            recency = self.request.query_params.get('recency', '').lower() in ('1', 'true', 'yes')
+            queryset = search_products(queryset, query, recency=recency)
+        return queryset
 
     def perform_create(self, serializer):
         # 1. Initial save to store image
         product = serializer.save(seller=self.request.user)
         
         if product.image:
+            # Thumbnails/WebP copies are rendered off the request thread
+            schedule_product_derivatives(product)
+
             try:
                 # 2. AI Analysis (Description, Name, Category, Size)
                 ai_data = ai_brain.analyze_product_image(product.image.path)
@@ -257,12 +433,17 @@ class ProductViewSet(viewsets.ModelViewSet):
                             # # Link the first 3 items to this box
                             new_box.items.set(loose_thrift_items[:3])
                             new_box.save()
-                            print(f"DEBUG: Mystery Box created at discounted price: {bundle_price} KES")
+                            logger.info(f"Mystery Box created at discounted price: {bundle_price} KES")
 
-                    print(f"DEBUG: {product.name} processed successfully.")
+                    logger.debug(f"{product.name} processed successfully.")
                     
             except Exception as e:
-                print(f"DEBUG Error in Product Creation Flow -> {e}")
+                logger.exception(f"Error in product creation flow: {e}")
+
+    def perform_update(self, serializer):
+        product = serializer.save()
+        if 'image' in serializer.validated_data and product.image:
+            schedule_product_derivatives(product)
 
     @action(detail=False, methods=['post'], url_path='search-by-image')
     def search_by_image(self, request):
@@ -270,14 +451,18 @@ class ProductViewSet(viewsets.ModelViewSet):
         if not image_file:
             return Response({"error": "No image provided"}, status=400)
 
-        temp_path = "temp_search.jpg"
-        with open(temp_path, 'wb+') as destination:
-            for chunk in image_file.chunks():
-                destination.write(chunk)
+        image = image_file.read()
+
+        def run_search():
+            # A file per request: concurrent searches must not overwrite each other's image
+            with tempfile.NamedTemporaryFile(suffix=os.path.splitext(image_file.name)[1] or '.jpg') as temp:
+                temp.write(image)
+                temp.flush()
+                return search_similar_products(temp.name)['ids'][0]
 
         try:
-            results = search_similar_products(temp_path)
-            product_ids = results['ids'][0]
+            # Identical images searched at the same moment (a viral product) share one CLIP query
+            product_ids = coalesce('image_search', content_key(image), run_search)
             products = Product.objects.filter(id__in=product_ids)
             serializer = self.get_serializer(products, many=True)
             return Response(serializer.data)
@@ -295,7 +480,7 @@ class ProductViewSet(viewsets.ModelViewSet):
 #     queryset = Discount.objects.all()
 #     serializer_class = DiscountSerializer
 
-class ReviewViewSet(viewsets.ModelViewSet):
+class ReviewViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = Review.objects.all()
     serializer_class = ReviewSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -304,16 +489,17 @@ class ReviewViewSet(viewsets.ModelViewSet):
         # Set the buyer to the currently authenticated user
         serializer.save(buyer=self.request.user)
 
-class RateTraderViewSet(viewsets.ModelViewSet):
+class RateTraderViewSet(CachedResponseMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = RateTrader.objects.all()
     serializer_class = RateTraderSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    cache_models = ('ratetrader',)
 
     def perform_create(self, serializer):
         # Set the buyer to the currently authenticated user
         serializer.save(buyer=self.request.user)
 
-class CartViewSet(viewsets.ModelViewSet):
+class CartViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]
 
@@ -321,7 +507,23 @@ class CartViewSet(viewsets.ModelViewSet):
         """A user can only see their own cart."""
         return Cart.objects.filter(user=self.request.user)
 
-class CartItemViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Applies many add/update/remove operations in one transaction and
+        returns the updated cart, e.g.
+        {"operations": [{"op": "add", "product_id": "...", "quantity": 2},
+                        {"op": "remove", "mystery_box_id": "..."}]}
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart = get_or_create_cart(request.user)
+        apply_cart_operations(cart, serializer.validated_data['operations'])
+
+        cart = optimize_queryset(self.get_queryset(), self.get_serializer()).get()
+        return Response(self.get_serializer(cart).data)
+
+class CartItemViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     serializer_class = CartItemSerializer
     permission_classes = [IsAuthenticated]
 
@@ -331,58 +533,78 @@ class CartItemViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         """Add an item to the user's cart."""
-        cart = get_object_or_404(Cart, user=self.request.user)
+        cart = get_or_create_cart(self.request.user)
         serializer.save(cart=cart)
 
-class MysteryBoxViewSet(viewsets.ReadOnlyModelViewSet):
+
+class GuestCartView(APIView):
     """
-    A simple ViewSet for viewing mystery boxes. 
-    We use ReadOnly because boxes are created automatically by AI.
+    Cart for visitors who haven't signed in, kept in a signed cookie so it
+    costs no database writes. It is merged into the user's cart on login
+    or checkout. POST takes the same operations as /carts/batch/.
     """
-    queryset = MysteryBox.objects.filter(is_active=True).order_by('-created_at')
-    serializer_class = MysteryBoxSerializer
+    permission_classes = [permissions.AllowAny]
 
+    def _respond(self, request, lines):
+        serializer = GuestCartSerializer(guest_cart_summary(lines), context={'request': request})
+        response = Response(serializer.data)
+        if lines or settings.GUEST_CART_COOKIE_NAME in request.COOKIES:
+            write_guest_cart(response, lines)
+        return response
 
+    def get(self, request):
+        return self._respond(request, read_guest_cart(request))
 
-mpesa_client = MpesaAPIClient()
+    def post(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lines = apply_guest_operations(read_guest_cart(request), serializer.validated_data['operations'])
+        return self._respond(request, lines)
 
-class InitiateSTKPushView(APIView):
-    permission_classes = [permissions.IsAuthenticated]
+    def delete(self, request):
+        return self._respond(request, {})
 
-    def post(self, request):
-        serializer = MpesaSTKPushInitiateSerializer(data=request.data)
-        if serializer.is_valid():
-            phone_number = serializer.validated_data['phone_number']
-            amount = serializer.validated_data['amount']
-            
+class MysteryBoxViewSet(ConditionalGetMixin, CachedResponseMixin, SparseFieldsViewMixin, RowListMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    A simple ViewSet for viewing mystery boxes. 
+    We use ReadOnly because boxes are created automatically by AI.
+    """
+    queryset = MysteryBox.objects.filter(is_active=True).order_by('-created_at')
+    serializer_class = MysteryBoxSerializer
+    row_serializer_class = MysteryBoxRowSerializer
+    # Boxes embed full product objects, so product edits invalidate them too
+    cache_models = ('mysterybox', 'product')
+    cache_control = {
+        'list': {'public': True, 'max_age': 60},
+        'retrieve': {'public': True, 'max_age': 120},
+    }
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Boxes embed their products, so an edited item also changes the box's
+        validators. They are sent as an ETag only, as for product lists:
+        deleting a product drops it from its boxes without moving any
+        updated_at.
+        """
+        queryset = self.get_queryset().order_by()
+        if self.action == 'retrieve':
             try:
-                # 1. Start the M-Pesa push
-                daraja_response = mpesa_client.initiate_stk_push(
-                    phone_number=phone_number,
-                    amount=amount,
-                    reference=f"User-{request.user.id}",
-                    description="Gikomba Purchase"
-                )
-
-                # 2. Record it in your MpesaSTKPush model
-                MpesaSTKPush.objects.create(
-                    user=request.user,
-                    phone_number=phone_number,
-                    amount=amount,
-                    checkout_request_id=daraja_response.get('CheckoutRequestID'),
-                    status='Pending'
-                )
-
-                return Response({"message": "Payment initiated!"})
-            except Exception as e:
-                return Response({"error": str(e)}, status=500)
-        return Response(serializer.errors, status=400)
+                queryset = queryset.filter(pk=kwargs.get('pk'))
+            except (ValueError, ValidationError):
+                return None
+        stats = queryset.aggregate(
+            count=Count('pk', distinct=True),
+            item_count=Count('items', distinct=True),
+            boxes_modified=Max('updated_at'),
+            items_modified=Max('items__updated_at'),
+        )
+        if self.action == 'retrieve' and not stats['count']:
+            return None
+        # Adding/removing items touches the box's updated_at (api.signals)
+        last_modified = max(filter(None, [stats['boxes_modified'], stats['items_modified']]), default=None)
+        return (stats['count'], stats['item_count'], last_modified), None
+
 
-@api_view(['POST'])
-@permission_classes([permissions.AllowAny])
-def mpesa_callback(request):
-    # (The callback logic we discussed previously)
-    return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
 
 class ChatAssistantView(APIView): # The new Chat view
     permission_classes = [permissions.IsAuthenticated]
@@ -394,13 +616,19 @@ class ChatAssistantView(APIView): # The new Chat view
 
 
 
-class ChatAssistantView(APIView):
+class ChatAssistantView(RateLimitHeadersMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [UserTypeScopedThrottle]
+    throttle_scope = 'chat'
 
     def post(self, request):
         user_message = request.data.get('message')
         if not user_message:
             return Response({"error": "Sema kitu (Say something)!"}, status=400)
             
-        ai_response = shopping_agent.ask_agent(user_message, request.user.username)
+        # The same question asked by many people at once gets one Groq call
+        ai_response = coalesce(
+            'chat', content_key(user_message.strip()),
+            lambda: shopping_agent.ask_agent(user_message, request.user.username),
+        )
         return Response({"reply": ai_response})
\ No newline at end of file
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-19 14:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_totals(apps, schema_editor):
+    Cart = apps.get_model('cart', 'Cart')
+    CartItem = apps.get_model('cart', 'CartItem')
+    totals = CartItem.objects.values('cart').order_by().annotate(total=Sum('subtotal'), count=Sum('quantity'))
+    for row in totals:
+        Cart.objects.filter(pk=row['cart']).update(total_price=row['total'] or 0, item_count=row['count'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+        ('product', '0008_product_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='mystery_box',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='product.mysterybox'),
+        ),
+        migrations.AlterField(
+            model_name='cartitem',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='product.product'),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 import uuid
 from django.conf import settings
 from product.models import Product, MysteryBox # Import MysteryBox
@@ -9,16 +12,56 @@ class Cart(models.Model):
     user = models.OneToOneField(
         AppUser, on_delete=models.CASCADE, related_name='cart'
     )
+    # Running totals kept in step by CartItem.save()/delete() and checked by
+    # the verify_cart_totals command, so reading a cart never sums its items.
+    # Checkout charges exactly this; if a price has changed since a line was
+    # added it reprices the cart instead and asks the buyer to look again
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    @property
-    def total_price(self):
-        return sum(item.subtotal for item in self.items.all())
-
     def __str__(self):
         return f"Cart for {self.user.email}"
 
+    @classmethod
+    def adjust_totals(cls, cart_id, price_delta, count_delta):
+        """Applies a change to the running totals in the database, race-free."""
+        if not price_delta and not count_delta:
+            return
+        cls.objects.filter(pk=cart_id).update(
+            total_price=F('total_price') + price_delta,
+            item_count=F('item_count') + count_delta,
+            updated_at=timezone.now(),
+        )
+
+    def recalculate_totals(self):
+        """Resets the running totals from the items themselves (one UPDATE)."""
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        Cart.objects.filter(pk=self.pk).update(
+            total_price=Coalesce(Subquery(items.annotate(total=Sum('subtotal')).values('total')), Value(0), output_field=models.DecimalField()),
+            item_count=Coalesce(Subquery(items.annotate(count=Sum('quantity')).values('count')), Value(0)),
+            updated_at=timezone.now(),
+        )
+        self.refresh_from_db(fields=['total_price', 'item_count', 'updated_at'])
+
+    def reprice(self):
+        """Moves lines whose product or box price has changed to the current price. Returns lines changed."""
+        current = Coalesce(
+            Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')),
+            Subquery(MysteryBox.objects.filter(pk=OuterRef('mystery_box_id')).values('price')),
+        )
+        changed = self.items.exclude(unit_price=current).update(unit_price=current, subtotal=F('quantity') * current)
+        if changed:
+            self.recalculate_totals()
+        return changed
+
+    def clear(self):
+        """Empties the cart with one DELETE and one UPDATE."""
+        self.items.all().delete()
+        Cart.objects.filter(pk=self.pk).update(total_price=0, item_count=0, updated_at=timezone.now())
+        self.total_price, self.item_count = 0, 0
+
 class CartItem(models.Model):
     cart_item_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
@@ -32,16 +75,57 @@ class CartItem(models.Model):
     subtotal = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
     added_at = models.DateTimeField(auto_now_add=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What this row currently contributes to the cart totals
+        instance._stored = {
+            name: instance.__dict__.get(name) for name in ('product_id', 'mystery_box_id', 'quantity', 'subtotal')
+        }
+        return instance
+
+    def _current_price(self):
+        """Uses an already-loaded product/box, otherwise fetches just the price column."""
+        if self.product_id:
+            if CartItem.product.is_cached(self):
+                return self.product.price
+            return Product.objects.values_list('price', flat=True).get(pk=self.product_id)
+        if CartItem.mystery_box.is_cached(self):
+            return self.mystery_box.price
+        return MysteryBox.objects.values_list('price', flat=True).get(pk=self.mystery_box_id)
+
     def save(self, *args, **kwargs):
-        # Automatically set price based on which item type is present
-        if self.product:
-            self.unit_price = self.product.price
-        elif self.mystery_box:
-            self.unit_price = self.mystery_box.price
-            
+        stored = getattr(self, '_stored', None)
+        if stored is not None and None in (stored['quantity'], stored['subtotal']):
+            # Loaded with deferred fields; read the stored contribution once
+            stored = CartItem.objects.filter(pk=self.pk).values(
+                'product_id', 'mystery_box_id', 'quantity', 'subtotal'
+            ).first()
+
+        # Price is set when the item is added (or re-pointed at something else)
+        # and kept when only the quantity changes
+        if (
+            stored is None or self.unit_price is None
+            or (stored['product_id'], stored['mystery_box_id']) != (self.product_id, self.mystery_box_id)
+        ):
+            self.unit_price = self._current_price()
+
         self.subtotal = self.quantity * self.unit_price
         super().save(*args, **kwargs)
 
+        previous_quantity = stored['quantity'] if stored else 0
+        previous_subtotal = stored['subtotal'] if stored else 0
+        Cart.adjust_totals(self.cart_id, self.subtotal - previous_subtotal, self.quantity - previous_quantity)
+        self._stored = {
+            'product_id': self.product_id, 'mystery_box_id': self.mystery_box_id,
+            'quantity': self.quantity, 'subtotal': self.subtotal,
+        }
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Cart.adjust_totals(self.cart_id, -self.subtotal, -self.quantity)
+        return result
+
     def __str__(self):
         name = self.product.name if self.product else self.mystery_box.name
-        return f"{self.quantity} of {name}"
\ No newline at end of file
+        return f"{self.quantity} of {name}"
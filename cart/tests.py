@@ -1,3 +1,163 @@
-from django.test import TestCase
+import uuid
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from django.conf import settings
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from api.cart_utils import MAX_LINE_QUANTITY, apply_cart_operations, merge_guest_cart, read_guest_cart, write_guest_cart
+from authentication.models import AppUser
+from product.models import Product, MysteryBox
+from .models import Cart, CartItem
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.dress = Product.objects.create(seller=seller, name='Dress', slug='dress', price=Decimal('45.50'))
+        self.cart = Cart.objects.create(user=buyer)
+
+    def assertTotals(self, total_price, item_count):
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_price, Decimal(total_price))
+        self.assertEqual(self.cart.item_count, item_count)
+
+    def test_totals_follow_item_changes(self):
+        item = CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.dress, quantity=1)
+        self.assertTotals('245.50', 3)
+
+        item = CartItem.objects.get(pk=item.pk)
+        item.quantity = 1
+        item.save()
+        self.assertTotals('145.50', 2)
+
+        item.delete()
+        self.assertTotals('45.50', 1)
+
+    def test_quantity_change_keeps_unit_price(self):
+        item = CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=1)
+        Product.objects.filter(pk=self.jacket.pk).update(price=Decimal('120.00'))
+        item = CartItem.objects.get(pk=item.pk)
+        item.quantity = 2
+        item.save()
+        self.assertEqual(item.unit_price, Decimal('100.00'))
+        self.assertTotals('200.00', 2)
+
+    def test_clear(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        self.cart.clear()
+        self.assertFalse(self.cart.items.exists())
+        self.assertTotals('0', 0)
+
+    def test_verifier_repairs_drift(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        Cart.objects.filter(pk=self.cart.pk).update(total_price=Decimal('1.00'), item_count=7)
+        call_command('verify_cart_totals', '--settle=0', stdout=StringIO())
+        self.assertTotals('200.00', 2)
+
+
+class CartBatchTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.dress = Product.objects.create(seller=seller, name='Dress', slug='dress', price=Decimal('45.50'))
+        self.box = MysteryBox.objects.create(seller=seller, price=Decimal('60.00'))
+        self.cart = Cart.objects.create(user=buyer)
+
+    def test_operations_apply_in_order(self):
+        CartItem.objects.create(cart=self.cart, product=self.dress, quantity=1)
+        apply_cart_operations(self.cart, [
+            {'op': 'add', 'product_id': self.jacket.pk, 'quantity': 1},
+            {'op': 'add', 'product_id': self.jacket.pk, 'quantity': 2},
+            {'op': 'add', 'mystery_box_id': self.box.pk, 'quantity': 1},
+            {'op': 'remove', 'product_id': self.dress.pk, 'quantity': 1},
+        ])
+        quantities = {(item.product_id, item.mystery_box_id): item.quantity for item in self.cart.items.all()}
+        self.assertEqual(quantities, {(self.jacket.pk, None): 3, (None, self.box.pk): 1})
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_price, Decimal('360.00'))
+        self.assertEqual(self.cart.item_count, 4)
+
+    def test_unknown_product_rolls_back(self):
+        with self.assertRaises(ValidationError):
+            apply_cart_operations(self.cart, [
+                {'op': 'add', 'product_id': self.jacket.pk, 'quantity': 1},
+                {'op': 'add', 'product_id': self.cart.pk, 'quantity': 1},
+            ])
+        self.assertFalse(self.cart.items.exists())
+
+
+class GuestCartTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+
+    def request_with(self, lines):
+        response = HttpResponse()
+        write_guest_cart(response, lines)
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.GUEST_CART_COOKIE_NAME] = response.cookies[settings.GUEST_CART_COOKIE_NAME].value
+        return request
+
+    def test_cookie_round_trip(self):
+        lines = {('product', self.jacket.pk): 2}
+        self.assertEqual(read_guest_cart(self.request_with(lines)), lines)
+
+    def test_tampered_cookie_reads_empty(self):
+        request = self.request_with({('product', self.jacket.pk): 2})
+        request.COOKIES[settings.GUEST_CART_COOKIE_NAME] += 'x'
+        self.assertEqual(read_guest_cart(request), {})
+
+    def test_merge_adds_to_existing_cart(self):
+        cart = Cart.objects.create(user=self.buyer)
+        CartItem.objects.create(cart=cart, product=self.jacket, quantity=1)
+        request = self.request_with({('product', self.jacket.pk): 2, ('product', uuid.uuid4()): 1})
+        self.assertTrue(merge_guest_cart(request, self.buyer))
+        cart.refresh_from_db()
+        self.assertEqual(cart.item_count, 3)
+        self.assertEqual(cart.items.count(), 1)
+
+
+class CartQuantityLimitTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'))
+        self.api = APIClient()
+
+    def add(self, url, quantity):
+        return self.api.post(url, {'operations': [{'op': 'add', 'product_id': str(self.jacket.pk), 'quantity': quantity}]}, format='json')
+
+    def test_oversized_quantity_is_rejected(self):
+        self.api.force_authenticate(self.buyer)
+        for url in ('/api/carts/batch/', '/api/guest-cart/'):
+            with self.subTest(url=url):
+                self.assertEqual(self.add(url, 10 ** 12).status_code, 400)
+        response = self.api.post('/api/cart-items/', {'product_id': str(self.jacket.pk), 'quantity': 10 ** 12}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_adds_stop_at_the_line_limit(self):
+        self.api.force_authenticate(self.buyer)
+        self.assertEqual(self.add('/api/carts/batch/', MAX_LINE_QUANTITY).status_code, 200)
+        response = self.add('/api/carts/batch/', 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'operations': {'0': [f"A cart line holds at most {MAX_LINE_QUANTITY} units."]}})
+        self.assertEqual(CartItem.objects.get().quantity, MAX_LINE_QUANTITY)
+
+        # A guest cart merged on sign-in is capped rather than refused
+        self.api.force_authenticate(None)
+        self.add('/api/guest-cart/', 5)
+        request = RequestFactory().get('/')
+        request.COOKIES = {key: morsel.value for key, morsel in self.api.cookies.items()}
+        self.assertTrue(merge_guest_cart(request, self.buyer))
+        self.assertEqual(CartItem.objects.get().quantity, MAX_LINE_QUANTITY)
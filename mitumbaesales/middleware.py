@@ -0,0 +1,152 @@
+"""
+Per-request performance instrumentation. For every request the middleware
+records the route, total latency, the number of SQL queries and the time
+spent in them, and the time spent in external calls (Groq, CLIP, Chroma,
+Daraja) reported by code wrapped in `external_call`:
+
+    with external_call('groq'):
+        response = client.chat.completions.create(...)
+
+Everything is aggregated into histograms served at /metrics. Requests
+slower than SLOW_REQUEST_THRESHOLD seconds are logged with their full
+breakdown, SLOW_REQUEST_SAMPLE_RATE of them at most. Queries run while a
+streaming response is consumed happen after the middleware returns and are
+not counted.
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .metrics import histogram
+
+logger = logging.getLogger('mitumbaesales.performance')
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+REQUEST_SECONDS = histogram('http_request_seconds', "Total request latency.", ['route', 'method', 'status'])
+REQUEST_QUERIES = histogram('http_request_sql_queries', "SQL queries per request.", ['route'], buckets=QUERY_BUCKETS)
+REQUEST_SQL_SECONDS = histogram('http_request_sql_seconds', "Time per request spent in SQL queries.", ['route'])
+REQUEST_EXTERNAL_SECONDS = histogram(
+    'http_request_external_seconds', "Time per request spent in calls to an external service.", ['route', 'service'],
+)
+EXTERNAL_SECONDS = histogram(
+    'external_call_seconds',
+    "Latency of calls to external services (groq, clip, chroma, daraja), in requests and background jobs alike. "
+    "Time in a call nested in another (CLIP embedding inside a Chroma query) counts for the inner one only.",
+    ['service'],
+)
+
+# The breakdown of the request being handled, if any
+_breakdown = ContextVar('request_breakdown', default=None)
+# Time spent in external calls nested in the current one
+_nested = ContextVar('external_call_nested', default=None)
+
+
+class RequestBreakdown:
+    __slots__ = ('queries', 'sql', 'external')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql = 0.0
+        self.external = {}
+
+
+def _time_query(execute, sql, params, many, context):
+    breakdown = _breakdown.get()
+    if breakdown is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        breakdown.queries += 1
+        breakdown.sql += time.perf_counter() - start
+
+
+def install_query_timer(connection, **kwargs):
+    """
+    Keeps _time_query among the connection's execute wrappers for good, so
+    requests don't pay for installing it (connections are per thread).
+    """
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(install_query_timer)
+
+
+@contextmanager
+def external_call(service):
+    """Times the enclosed call to an external service and adds it to the current request's breakdown."""
+    token = _nested.set(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        own = elapsed - _nested.get()
+        _nested.reset(token)
+        enclosing = _nested.get()
+        if enclosing is not None:
+            _nested.set(enclosing + elapsed)
+        EXTERNAL_SECONDS.observe(own, service=service)
+        breakdown = _breakdown.get()
+        if breakdown is not None:
+            breakdown.external[service] = breakdown.external.get(service, 0.0) + own
+
+
+def route_name(request):
+    """
+    Low-cardinality label for the URL pattern a request matched: the view
+    name ('product-detail'), or the route if it has none. Unmatched paths
+    share one label so scanners can't blow up the number of series.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Connections opened before this module was loaded didn't get the timer
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(connection)
+
+    def __call__(self, request):
+        breakdown = RequestBreakdown()
+        token = _breakdown.set(breakdown)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            total = time.perf_counter() - start
+            _breakdown.reset(token)
+
+        route = route_name(request)
+        REQUEST_SECONDS.observe(total, route=route, method=request.method, status=response.status_code)
+        REQUEST_QUERIES.observe(breakdown.queries, route=route)
+        REQUEST_SQL_SECONDS.observe(breakdown.sql, route=route)
+        for service, seconds in breakdown.external.items():
+            REQUEST_EXTERNAL_SECONDS.observe(seconds, route=route, service=service)
+
+        if total >= settings.SLOW_REQUEST_THRESHOLD and random.random() < settings.SLOW_REQUEST_SAMPLE_RATE:
+            self.log_slow_request(request, response, route, total, breakdown)
+        return response
+
+    def log_slow_request(self, request, response, route, total, breakdown):
+        external = sum(breakdown.external.values())
+        parts = [f"{breakdown.queries} SQL queries {breakdown.sql * 1000:.0f} ms"]
+        parts += [f"{service} {seconds * 1000:.0f} ms" for service, seconds in sorted(breakdown.external.items())]
+        parts.append(f"other {(total - breakdown.sql - external) * 1000:.0f} ms")
+        logger.warning(
+            f"Slow request: {request.method} {request.path} ({route}) -> {response.status_code} "
+            f"in {total * 1000:.0f} ms: {', '.join(parts)}"
+        )
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 import dj_database_url
@@ -74,6 +75,8 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 
 MIDDLEWARE = [
+    'mitumbaesales.tracing.TracingMiddleware',
+    'mitumbaesales.middleware.PerformanceMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -191,16 +194,121 @@ AUTH_USER_MODEL = 'authentication.AppUser'
 # --- Find and replace your existing REST_FRAMEWORK block ---
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    # orjson-backed JSON in and out; form/multipart stay for image uploads
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    # Budgets for the expensive endpoints (see api/throttling.py), by scope
+    # and optionally user type ('scope:Buyer', 'scope:Seller', 'scope:anon')
+    'DEFAULT_THROTTLE_RATES': {
+        'chat': os.getenv('THROTTLE_CHAT', '20/min'),
+        'image_search': os.getenv('THROTTLE_IMAGE_SEARCH', '30/min'),
+        'image_search:anon': os.getenv('THROTTLE_IMAGE_SEARCH_ANON', '10/min'),
+        'product_upload:Seller': os.getenv('THROTTLE_PRODUCT_UPLOAD', '60/hour'),
+        'stk_push': os.getenv('THROTTLE_STK_PUSH', '10/min'),
+    },
     # This is the fix for clean error messages on the frontend
     'EXCEPTION_HANDLER': 'api.exceptions.custom_exception_handler', 
 }
 
+# Cache: per-process local memory by default. Set CACHE_DIR to share the
+# cache (response cache generations, locks) between gunicorn workers.
+CACHE_DIR = os.getenv('CACHE_DIR')
+if CACHE_DIR:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_DIR,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# API token -> user snapshots (see api/authentication.py): shared cache and
+# per-process LRU timeouts in seconds. AUTH_TOKEN_EXPIRY (seconds unused, 0 =
+# never) enables sliding expiry; Token.created is moved forward at most once
+# per AUTH_TOKEN_SLIDE_INTERVAL
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 60))
+AUTH_TOKEN_LOCAL_CACHE_SIZE = 10000
+AUTH_TOKEN_LOCAL_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_LOCAL_CACHE_TIMEOUT', 5))
+AUTH_TOKEN_EXPIRY = int(os.getenv('AUTH_TOKEN_EXPIRY', 0))
+AUTH_TOKEN_SLIDE_INTERVAL = int(os.getenv('AUTH_TOKEN_SLIDE_INTERVAL', 15 * 60))
+
+# Anonymous catalogue response cache (see api/cache_utils.py), in seconds
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 60))
+RESPONSE_CACHE_STALE_GRACE = int(os.getenv('RESPONSE_CACHE_STALE_GRACE', 30))
+RESPONSE_CACHE_LOCK_TIMEOUT = 10
+RESPONSE_CACHE_LOCK_WAIT = 2
+
+# Identical concurrent image searches / chat questions share one computation
+# (see api/coalesce_utils.py). Duplicates wait up to SINGLE_FLIGHT_WAIT seconds;
+# the result stays in the shared cache for SINGLE_FLIGHT_RESULT_TTL seconds
+SINGLE_FLIGHT_WAIT = int(os.getenv('SINGLE_FLIGHT_WAIT', 30))
+SINGLE_FLIGHT_LOCK_TIMEOUT = 60
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 5))
+
+# Background threads rendering product image thumbnails (api/image_utils.py)
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+
+# Anonymous carts kept in a signed cookie (see api/cart_utils.py)
+GUEST_CART_COOKIE_NAME = 'guest_cart'
+GUEST_CART_MAX_AGE = int(os.getenv('GUEST_CART_MAX_AGE', 60 * 60 * 24 * 30))
+GUEST_CART_MAX_LINES = 50
+
+# Stock held for unpaid orders (see api/inventory_utils.py), in seconds:
+# from checkout until an STK push is sent, then while the buyer pays
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 15 * 60))
+STOCK_PAYMENT_HOLD = int(os.getenv('STOCK_PAYMENT_HOLD', 10 * 60))
+
+# Seller order feed, keyset-paginated (see api/order_utils.py)
+SELLER_ORDERS_PAGE_SIZE = int(os.getenv('SELLER_ORDERS_PAGE_SIZE', 50))
+SELLER_ORDERS_MAX_PAGE_SIZE = 200
+
+# Rows fetched per server-side cursor round trip by order exports (see api/export_utils.py)
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+
+# Keyword product search (see api/search_utils.py)
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 200))
+SEARCH_RECENCY_HALF_LIFE_DAYS = float(os.getenv('SEARCH_RECENCY_HALF_LIFE_DAYS', 14))
+SEARCH_RECENCY_WEIGHT = float(os.getenv('SEARCH_RECENCY_WEIGHT', 1.0))
+
+# Per-request instrumentation (see mitumbaesales/middleware.py). Requests slower
+# than SLOW_REQUEST_THRESHOLD seconds are logged with their breakdown, a
+# SLOW_REQUEST_SAMPLE_RATE fraction of them. /metrics is served only when
+# METRICS_TOKEN is set, to requests sending it as a Bearer token
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', 1.0))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv('SLOW_REQUEST_SAMPLE_RATE', 0.1))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# OpenTelemetry spans (see mitumbaesales/tracing.py), off by default.
+# TRACING_EXPORTER is none, otlp (OTEL_EXPORTER_OTLP_* variables), console or
+# file (JSON lines in TRACING_FILE, rotated at TRACING_FILE_MAX_BYTES);
+# TRACING_SAMPLE_RATE is the fraction of new traces kept. Test runs never export
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'none')
+if sys.argv[1:2] == ['test']:
+    TRACING_EXPORTER = 'none'
+TRACING_FILE = os.getenv('TRACING_FILE', os.path.join(BASE_DIR, 'traces.jsonl'))
+TRACING_FILE_MAX_BYTES = int(os.getenv('TRACING_FILE_MAX_BYTES', 10 * 1024 * 1024))
+TRACING_FILE_BACKUPS = int(os.getenv('TRACING_FILE_BACKUPS', 3))
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 0.1))
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'mitumbaesales')
+
 # Add this at the bottom to make the key available in your code
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
@@ -222,4 +330,39 @@ MPESA_QUERY_URL = os.getenv('MPESA_QUERY_URL')
 MPESA_AUTH_URL_SANDBOX = os.getenv('MPESA_AUTH_URL_SANDBOX')
 MPESA_STK_PUSH_URL_SANDBOX = os.getenv('MPESA_STK_PUSH_URL_SANDBOX')
 MPESA_QUERY_URL_SANDBOX = os.getenv('MPESA_QUERY_URL_SANDBOX')
-MPESA_USE_SANDBOX = os.getenv('MPESA_USE_SANDBOX')  
\ No newline at end of file
+MPESA_USE_SANDBOX = os.getenv('MPESA_USE_SANDBOX')  
+
+# Daraja OAuth tokens are cached (shared between workers when CACHE_DIR is set)
+# and refreshed this many seconds before they expire, by one worker at a time
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', 5 * 60))
+MPESA_TOKEN_LOCK_WAIT = 5
+
+# HTTP to Daraja: pooled keep-alive connections per worker, timeouts in
+# seconds, and retries (token and status query only) with jittered backoff
+MPESA_POOL_SIZE = int(os.getenv('MPESA_POOL_SIZE', 10))
+MPESA_CONNECT_TIMEOUT = float(os.getenv('MPESA_CONNECT_TIMEOUT', 3.05))
+MPESA_READ_TIMEOUT = float(os.getenv('MPESA_READ_TIMEOUT', 15))
+MPESA_MAX_RETRIES = int(os.getenv('MPESA_MAX_RETRIES', 2))
+MPESA_RETRY_BACKOFF = float(os.getenv('MPESA_RETRY_BACKOFF', 0.25))
+
+# The token refresh lock must outlive the slowest possible fetch (every
+# attempt timing out, plus the longest jittered backoff between them), or a
+# second worker starts its own fetch while the first is still retrying
+MPESA_TOKEN_LOCK_TIMEOUT = int(
+    (1 + MPESA_MAX_RETRIES) * (MPESA_CONNECT_TIMEOUT + MPESA_READ_TIMEOUT)
+    + 1.5 * MPESA_RETRY_BACKOFF * (2 ** MPESA_MAX_RETRIES - 1)
+) + 1
+
+# STK pushes with no callback yet are queried after MPESA_RECONCILE_AFTER
+# seconds and given up on after MPESA_STK_EXPIRE_AFTER (see payments/services.py)
+MPESA_RECONCILE_AFTER = int(os.getenv('MPESA_RECONCILE_AFTER', 2 * 60))
+MPESA_STK_EXPIRE_AFTER = int(os.getenv('MPESA_STK_EXPIRE_AFTER', 30 * 60))
+MPESA_RECONCILE_WORKERS = int(os.getenv('MPESA_RECONCILE_WORKERS', 4))
+MPESA_RECONCILE_RATE = float(os.getenv('MPESA_RECONCILE_RATE', 5))
+
+# STK callbacks are stored in an inbox and applied in batches, on a
+# background thread right after they arrive and by process_mpesa_callbacks
+MPESA_CALLBACK_BACKGROUND = os.getenv('MPESA_CALLBACK_BACKGROUND', 'True') == 'True'
+MPESA_CALLBACK_BATCH_SIZE = 100
+MPESA_CALLBACK_MAX_ATTEMPTS = 10
+MPESA_CALLBACK_RETRY_DELAY = 30
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""
+OpenTelemetry tracing. Spans cover request handling (TracingMiddleware),
+ORM queries, Groq, Chroma, CLIP and Daraja calls, and the background jobs a
+request schedules, so a product upload shows up as one trace from the POST
+to its thumbnails:
+
+    @traced('chroma.query')
+    def search_similar_products(...): ...
+
+    _executor.submit(in_current_context(job, 'image_derivatives.generate'), product_id)
+
+Spans are exported according to TRACING_EXPORTER: 'none' (the default),
+'file' (one JSON span per line in TRACING_FILE, rotated at
+TRACING_FILE_MAX_BYTES), 'console' or 'otlp' (configured with the usual
+OTEL_EXPORTER_OTLP_* variables).
+"""
+import functools
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+from .middleware import route_name
+
+logger = logging.getLogger(__name__)
+
+# A proxy until configure_tracing() installs the provider, so modules can create spans at import time
+tracer = trace.get_tracer('mitumbaesales')
+
+MAX_STATEMENT_LENGTH = 2000
+
+_provider = None
+
+
+def span_line(span):
+    """
+    One finished span as JSON, on a single line. Leaner than ReadableSpan.to_json(),
+    which repeats the resource on every span and costs about as much as
+    creating the span in the first place.
+    """
+    span_context = span.context
+    return json.dumps({
+        'name': span.name,
+        'trace_id': format(span_context.trace_id, '032x'),
+        'span_id': format(span_context.span_id, '016x'),
+        'parent_id': format(span.parent.span_id, '016x') if span.parent else None,
+        'kind': span.kind.name,
+        'start_time': span.start_time,
+        'duration_ms': (span.end_time - span.start_time) / 1e6,
+        'status': span.status.status_code.name,
+        'attributes': dict(span.attributes),
+        'events': [{'name': event.name, 'time': event.timestamp, 'attributes': dict(event.attributes)} for event in span.events],
+    }, default=str)
+
+
+class RotatingFileSpanExporter(SpanExporter):
+    """
+    Spans as JSON lines in `path`. Like RotatingFileHandler (which does the
+    writing), the file is rolled over at `max_bytes`, keeping `backups` old
+    ones, so tracing left on can't fill the disk.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+
+    def export(self, spans):
+        for span in spans:
+            self._handler.handle(logging.makeLogRecord({'msg': span_line(span)}))
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        self._handler.close()
+
+
+def _exporter(name):
+    if name == 'file':
+        return RotatingFileSpanExporter(settings.TRACING_FILE, settings.TRACING_FILE_MAX_BYTES, settings.TRACING_FILE_BACKUPS)
+    if name == 'console':
+        return ConsoleSpanExporter()
+    if name == 'otlp':
+        # Only needed here, and only when spans go to a collector
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    raise ValueError(f"Unknown TRACING_EXPORTER {name!r} (expected file, console, otlp or none)")
+
+
+def configure_tracing(span_processor=None):
+    """
+    Installs the tracer provider once per process (called from
+    ApiConfig.ready), unless TRACING_EXPORTER is 'none'. Tests pass their
+    own `span_processor`, which turns tracing on whatever the setting, with
+    every trace sampled.
+    """
+    global _provider
+    if span_processor is None and settings.TRACING_EXPORTER in ('', 'none'):
+        return
+    if _provider is None:
+        rate = 1.0 if span_processor is not None else settings.TRACING_SAMPLE_RATE
+        _provider = TracerProvider(
+            resource=Resource.create({'service.name': settings.TRACING_SERVICE_NAME}),
+            sampler=ParentBased(TraceIdRatioBased(rate)),
+        )
+        trace.set_tracer_provider(_provider)
+        connection_created.connect(install_query_tracer)
+        for connection in connections.all(initialized_only=True):
+            install_query_tracer(connection)
+        if span_processor is None:
+            _provider.add_span_processor(BatchSpanProcessor(_exporter(settings.TRACING_EXPORTER)))
+            logger.info(f"Tracing enabled, exporting spans to {settings.TRACING_EXPORTER}")
+    if span_processor is not None:
+        _provider.add_span_processor(span_processor)
+
+
+def traced(name, attributes=None, kind=SpanKind.INTERNAL):
+    """A span around a block, or around every call of the function it decorates."""
+    return tracer.start_as_current_span(name, kind=kind, attributes=attributes)
+
+
+def in_current_context(function, name=None):
+    """
+    `function`, wrapped to run in the caller's trace context (in a span
+    called `name`, if given) on whichever thread ends up calling it.
+    """
+    captured = context.get_current()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = context.attach(captured)
+        try:
+            if name is None:
+                return function(*args, **kwargs)
+            with tracer.start_as_current_span(name):
+                return function(*args, **kwargs)
+        finally:
+            context.detach(token)
+
+    return wrapper
+
+
+def _trace_query(execute, sql, params, many, query_context):
+    # Queries outside a sampled trace (migrations, shell, unsampled requests) cost a single check
+    if not trace.get_current_span().is_recording():
+        return execute(sql, params, many, query_context)
+    connection = query_context['connection']
+    operation = sql.split(None, 1)[0].upper() if sql else 'QUERY'
+    attributes = {
+        'db.system': connection.vendor,
+        'db.name': connection.alias,
+        'db.operation': operation,
+        'db.statement': sql[:MAX_STATEMENT_LENGTH],
+    }
+    if many:
+        attributes['db.executemany'] = True
+    with tracer.start_as_current_span(f'db.{operation}', kind=SpanKind.CLIENT, attributes=attributes):
+        return execute(sql, params, many, query_context)
+
+
+def install_query_tracer(connection, **kwargs):
+    """Adds the ORM span wrapper to a connection when it opens (connections are per thread)."""
+    if _trace_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_trace_query)
+
+
+class TracingMiddleware:
+    """
+    One server span per request, continuing the caller's trace when a
+    `traceparent` header is sent. Named after the matched URL pattern once
+    the view is resolved.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if _provider is not None:
+            # Connections opened before tracing was configured didn't get the wrapper
+            for connection in connections.all(initialized_only=True):
+                install_query_tracer(connection)
+
+    def __call__(self, request):
+        parent = propagate.extract(request.headers)
+        with tracer.start_as_current_span(
+            f'{request.method} {request.path}', context=parent, kind=SpanKind.SERVER,
+            attributes={'http.request.method': request.method, 'url.path': request.path},
+        ) as span:
+            response = self.get_response(request)
+            if span.is_recording():
+                route = route_name(request)
+                span.update_name(f'{request.method} {route}')
+                span.set_attribute('http.route', route)
+                span.set_attribute('http.response.status_code', response.status_code)
+                if response.status_code >= 500:
+                    span.set_status(Status(StatusCode.ERROR))
+            return response
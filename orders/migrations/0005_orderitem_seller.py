@@ -0,0 +1,52 @@
+# Generated by Django 5.2.3 on 2026-10-19 14:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BACKFILL_BATCH = 5000
+
+
+def backfill_sellers(apps, schema_editor):
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    Product = apps.get_model('product', 'Product')
+    MysteryBox = apps.get_model('product', 'MysteryBox')
+    Order = apps.get_model('orders', 'Order')
+    seller = Coalesce(
+        Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('seller_id')[:1]),
+        Subquery(MysteryBox.objects.filter(pk=OuterRef('mystery_box_id')).values('seller_id')[:1]),
+    )
+    ordered_at = Subquery(Order.objects.filter(pk=OuterRef('order_id')).values('created_at')[:1])
+    # Batches by id range keep each UPDATE's row locks short on a large table
+    last_id = OrderItem.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, last_id, BACKFILL_BATCH):
+        OrderItem.objects.filter(id__gt=start, id__lte=start + BACKFILL_BATCH).update(seller_id=seller, ordered_at=ordered_at)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_stockreservation'),
+        ('product', '0008_product_image_derivatives'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='ordered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='seller',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, db_index=False, related_name='sold_items', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_sellers, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['seller', '-ordered_at', '-order'], name='orderitem_seller_feed'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_orderstatuschange'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='mpesa_checkout_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+    ]
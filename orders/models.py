@@ -1,6 +1,7 @@
 import uuid
 from django.db import models
 from authentication.models import AppUser
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, MaxValueValidator
 from product.models import Product, MysteryBox # Ensure MysteryBox is imported
 
@@ -10,13 +11,21 @@ STATUS_CHOICES = [
     ('cancelled', 'Cancelled'),
 ]
 
+# Which statuses an order may move to from each status. Processed and
+# cancelled are final: stock has been committed or returned by then.
+ALLOWED_STATUS_TRANSITIONS = {
+    'pending': {'processed', 'cancelled'},
+    'processed': set(),
+    'cancelled': set(),
+}
+
 class Order(models.Model):
     order_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     buyer = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='orders')
     status = models.CharField(max_length=20, default='pending', choices=STATUS_CHOICES)
     
     # Store the M-Pesa CheckoutRequestID for tracking payments
-    mpesa_checkout_id = models.CharField(max_length=100, blank=True, null=True)
+    mpesa_checkout_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
     
     total_price = models.DecimalField(
         max_digits=10,
@@ -62,10 +71,98 @@ class OrderItem(models.Model):
     # Historical price at the time of purchase
     price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0.00)])
 
+    # Copied from the product/box and the order at checkout so a seller's
+    # order feed is a single index range scan instead of a join + DISTINCT
+    seller = models.ForeignKey(AppUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='sold_items', db_index=False)
+    ordered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['seller', '-ordered_at', '-order'], name='orderitem_seller_feed'),
+        ]
+
     @property
     def subtotal(self):
         return self.quantity * self.price
 
     def __str__(self):
         item_name = self.product.name if self.product else self.mystery_box.name
-        return f"{self.quantity} of {item_name} in order {self.order.order_id}"
\ No newline at end of file
+        return f"{self.quantity} of {item_name} in order {self.order.order_id}"
+
+class IdempotencyRecord(models.Model):
+    """
+    Result of a request sent with an Idempotency-Key header, so a retried
+    request (e.g. a double-tapped checkout) gets the original response
+    instead of repeating the work. Only completed requests are recorded.
+    """
+    user = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='idempotency_records')
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} for {self.user.email}"
+
+
+class StockReservation(models.Model):
+    """
+    Units taken out of Product.stock_quantity for an unpaid order. Active
+    reservations expire (api/inventory_utils.py puts the stock back) unless
+    the order's M-Pesa payment completes first.
+    """
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id} ({self.status})"
+
+
+class OrderStatusChange(models.Model):
+    """
+    Append-only history of order status transitions. `changed_by` is empty
+    for changes made by the system (payment failures, expired reservations).
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_history')
+    from_status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    to_status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    changed_by = models.ForeignKey(AppUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Order status history is append-only.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Order status history is append-only.")
+
+    def __str__(self):
+        return f"Order {self.order_id}: {self.from_status} -> {self.to_status}"
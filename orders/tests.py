@@ -1,4 +1,349 @@
+import csv
+import json
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.http import HttpResponse
 from django.test import TestCase
+from rest_framework.test import APIClient
+from rest_framework.exceptions import ValidationError
+from django.utils import timezone
+
+from api.cart_utils import write_guest_cart
+from api.checkout_utils import CheckoutError, DuplicateRequest, PricesChanged, place_order
+from api.export_utils import export_rows, stream_export
+from api.order_utils import seller_order_page, transition_orders
+from api.inventory_utils import hold_for_payment, release_expired_reservations, settle_payment
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from payments.models import MpesaSTKPush
+from product.models import Product, MysteryBox
+from .models import IdempotencyRecord, Order, OrderStatusChange, StockReservation
+
+
+def render(order):
+    return {'order_id': str(order.pk), 'total_price': str(order.total_price)}
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=10)
+        self.box = MysteryBox.objects.create(seller=seller, price=Decimal('60.00'))
+        self.cart = Cart.objects.create(user=self.buyer)
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        CartItem.objects.create(cart=self.cart, mystery_box=self.box, quantity=1)
+
+    def test_order_built_from_cart(self):
+        order, body = place_order(self.buyer, render)
+        self.assertEqual(order.total_price, Decimal('260.00'))
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(body['order_id'], str(order.pk))
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, 0)
+        self.assertFalse(self.cart.items.exists())
+
+    def test_changed_prices_are_repriced_not_charged(self):
+        Product.objects.filter(pk=self.jacket.pk).update(price=Decimal('80.00'))
+        MysteryBox.objects.filter(pk=self.box.pk).update(price=Decimal('75.00'))
+        with self.assertRaisesMessage(PricesChanged, 'Prices in your cart have changed.'):
+            place_order(self.buyer, render)
+        self.assertFalse(Order.objects.exists())
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_price, Decimal('235.00'))
+        self.assertEqual(sorted(self.cart.items.values_list('unit_price', 'subtotal')), [
+            (Decimal('75.00'), Decimal('75.00')), (Decimal('80.00'), Decimal('160.00')),
+        ])
+
+        # The buyer has now seen the new total, and is charged it
+        order, _ = place_order(self.buyer, render)
+        self.assertEqual(order.total_price, Decimal('235.00'))
+        self.assertEqual(sorted(order.items.values_list('price', flat=True)), [Decimal('75.00'), Decimal('80.00')])
+
+    def test_empty_cart(self):
+        self.cart.clear()
+        with self.assertRaises(CheckoutError):
+            place_order(self.buyer, render)
+        self.assertFalse(Order.objects.exists())
+
+    def test_idempotency_key_records_result(self):
+        order, body = place_order(self.buyer, render, idempotency_key='tap-1', request_hash='abc')
+        record = IdempotencyRecord.objects.get(user=self.buyer, key='tap-1')
+        self.assertEqual(record.order, order)
+        self.assertEqual(record.response_body, body)
+
+        with self.assertRaises(DuplicateRequest):
+            place_order(self.buyer, render, idempotency_key='tap-1', request_hash='abc')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_checkout_leaves_key_unused(self):
+        self.cart.clear()
+        with self.assertRaises(CheckoutError):
+            place_order(self.buyer, render, idempotency_key='tap-1')
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class GuestCheckoutTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=1)
+        self.api = APIClient()
+        self.api.force_authenticate(self.buyer)
+        cookie = HttpResponse()
+        write_guest_cart(cookie, {('product', self.jacket.pk): 2})
+        self.api.cookies[settings.GUEST_CART_COOKIE_NAME] = cookie.cookies[settings.GUEST_CART_COOKIE_NAME].value
+
+    def test_failed_checkout_clears_merged_cookie(self):
+        response = self.api.post('/api/orders/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.cookies[settings.GUEST_CART_COOKIE_NAME].value, '')
+
+        # The retry must not merge the same cookie lines again
+        self.assertEqual(self.api.post('/api/orders/', {}, format='json').status_code, 400)
+        cart = Cart.objects.get(user=self.buyer)
+        self.assertEqual(cart.items.get().quantity, 2)
+
+        Product.objects.filter(pk=self.jacket.pk).update(stock_quantity=5)
+        self.assertEqual(self.api.post('/api/orders/', {}, format='json').status_code, 201)
+        self.assertEqual(Order.objects.get(buyer=self.buyer).items.get().quantity, 2)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.seller = seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=3)
+        self.scarf = Product.objects.create(seller=seller, name='Scarf', slug='scarf', price=Decimal('20.00'), stock_quantity=5)
+        self.box = MysteryBox.objects.create(seller=seller, price=Decimal('60.00'))
+        self.box.items.set([self.jacket, self.scarf])
+        self.cart = Cart.objects.create(user=self.buyer)
+
+    def stock(self, product):
+        return Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+
+    def test_checkout_reserves_box_contents(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=1)
+        CartItem.objects.create(cart=self.cart, mystery_box=self.box, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.assertEqual(self.stock(self.jacket), 0)
+        self.assertEqual(self.stock(self.scarf), 3)
+        self.assertEqual(order.reservations.get(product=self.jacket).quantity, 3)
+
+    def test_out_of_stock_rolls_back(self):
+        CartItem.objects.create(cart=self.cart, product=self.scarf, quantity=1)
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=4)
+        with self.assertRaises(CheckoutError):
+            place_order(self.buyer, render)
+        self.assertEqual(self.stock(self.scarf), 5)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 2)
+
+    def pay(self, order, checkout_request_id='ws_CO_1'):
+        MpesaSTKPush.objects.create(
+            user=self.buyer, order=order, phone_number='254700000000', amount=order.total_price, checkout_request_id=checkout_request_id,
+        )
+        hold_for_payment(order, checkout_request_id)
+
+    def test_failed_payment_releases_stock(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.pay(order)
+        settle_payment('ws_CO_1', succeeded=False)
+        settle_payment('ws_CO_1', succeeded=False)
+        self.assertEqual(self.stock(self.jacket), 3)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+
+    def test_completed_payment_keeps_stock(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.pay(order)
+        settle_payment('ws_CO_1', succeeded=True)
+        self.assertEqual(release_expired_reservations(now=timezone.now() + timedelta(days=1)), 0)
+        self.assertEqual(self.stock(self.jacket), 1)
+        self.assertEqual(order.reservations.get().status, 'committed')
+
+    def expire(self, order):
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        release_expired_reservations()
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'cancelled')
+
+    def test_payment_after_expiry_reopens_order(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.pay(order)
+        self.expire(order)
+        settle_payment('ws_CO_1', succeeded=True)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'pending')
+        self.assertEqual(self.stock(self.jacket), 1)
+        self.assertEqual(order.reservations.get().status, 'committed')
+        self.assertEqual(
+            list(order.status_history.order_by('pk').values_list('from_status', 'to_status')),
+            [('pending', 'cancelled'), ('cancelled', 'pending')],
+        )
+
+    def test_payment_after_expiry_without_stock_needs_refund(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.pay(order)
+        self.expire(order)
+        Product.objects.filter(pk=self.jacket.pk).update(stock_quantity=1)
+        with self.assertLogs('api.inventory_utils', 'ERROR'):
+            settle_payment('ws_CO_1', succeeded=True)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'cancelled')
+        self.assertEqual(self.stock(self.jacket), 1)
+
+    def test_payment_after_seller_cancelled_needs_refund(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.pay(order)
+        transition_orders(self.seller, [order.pk], 'cancelled')
+        with self.assertLogs('api.inventory_utils', 'ERROR'):
+            settle_payment('ws_CO_1', succeeded=True)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'cancelled')
+        self.assertEqual(self.stock(self.jacket), 3)
+
+    def test_expired_reservation_released(self):
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=2)
+        order, _ = place_order(self.buyer, render)
+        self.assertEqual(release_expired_reservations(), 0)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(self.stock(self.jacket), 3)
+
+
+class SellerOrderFeedTests(TestCase):
+    def setUp(self):
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.other = AppUser.objects.create_user(username='other', email='other@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=100)
+        self.scarf = Product.objects.create(seller=self.other, name='Scarf', slug='scarf', price=Decimal('20.00'), stock_quantity=100)
+        self.box = MysteryBox.objects.create(seller=self.seller, price=Decimal('60.00'))
+        self.cart = Cart.objects.create(user=self.buyer)
+
+    def checkout(self, **line):
+        CartItem.objects.create(cart=self.cart, quantity=1, **line)
+        return place_order(self.buyer, render)[0]
+
+    def test_checkout_records_seller(self):
+        CartItem.objects.create(cart=self.cart, product=self.scarf, quantity=1)
+        order = self.checkout(mystery_box=self.box)
+        sellers = dict(order.items.values_list('mystery_box_id', 'seller_id'))
+        self.assertEqual(sellers, {None: self.other.pk, self.box.pk: self.seller.pk})
+        self.assertTrue(all(item.ordered_at == order.created_at for item in order.items.all()))
+
+    def test_pages_cover_every_order_once(self):
+        orders = [self.checkout(product=self.jacket) for _ in range(4)]
+        CartItem.objects.create(cart=self.cart, product=self.jacket, quantity=1)
+        orders.append(self.checkout(mystery_box=self.box))
+        self.checkout(product=self.scarf)
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = seller_order_page(self.seller, cursor, limit=2)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [order.pk for order in sorted(orders, key=lambda o: (o.created_at, o.pk), reverse=True)])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValidationError):
+            seller_order_page(self.seller, 'not-a-cursor')
+
+
+class OrderExportTests(TestCase):
+    def setUp(self):
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=10)
+        box = MysteryBox.objects.create(seller=self.seller, name='Denim box', price=Decimal('60.00'))
+        cart = Cart.objects.create(user=self.buyer)
+        CartItem.objects.create(cart=cart, product=jacket, quantity=2)
+        CartItem.objects.create(cart=cart, mystery_box=box, quantity=1)
+        self.order, _ = place_order(self.buyer, render)
+
+    def export(self, user, export_format, **dates):
+        return b''.join(stream_export(export_format, export_rows(user, **dates))).decode()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(self.export(self.seller, 'csv').splitlines()))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row['item_name'] for row in rows}, {'Jacket', 'Denim box'})
+        jacket = next(row for row in rows if row['item_type'] == 'product')
+        self.assertEqual((jacket['quantity'], jacket['subtotal'], jacket['buyer']), ('2', '200.00', 'buyer@example.com'))
+
+    def test_csv_neutralises_formulas(self):
+        names = ['=HYPERLINK("http://evil.test","Jacket")', '+1+1', '-2+3', '@SUM(A1)', '\tTab', '\rReturn', 'Plain - name']
+        for name in names:
+            with self.subTest(name=name):
+                Product.objects.filter(name__isnull=False).update(name=name)
+                jacket = next(
+                    row for row in csv.DictReader(self.export(self.seller, 'csv').splitlines(keepends=True))
+                    if row['item_type'] == 'product'
+                )
+                expected = name if name == 'Plain - name' else "'" + name
+                self.assertEqual(jacket['item_name'], expected)
+                self.assertEqual(jacket['subtotal'], '200.00')
+        # JSON consumers get the value untouched
+        records = [json.loads(line) for line in self.export(self.seller, 'jsonl').splitlines()]
+        self.assertIn('Plain - name', {record['item_name'] for record in records})
+
+    def test_jsonl_for_buyer(self):
+        records = [json.loads(line) for line in self.export(self.buyer, 'jsonl').splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual({record['order_id'] for record in records}, {str(self.order.pk)})
+        self.assertEqual(sorted(record['subtotal'] for record in records), ['200.00', '60.00'])
+
+    def test_date_filter(self):
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        self.assertEqual(self.export(self.seller, 'jsonl', since=tomorrow), '')
+
+
+class OrderStatusTransitionTests(TestCase):
+    def setUp(self):
+        self.seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        other = AppUser.objects.create_user(username='other', email='other@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=self.seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=10)
+        self.scarf = Product.objects.create(seller=other, name='Scarf', slug='scarf', price=Decimal('20.00'), stock_quantity=10)
+        self.cart = Cart.objects.create(user=self.buyer)
+
+    def checkout(self, product):
+        CartItem.objects.create(cart=self.cart, product=product, quantity=1)
+        return place_order(self.buyer, render)[0]
+
+    def test_bulk_transition_reports_each_order(self):
+        first, second = self.checkout(self.jacket), self.checkout(self.jacket)
+        done = self.checkout(self.jacket)
+        Order.objects.filter(pk=done.pk).update(status='processed')
+        foreign, missing = self.checkout(self.scarf), uuid.uuid4()
+
+        results = transition_orders(self.seller, [first.pk, second.pk, done.pk, foreign.pk, missing], 'cancelled')
+        self.assertEqual({order_id: outcome['result'] for order_id, outcome in results.items()}, {
+            first.pk: 'updated', second.pk: 'updated', done.pk: 'invalid_transition',
+            foreign.pk: 'forbidden', missing: 'not_found',
+        })
+        self.assertEqual(Order.objects.filter(status='cancelled').count(), 2)
+        self.assertEqual(Product.objects.get(pk=self.jacket.pk).stock_quantity, 9)
+        history = OrderStatusChange.objects.get(order=first)
+        self.assertEqual((history.from_status, history.to_status, history.changed_by), ('pending', 'cancelled', self.seller))
 
-# Create your tests here.
+    def test_processing_commits_reservations(self):
+        order = self.checkout(self.jacket)
+        transition_orders(self.seller, [order.pk], 'processed')
+        self.assertEqual(order.reservations.get().status, 'committed')
 
+    def test_history_is_append_only(self):
+        order = self.checkout(self.jacket)
+        transition_orders(self.seller, [order.pk], 'processed')
+        change = OrderStatusChange.objects.get()
+        with self.assertRaises(ValueError):
+            change.save()
+        with self.assertRaises(ValueError):
+            change.delete()
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-19 15:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesastkpush',
+            index=models.Index(fields=['status', 'created_at'], name='stkpush_status_created'),
+        ),
+    ]
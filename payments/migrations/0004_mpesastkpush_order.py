@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_pushes_to_orders(apps, schema_editor):
+    """Existing pushes belong to the order that recorded their CheckoutRequestID."""
+    Order = apps.get_model('orders', 'Order')
+    MpesaSTKPush = apps.get_model('payments', 'MpesaSTKPush')
+    orders = Order.objects.filter(mpesa_checkout_id__isnull=False).values_list('mpesa_checkout_id', 'pk')
+    for checkout_request_id, order_id in orders.iterator():
+        MpesaSTKPush.objects.filter(checkout_request_id=checkout_request_id).update(order_id=order_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_order_mpesa_checkout_id_index'),
+        ('payments', '0003_mpesacallback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesastkpush',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stk_pushes', to='orders.order'),
+        ),
+        migrations.RunPython(link_pushes_to_orders, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='mpesastkpush',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'Pending')), fields=('order',), name='stkpush_one_pending_per_order'),
+        ),
+    ]
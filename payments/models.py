@@ -1,5 +1,7 @@
 from django.db import models
+from django.db.models import Q
 from authentication.models import AppUser 
+from orders.models import Order
 import uuid
 
 # Create your models here.
@@ -7,6 +9,9 @@ import uuid
 class MpesaSTKPush(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(AppUser, on_delete=models.SET_NULL, null=True, blank=True)
+    # The order this push pays for; its result settles this order whatever
+    # push last wrote Order.mpesa_checkout_id
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='stk_pushes')
     phone_number = models.CharField(max_length=15)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     reference = models.CharField(max_length=100, unique=True, null=True, blank=True)
@@ -36,6 +41,40 @@ class MpesaSTKPush(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # The reconciler's scan for pushes still Pending after N seconds
+            models.Index(fields=['status', 'created_at'], name='stkpush_status_created'),
+        ]
+        constraints = [
+            # A second push while the buyer still has the first prompt open is refused
+            models.UniqueConstraint(fields=['order'], condition=Q(status='Pending'), name='stkpush_one_pending_per_order'),
+        ]
+
     def __str__(self):
         return f"Mpesa STK Push for {self.phone_number} - {self.amount} - {self.status}"
 
+
+class MpesaCallback(models.Model):
+    """
+    Inbox of raw Daraja STK callbacks. The callback view only appends here;
+    payments/services.py applies them in batches. `dedupe_key` drops
+    Daraja's retries of a callback at insert time.
+    """
+    checkout_request_id = models.CharField(max_length=100, null=True, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=50, null=True, blank=True)
+    dedupe_key = models.CharField(max_length=200, unique=True)
+    payload = models.JSONField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='mpesacallback_queue'),
+        ]
+
+    def __str__(self):
+        return f"M-Pesa callback {self.checkout_request_id} ({'processed' if self.processed_at else 'queued'})"
@@ -1,11 +1,61 @@
 import requests
 import base64
+import hashlib
+import os
+import random
+import threading
+import time
 from datetime import datetime
 from django.conf import settings
+from django.core.cache import cache
 import logging
 
+from api.cache_utils import acquire_lock, release_lock
+from mitumbaesales.metrics import counter, histogram
+from mitumbaesales.middleware import external_call
+from mitumbaesales.tracing import traced
+from opentelemetry.trace import SpanKind
+from requests.adapters import HTTPAdapter
+
 logger = logging.getLogger(__name__)
 
+TOKEN_FETCHES = counter('mpesa_token_fetch_total', "M-Pesa OAuth token fetches from Daraja.", ['outcome'])
+TOKEN_FETCH_SECONDS = histogram('mpesa_token_fetch_seconds', "Latency of M-Pesa OAuth token fetches.")
+TOKEN_LOOKUPS = counter(
+    'mpesa_token_lookup_total',
+    "Access token lookups: hit (cached), refreshed (this process fetched), "
+    "shared (waited for another worker's fetch), stale (served while another worker refreshes).",
+    ['result'],
+)
+REQUEST_SECONDS = histogram('mpesa_request_seconds', "Latency of each HTTP attempt to Daraja.", ['endpoint'])
+REQUESTS = counter('mpesa_request_total', "HTTP attempts to Daraja by outcome (ok, http_<status>, timeout, error).", ['endpoint', 'outcome'])
+
+# Worth retrying on an idempotent call: Daraja is overloaded or briefly down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    The process's shared keep-alive session, so calls reuse pooled TCP/TLS
+    connections. Rebuilt after a fork: gunicorn workers must not share
+    sockets opened in the master.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.MPESA_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
 class MpesaAPIClient:
     def __init__(self):
         self.consumer_key = settings.MPESA_CONSUMER_KEY
@@ -19,24 +69,117 @@ class MpesaAPIClient:
         self.stk_push_url = settings.MPESA_STK_PUSH_URL_SANDBOX if self.use_sandbox else settings.MPESA_STK_PUSH_URL
         self.query_url = settings.MPESA_QUERY_URL_SANDBOX if self.use_sandbox else settings.MPESA_QUERY_URL
 
-    def _get_access_token(self):
+    def _request(self, endpoint, method, url, idempotent, **kwargs):
+        """
+        One call to Daraja on the pooled session with connect/read timeouts.
+        Idempotent calls (token, status query) are retried up to
+        MPESA_MAX_RETRIES times on timeouts, connection errors and 429/5xx,
+        with jittered exponential backoff. An STK push is never retried:
+        a retry after a lost response could prompt the buyer twice.
+        """
+        timeout = (settings.MPESA_CONNECT_TIMEOUT, settings.MPESA_READ_TIMEOUT)
+        attempts = 1 + (settings.MPESA_MAX_RETRIES if idempotent else 0)
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            try:
+                attributes = {'http.request.method': method, 'url.full': url, 'mpesa.endpoint': endpoint, 'mpesa.attempt': attempt + 1}
+                with traced(f'daraja {endpoint}', attributes, kind=SpanKind.CLIENT) as span, external_call('daraja'):
+                    response = get_session().request(method, url, timeout=timeout, **kwargs)
+                    span.set_attribute('http.response.status_code', response.status_code)
+            except requests.exceptions.RequestException as e:
+                outcome = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'error'
+                REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+                if attempt + 1 == attempts or not isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+                    raise
+            else:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                REQUESTS.inc(endpoint=endpoint, outcome='ok' if response.ok else f'http_{response.status_code}')
+                if response.status_code not in RETRY_STATUSES or attempt + 1 == attempts:
+                    return response
+            delay = settings.MPESA_RETRY_BACKOFF * 2 ** attempt
+            time.sleep(random.uniform(delay / 2, delay * 1.5))
+            logger.warning(f"Retrying M-Pesa {endpoint} call (attempt {attempt + 2} of {attempts})")
+
+    @property
+    def _token_cache_key(self):
+        # Keyed by credentials so sandbox and live (or rotated keys) never share a token
+        credentials = hashlib.sha256(f"{self.auth_url}|{self.consumer_key}".encode()).hexdigest()[:16]
+        return f"mpesa:access_token:{credentials}"
+
+    @traced('mpesa.fetch_access_token')
+    def _fetch_access_token(self):
         try:
             auth_string = f"{self.consumer_key}:{self.consumer_secret}"
             headers = {
                 'Authorization': f'Basic {base64.b64encode(auth_string.encode()).decode()}'
             }
-            response = requests.get(self.auth_url, headers=headers)
+            with TOKEN_FETCH_SECONDS.time():
+                response = self._request('token', 'GET', self.auth_url, idempotent=True, headers=headers)
             response.raise_for_status()
-            return response.json()['access_token']
+            data = response.json()
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error getting M-Pesa access token: {e}. Response: {e.response.text if e.response else 'N/A'}")
+            TOKEN_FETCHES.inc(outcome='error')
+            logger.error(f"Error getting M-Pesa access token: {e}. Response: {e.response.text if e.response is not None else 'N/A'}")
             raise
+        TOKEN_FETCHES.inc(outcome='success')
+
+        # Daraja sends expires_in as a string of seconds (3599)
+        expires_in = int(data.get('expires_in') or 3599)
+        entry = {'token': data['access_token'], 'expires_at': time.time() + expires_in}
+        cache.set(self._token_cache_key, entry, timeout=expires_in)
+        return entry
+
+    def _get_access_token(self):
+        """
+        Access token from the shared cache. It is refreshed
+        MPESA_TOKEN_REFRESH_MARGIN seconds before it expires, by one worker
+        at a time: the others keep using the current token meanwhile, or, if
+        there is none, wait briefly for the refreshing worker's result.
+        """
+        key = self._token_cache_key
+        entry = cache.get(key)
+        now = time.time()
+        if entry and entry['expires_at'] - settings.MPESA_TOKEN_REFRESH_MARGIN > now:
+            TOKEN_LOOKUPS.inc(result='hit')
+            return entry['token']
+
+        lock_key = f"{key}:lock"
+        token = acquire_lock(lock_key, settings.MPESA_TOKEN_LOCK_TIMEOUT)
+        if token is None:
+            if entry and entry['expires_at'] > now:
+                TOKEN_LOOKUPS.inc(result='stale')
+                return entry['token']
+            deadline = now + settings.MPESA_TOKEN_LOCK_WAIT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry and entry['expires_at'] > time.time():
+                    TOKEN_LOOKUPS.inc(result='shared')
+                    return entry['token']
+            # The refreshing worker is stuck or failed; fetch our own
+        try:
+            TOKEN_LOOKUPS.inc(result='refreshed')
+            return self._fetch_access_token()['token']
+        finally:
+            if token:
+                release_lock(lock_key, token)
+
+    def invalidate_access_token(self):
+        """Drops the cached token, e.g. after Daraja rejects it with a 401."""
+        cache.delete(self._token_cache_key)
+
+    def _check_response(self, response):
+        if response.status_code == 401:
+            self.invalidate_access_token()
+        response.raise_for_status()
 
     def generate_password(self, timestamp):
         data_to_encode = f"{self.shortcode}{self.passkey}{timestamp}"
         encoded_data = base64.b64encode(data_to_encode.encode()).decode()
         return encoded_data
 
+    @traced('mpesa.initiate_stk_push')
     def initiate_stk_push(self, phone_number, amount, reference, description):
         try:
             access_token = self._get_access_token()
@@ -62,14 +205,15 @@ class MpesaAPIClient:
                 "TransactionDesc": description
             }
 
-            response = requests.post(self.stk_push_url, headers=headers, json=payload)
-            response.raise_for_status()
+            response = self._request('stk_push', 'POST', self.stk_push_url, idempotent=False, headers=headers, json=payload)
+            self._check_response(response)
             logger.info(f"STK Push initiated successfully. Response: {response.json()}")
             return response.json()
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error initiating STK Push: {e}. Response: {e.response.text if e.response else 'N/A'}")
+            logger.error(f"Error initiating STK Push: {e}. Response: {e.response.text if e.response is not None else 'N/A'}")
             raise
 
+    @traced('mpesa.query_stk_push_status')
     def query_stk_push_status(self, checkout_request_id):
         try:
             access_token = self._get_access_token()
@@ -88,11 +232,11 @@ class MpesaAPIClient:
                 "CheckoutRequestID": checkout_request_id
             }
 
-            response = requests.post(self.query_url, headers=headers, json=payload)
-            response.raise_for_status()
+            response = self._request('stk_query', 'POST', self.query_url, idempotent=True, headers=headers, json=payload)
+            self._check_response(response)
             logger.info(f"STK Push status queried. Response: {response.json()}")
             return response.json()
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error querying STK Push status: {e}. Response: {e.response.text if e.response else 'N/A'}")
+            logger.error(f"Error querying STK Push status: {e}. Response: {e.response.text if e.response is not None else 'N/A'}")
             raise
 
@@ -1,15 +1,36 @@
 from rest_framework import serializers
+from orders.models import Order
 from .models import MpesaSTKPush
 
 class MpesaSTKPushInitiateSerializer(serializers.Serializer):
 
     phone_number = serializers.CharField(max_length=12, help_text="M-Pesa registered phone number (e.g., 2547XXXXXXXX).")
-    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=1)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=1, required=False)
     reference = serializers.CharField(max_length=100, required=False, help_text="Internal transaction reference.")
     description = serializers.CharField(max_length=255, required=False, help_text="Short description of the transaction.")
+    # Paying for an order holds its reserved stock until M-Pesa reports back
+    order_id = serializers.UUIDField(required=False)
+
+    def validate(self, data):
+        order_id = data.get('order_id')
+        if order_id is None:
+            if 'amount' not in data:
+                raise serializers.ValidationError({'amount': "This field is required."})
+            return data
+        request = self.context['request']
+        order = Order.objects.filter(pk=order_id, buyer=request.user, status='pending').first()
+        if order is None:
+            raise serializers.ValidationError({'order_id': "No pending order with this id."})
+        data['order'] = order
+        data['amount'] = order.total_price
+        return data
+
+    def validate_reference(self, value):
+        if MpesaSTKPush.objects.filter(reference=value).exists():
+            raise serializers.ValidationError("This reference has already been used.")
+        return value
 
     def validate_phone_number(self, value):
-        if not value.startswith('2547') or not value[3:].isdigit() or len(value) != 12:
+        if not value.startswith('254') or not value.isdigit() or len(value) != 12:
             raise serializers.ValidationError("Phone number must be in the format 2547XXXXXXXX and 12 digits long.")
         return value
-
@@ -0,0 +1,441 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.inventory_utils import hold_for_payment, settle_payment
+from mitumbaesales.metrics import counter, gauge
+from mitumbaesales.tracing import in_current_context, traced
+from .models import MpesaCallback, MpesaSTKPush
+from .mpesa_api import MpesaAPIClient
+
+logger = logging.getLogger(__name__)
+
+# Daraja ResultCode -> MpesaSTKPush.status; anything else is a failure
+STK_RESULT_STATUSES = {'0': 'Completed', '1032': 'Cancelled'}
+# Stored as result_code on pushes given up on without a result from M-Pesa
+EXPIRED_RESULT_CODE = 'expired'
+
+RECONCILED = counter(
+    'mpesa_reconcile_total', "Pending STK pushes checked by the reconciler, by outcome.", ['outcome'],
+)
+PENDING_BACKLOG = gauge(
+    'mpesa_stk_pending_backlog', "STK pushes still Pending after MPESA_RECONCILE_AFTER seconds.",
+)
+CALLBACKS_RECEIVED = counter('mpesa_callback_received_total', "STK callbacks received, by result (queued, duplicate).", ['result'])
+CALLBACKS_PROCESSED = counter('mpesa_callback_processed_total', "Inbox callbacks processed, by outcome.", ['outcome'])
+CALLBACK_BACKLOG = gauge('mpesa_callback_backlog', "Callbacks received but not processed yet.")
+STK_PUSHES = counter('mpesa_stk_push_total', "STK pushes initiated, by outcome (accepted, rejected, error).", ['outcome'])
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process's shared MpesaAPIClient, created on first use rather than at import."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MpesaAPIClient()
+    return _client
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    # The client reads its URLs and credentials once; rebuild it when tests override them
+    global _client
+    if setting.startswith('MPESA_'):
+        _client = None
+
+
+class STKPushRejected(Exception):
+    """Daraja answered the push request with a non-zero ResponseCode."""
+
+    def __init__(self, push):
+        super().__init__(push.response_description or "Unknown error.")
+        self.push = push
+
+
+class PaymentInProgress(Exception):
+    """The order already has a push waiting on the buyer, or has been paid."""
+
+
+class DuplicateReference(Exception):
+    """Another push already uses the caller's reference."""
+
+
+def _claim_push(user, phone_number, amount, reference, description, order):
+    """
+    Records a Pending push before Daraja is called, for pushes whose
+    duplicates must never prompt the buyer twice: one for `order` (at most
+    one push per order may be Pending, a partial unique index) or one with
+    a caller-chosen `reference` (a unique column). Raises PaymentInProgress
+    or DuplicateReference if another request got there first.
+    """
+    try:
+        with transaction.atomic():
+            if order is not None and MpesaSTKPush.objects.filter(order=order, status='Completed').exists():
+                raise PaymentInProgress("This order has already been paid.")
+            return MpesaSTKPush.objects.create(
+                user=user, order=order, phone_number=phone_number, amount=amount,
+                reference=reference, description=description, status='Pending',
+            )
+    except IntegrityError:
+        if reference is not None and MpesaSTKPush.objects.filter(reference=reference).exists():
+            raise DuplicateReference("This reference has already been used.")
+        raise PaymentInProgress("A payment for this order is already in progress.")
+
+
+def initiate_stk_push(user, phone_number, amount, reference=None, description=None, order=None):
+    """
+    Sends an STK push and records it. A push for `order` or with a
+    `reference` is claimed as Pending first (see _claim_push), and a push
+    for `order` holds the order's stock until the result arrives; any other
+    push is recorded with a single insert once Daraja has answered. Returns
+    the MpesaSTKPush; raises PaymentInProgress for an order that is already
+    being paid, DuplicateReference for a reference already used, and
+    STKPushRejected if Daraja refused the request (the refusal is recorded
+    as a Failed push). Network errors propagate; a claimed push is marked
+    Failed, so its order can be paid again.
+    """
+    account_reference = reference or (f"Order-{str(order.pk)[:8]}" if order is not None else f"User-{user.id}")
+    description = description or 'Gikomba Purchase'
+    claimed = None
+    if order is not None or reference is not None:
+        claimed = _claim_push(user, phone_number, amount, reference, description, order)
+    try:
+        response = get_client().initiate_stk_push(
+            phone_number=phone_number, amount=amount, reference=account_reference, description=description,
+        )
+    except Exception as e:
+        STK_PUSHES.inc(outcome='error')
+        if claimed is not None:
+            MpesaSTKPush.objects.filter(pk=claimed.pk).update(
+                status='Failed', response_description=f"STK push request failed: {e}", updated_at=timezone.now(),
+            )
+        raise
+
+    accepted = response.get('ResponseCode') == '0'
+    result = {
+        'merchant_request_id': response.get('MerchantRequestID'),
+        'checkout_request_id': response.get('CheckoutRequestID'),
+        'response_code': response.get('ResponseCode'),
+        'response_description': response.get('ResponseDescription'),
+        'customer_message': response.get('CustomerMessage'),
+        'status': 'Pending' if accepted else 'Failed',
+    }
+    with transaction.atomic():
+        if claimed is None:
+            push = MpesaSTKPush.objects.create(
+                user=user,
+                phone_number=phone_number,
+                amount=amount,
+                description=description,
+                **result,
+            )
+        else:
+            push = claimed
+            MpesaSTKPush.objects.filter(pk=push.pk).update(updated_at=timezone.now(), **result)
+            for name, value in result.items():
+                setattr(push, name, value)
+        if accepted and order is not None and push.checkout_request_id:
+            hold_for_payment(order, push.checkout_request_id)
+        if accepted and push.checkout_request_id:
+            transaction.on_commit(lambda: _release_early_callbacks(push.checkout_request_id))
+
+    STK_PUSHES.inc(outcome='accepted' if accepted else 'rejected')
+    if not accepted:
+        logger.error(f"STK Push initiation failed for {phone_number}. Daraja Response: {response}")
+        raise STKPushRejected(push)
+    return push
+
+
+def _release_early_callbacks(checkout_request_id):
+    """
+    A fast buyer's callback can land before the push row is committed; it
+    then waits for a retry. Now that the row exists, make it due at once.
+    """
+    if MpesaCallback.objects.filter(checkout_request_id=checkout_request_id, processed_at__isnull=True).update(retry_at=None):
+        if settings.MPESA_CALLBACK_BACKGROUND:
+            schedule_callback_processing()
+
+
+def apply_stk_result(checkout_request_id, result_code, result_description, receipt_number=None,
+                     transaction_date=None, amount=None, phone_number=None):
+    """
+    Records the outcome of an STK push and settles its order. Safe to call
+    any number of times with the same result (callback retries, the
+    reconciler racing a late callback): only a Pending push changes, except
+    that a completed payment still overrides an expiry, since the buyer has
+    paid. Returns True if this call applied the result.
+    """
+    result_code = str(result_code)
+    new_status = STK_RESULT_STATUSES.get(result_code, 'Failed')
+    applicable = Q(status='Pending')
+    if new_status == 'Completed':
+        applicable |= Q(result_code=EXPIRED_RESULT_CODE)
+
+    fields = {'status': new_status, 'result_code': result_code, 'result_description': result_description, 'updated_at': timezone.now()}
+    if new_status == 'Completed':
+        fields.update(
+            mpesa_receipt_number=receipt_number, transaction_date=transaction_date,
+            amount_from_callback=amount, phone_number_from_callback=phone_number,
+        )
+    with transaction.atomic():
+        applied = MpesaSTKPush.objects.filter(applicable, checkout_request_id=checkout_request_id).update(**fields)
+        if applied:
+            settle_payment(checkout_request_id, succeeded=(new_status == 'Completed'))
+    return bool(applied)
+
+
+def parse_stk_callback(payload):
+    """The fields of a Daraja STK callback body ({"Body": {"stkCallback": {...}}}) that we store."""
+    stk_callback = payload.get('Body', {}).get('stkCallback', {})
+    metadata = {item.get('Name'): item.get('Value') for item in stk_callback.get('CallbackMetadata', {}).get('Item', [])}
+
+    transaction_date = None
+    if metadata.get('TransactionDate'):
+        try:
+            transaction_date = datetime.strptime(str(metadata['TransactionDate']), '%Y%m%d%H%M%S')
+        except ValueError:
+            logger.error(f"Invalid TransactionDate format: {metadata['TransactionDate']}")
+
+    return {
+        'checkout_request_id': stk_callback.get('CheckoutRequestID'),
+        'result_code': stk_callback.get('ResultCode'),
+        'result_description': stk_callback.get('ResultDesc'),
+        'receipt_number': metadata.get('MpesaReceiptNumber'),
+        'transaction_date': transaction_date,
+        'amount': metadata.get('Amount'),
+        'phone_number': metadata.get('PhoneNumber'),
+    }
+
+
+def enqueue_callback(payload):
+    """
+    Appends a raw callback to the inbox; nothing else happens in the request.
+    Daraja's retries carry the same CheckoutRequestID and receipt (or result
+    code, for failures) and are dropped by the unique dedupe_key. Returns
+    False for such a duplicate.
+    """
+    callback = parse_stk_callback(payload)
+    checkout_request_id, receipt = callback['checkout_request_id'], callback['receipt_number']
+    if not checkout_request_id:
+        dedupe_key = 'payload:' + hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    elif receipt:
+        dedupe_key = f"{checkout_request_id}:{receipt}"
+    else:
+        dedupe_key = f"{checkout_request_id}:result:{callback['result_code']}"
+
+    try:
+        with transaction.atomic():
+            MpesaCallback.objects.create(
+                checkout_request_id=checkout_request_id, mpesa_receipt_number=receipt, dedupe_key=dedupe_key, payload=payload,
+            )
+        queued = True
+    except IntegrityError:
+        queued = False
+    CALLBACKS_RECEIVED.inc(result='queued' if queued else 'duplicate')
+    if queued and settings.MPESA_CALLBACK_BACKGROUND:
+        transaction.on_commit(schedule_callback_processing)
+    return queued
+
+
+def process_callbacks(batch_size=None):
+    """
+    Applies one batch of queued callbacks, oldest first. The inbox rows are
+    claimed with SELECT ... FOR UPDATE SKIP LOCKED so several processors can
+    run at once, and the batch's STK pushes are locked in one query before
+    apply_stk_result() settles each order (the push's MpesaSTKPush.order).
+    A callback for a push we can't find yet (it can beat the STK push
+    response that records its CheckoutRequestID) is retried on later runs,
+    MPESA_CALLBACK_RETRY_DELAY seconds apart, up to MPESA_CALLBACK_MAX_ATTEMPTS
+    times. Returns the number of callbacks handled.
+    """
+    batch_size = batch_size or settings.MPESA_CALLBACK_BATCH_SIZE
+    now = timezone.now()
+    with transaction.atomic():
+        callbacks = list(
+            MpesaCallback.objects.filter(processed_at__isnull=True)
+            .filter(Q(retry_at__isnull=True) | Q(retry_at__lte=now))
+            .order_by('id').select_for_update(skip_locked=True)[:batch_size]
+        )
+        if not callbacks:
+            return 0
+        checkout_ids = {callback.checkout_request_id for callback in callbacks if callback.checkout_request_id}
+        known = set(
+            MpesaSTKPush.objects.filter(checkout_request_id__in=checkout_ids)
+            .order_by('pk').select_for_update().values_list('checkout_request_id', flat=True)
+        )
+
+        for callback in callbacks:
+            callback.attempts += 1
+            result = parse_stk_callback(callback.payload)
+            if result['checkout_request_id'] not in known:
+                callback.error = "No STK push with this CheckoutRequestID."
+                if callback.attempts >= settings.MPESA_CALLBACK_MAX_ATTEMPTS:
+                    logger.error(f"Dropping M-Pesa callback {callback.pk}: {callback.error}")
+                    callback.processed_at = now
+                    CALLBACKS_PROCESSED.inc(outcome='unknown_push')
+                else:
+                    callback.retry_at = now + timedelta(seconds=settings.MPESA_CALLBACK_RETRY_DELAY)
+                continue
+            try:
+                with transaction.atomic():
+                    applied = apply_stk_result(
+                        result['checkout_request_id'], result['result_code'], result['result_description'],
+                        receipt_number=result['receipt_number'], transaction_date=result['transaction_date'],
+                        amount=result['amount'], phone_number=result['phone_number'],
+                    )
+            except Exception as e:
+                logger.error(f"Applying M-Pesa callback {callback.pk} failed: {e}", exc_info=True)
+                callback.error = str(e)
+                if callback.attempts >= settings.MPESA_CALLBACK_MAX_ATTEMPTS:
+                    callback.processed_at = now
+                    CALLBACKS_PROCESSED.inc(outcome='error')
+                else:
+                    callback.retry_at = now + timedelta(seconds=settings.MPESA_CALLBACK_RETRY_DELAY)
+                continue
+            callback.error = ''
+            callback.processed_at = now
+            CALLBACKS_PROCESSED.inc(outcome='applied' if applied else 'already_settled')
+
+        MpesaCallback.objects.bulk_update(callbacks, ['attempts', 'retry_at', 'error', 'processed_at'])
+    return len(callbacks)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mpesa-callbacks')
+# Held while a background run is queued, so a burst of callbacks queues one run
+_run_queued = threading.Lock()
+
+
+def _process_in_background():
+    _run_queued.release()
+    try:
+        while process_callbacks():
+            pass
+    except Exception as e:
+        logger.error(f"Background M-Pesa callback processing failed: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+def schedule_callback_processing():
+    """Applies queued callbacks on a worker thread soon after they arrive; process_mpesa_callbacks is the backstop."""
+    if _run_queued.acquire(blocking=False):
+        _executor.submit(in_current_context(_process_in_background, 'mpesa.process_callbacks'))
+
+
+def callback_backlog():
+    return MpesaCallback.objects.filter(processed_at__isnull=True).count()
+
+
+CALLBACK_BACKLOG.set_function(callback_backlog)
+
+
+def pending_backlog(now=None):
+    cutoff = (now or timezone.now()) - timedelta(seconds=settings.MPESA_RECONCILE_AFTER)
+    return MpesaSTKPush.objects.filter(status='Pending', created_at__lt=cutoff).count()
+
+
+PENDING_BACKLOG.set_function(pending_backlog)
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _query(client, limiter, checkout_request_id):
+    """Daraja's view of one push: its ResultCode and description, or None while unknown."""
+    limiter.wait()
+    try:
+        response = client.query_stk_push_status(checkout_request_id)
+    except requests.exceptions.RequestException as e:
+        # Includes Daraja's 500 "The transaction is being processed"
+        logger.info(f"STK push {checkout_request_id} not resolved yet: {e}")
+        return None
+    if response.get('ResultCode') in (None, ''):
+        return None
+    return str(response['ResultCode']), response.get('ResultDesc', '')
+
+
+@traced('mpesa.reconcile')
+def reconcile_pending_pushes(client, older_than=None, expire_after=None, workers=None, rate=None, limit=500):
+    """
+    Asks Daraja about STK pushes that are still Pending `older_than` seconds
+    after they were sent (their callback was lost or is late) and applies
+    the answers. Pushes still unresolved after `expire_after` seconds are
+    marked failed and their orders' stock released. Queries run on a pool
+    of `workers` threads, at most `rate` per second; results are written
+    from the calling thread. Returns a count per outcome.
+    """
+    older_than = settings.MPESA_RECONCILE_AFTER if older_than is None else older_than
+    expire_after = settings.MPESA_STK_EXPIRE_AFTER if expire_after is None else expire_after
+    workers = workers or settings.MPESA_RECONCILE_WORKERS
+    rate = settings.MPESA_RECONCILE_RATE if rate is None else rate
+
+    now = timezone.now()
+    expire_before = now - timedelta(seconds=expire_after)
+    # Oldest first, straight off the (status, created_at) index
+    pending = list(
+        MpesaSTKPush.objects.filter(status='Pending', created_at__lt=now - timedelta(seconds=older_than))
+        .order_by('created_at').values_list('checkout_request_id', 'created_at')[:limit]
+    )
+    outcomes = dict.fromkeys(['completed', 'failed', 'cancelled', 'pending', 'expired', 'unchanged'], 0)
+
+    # A push without a CheckoutRequestID never reached Daraja; there is nothing to ask
+    unsent = MpesaSTKPush.objects.filter(status='Pending', checkout_request_id__isnull=True, created_at__lt=expire_before)
+    outcomes['expired'] += unsent.update(
+        status='Failed', result_code=EXPIRED_RESULT_CODE,
+        result_description="STK push was never accepted by M-Pesa.", updated_at=timezone.now(),
+    )
+
+    limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(in_current_context(_query), client, limiter, checkout_request_id): (checkout_request_id, created_at)
+            for checkout_request_id, created_at in pending if checkout_request_id
+        }
+        for future in as_completed(futures):
+            checkout_request_id, created_at = futures[future]
+            result = future.result()
+            if result is None:
+                if created_at >= expire_before:
+                    outcome = 'pending'
+                elif apply_stk_result(checkout_request_id, EXPIRED_RESULT_CODE, "No result from M-Pesa before the push expired."):
+                    outcome = 'expired'
+                else:
+                    outcome = 'unchanged'
+            elif apply_stk_result(checkout_request_id, *result):
+                outcome = STK_RESULT_STATUSES.get(result[0], 'Failed').lower()
+            else:
+                # A callback got there first
+                outcome = 'unchanged'
+            outcomes[outcome] += 1
+            RECONCILED.inc(outcome=outcome)
+    return outcomes
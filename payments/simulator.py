@@ -0,0 +1,306 @@
+"""
+Local stand-in for Safaricom's Daraja API, for load tests and manual runs
+without the sandbox. It serves the OAuth, STK push and STK query endpoints
+and, like Daraja, later POSTs the result to the push's CallBackURL. Latency,
+error rates, failed payments and lost or duplicated callbacks are all
+configurable. Run it with `manage.py run_daraja_simulator`, or start one
+in-process:
+
+    simulator = DarajaSimulator(callback_delay=(0.2, 1.0), duplicate_rate=0.1).start()
+    ...
+    simulator.stop()
+"""
+import heapq
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+AUTH_PATH = '/oauth/v1/generate'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+# The result codes Daraja sends for a paid and a declined (cancelled by the user) push
+RESULTS = {'0': "The service request is processed successfully.", '1032': "Request cancelled by user"}
+
+
+def add_simulator_arguments(parser):
+    """The simulator's knobs, shared by run_daraja_simulator and bench_payments."""
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds Daraja takes to answer each API call.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of API calls answered with a 503.")
+    parser.add_argument('--callback-delay', type=float, nargs=2, default=(0.5, 2.0), metavar=('MIN', 'MAX'),
+                        help="Seconds between a push and its callback (the buyer entering their PIN).")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of pushes the buyer cancels (ResultCode 1032).")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help="Share of callbacks sent twice.")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Share of callbacks never sent (only the query endpoint knows the result).")
+    parser.add_argument('--callback-url', help="Send callbacks here instead of each push's CallBackURL.")
+    parser.add_argument('--seed', type=int, help="Random seed, for repeatable runs.")
+
+
+def simulator_from_options(options, host='127.0.0.1', port=0):
+    return DarajaSimulator(
+        host=host, port=port, latency=options['latency'], error_rate=options['error_rate'],
+        callback_delay=tuple(options['callback_delay']), failure_rate=options['failure_rate'],
+        duplicate_rate=options['duplicate_rate'], drop_rate=options['drop_rate'],
+        callback_url=options['callback_url'], seed=options['seed'],
+    )
+
+
+class DarajaSimulator:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, callback_delay=(0.5, 2.0),
+                 failure_rate=0.0, duplicate_rate=0.0, drop_rate=0.0, callback_url=None, callback_workers=8,
+                 token_lifetime=3599, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.callback_delay = callback_delay
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.drop_rate = drop_rate
+        self.callback_url = callback_url
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+
+        self.tokens = {}
+        # CheckoutRequestID -> {'result_code', 'resolves_at', ...}
+        self.transactions = {}
+        self.stats = dict.fromkeys([
+            'tokens', 'pushes', 'queries', 'api_errors', 'rejected',
+            'callbacks_sent', 'callbacks_failed', 'callbacks_duplicated', 'callbacks_dropped',
+        ], 0)
+        self._lock = threading.Lock()
+
+        # Callbacks due later, as a heap of (due, sequence, url, payload)
+        self._due = []
+        self._sequence = 0
+        self._due_changed = threading.Condition(self._lock)
+        self._sender = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix='daraja-callback')
+        self._session = requests.Session()
+        self._stopped = False
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    @property
+    def auth_url(self):
+        return f"{self.url}{AUTH_PATH}?grant_type=client_credentials"
+
+    @property
+    def stk_push_url(self):
+        return f"{self.url}{STK_PUSH_PATH}"
+
+    @property
+    def query_url(self):
+        return f"{self.url}{QUERY_PATH}"
+
+    def settings(self):
+        """MPESA_* settings pointing MpesaAPIClient at this simulator."""
+        return {
+            'MPESA_USE_SANDBOX': None,
+            'MPESA_CONSUMER_KEY': 'simulator', 'MPESA_CONSUMER_SECRET': 'simulator',
+            'MPESA_SHORTCODE': '174379', 'MPESA_PASSKEY': 'simulator',
+            'MPESA_AUTH_URL': self.auth_url, 'MPESA_STK_PUSH_URL': self.stk_push_url, 'MPESA_QUERY_URL': self.query_url,
+        }
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='daraja-simulator').start()
+        threading.Thread(target=self._dispatch_callbacks, daemon=True, name='daraja-callback-scheduler').start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._due_changed.notify()
+        self.server.shutdown()
+        self.server.server_close()
+        self._sender.shutdown(wait=True, cancel_futures=True)
+
+    def pending_callbacks(self):
+        with self._lock:
+            return len(self._due)
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self.stats[stat] += amount
+
+    # --- API endpoints ---
+
+    def _issue_token(self):
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self.tokens[token] = time.time() + self.token_lifetime
+            self.stats['tokens'] += 1
+        return 200, {'access_token': token, 'expires_in': str(self.token_lifetime)}
+
+    def _authorized(self, authorization):
+        token = (authorization or '').removeprefix('Bearer ')
+        with self._lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def _stk_push(self, request):
+        missing = [field for field in ('BusinessShortCode', 'Amount', 'PhoneNumber', 'CallBackURL') if not request.get(field)]
+        if missing:
+            self._count('rejected')
+            return 400, {'errorCode': '400.002.02', 'errorMessage': f"Bad Request - Invalid {missing[0]}"}
+
+        checkout_request_id = f"ws_CO_{datetime.now():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+        merchant_request_id = f"{self.random.randint(10000, 99999)}-{self.random.randint(10 ** 7, 10 ** 8 - 1)}-1"
+        result_code = '1032' if self.random.random() < self.failure_rate else '0'
+        delay = self.random.uniform(*self.callback_delay)
+        transaction = {
+            'merchant_request_id': merchant_request_id,
+            'result_code': result_code,
+            'resolves_at': time.time() + delay,
+            'amount': request['Amount'],
+            'phone_number': request['PhoneNumber'],
+            'receipt': ''.join(self.random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=10)),
+        }
+        with self._lock:
+            self.transactions[checkout_request_id] = transaction
+            self.stats['pushes'] += 1
+
+        if self.random.random() < self.drop_rate:
+            self._count('callbacks_dropped')
+        else:
+            url = self.callback_url or request['CallBackURL']
+            payload = self._callback_payload(checkout_request_id, transaction)
+            self._schedule(delay, url, payload)
+            if self.random.random() < self.duplicate_rate:
+                # Daraja resends when it thinks the first delivery failed
+                self._schedule(delay + self.random.uniform(0.05, 0.5), url, payload)
+                self._count('callbacks_duplicated')
+
+        return 200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': "Success. Request accepted for processing",
+            'CustomerMessage': "Success. Request accepted for processing",
+        }
+
+    def _query(self, request):
+        self._count('queries')
+        with self._lock:
+            transaction = self.transactions.get(request.get('CheckoutRequestID'))
+        if transaction is None:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': "Bad Request - Invalid CheckoutRequestID"}
+        if transaction['resolves_at'] > time.time():
+            return 500, {'errorCode': '500.001.1001', 'errorMessage': "The transaction is being processed"}
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': "The service request has been accepted successsfully",
+            'MerchantRequestID': transaction['merchant_request_id'],
+            'CheckoutRequestID': request['CheckoutRequestID'],
+            'ResultCode': transaction['result_code'],
+            'ResultDesc': RESULTS[transaction['result_code']],
+        }
+
+    def _handle(self, method, path, authorization, request):
+        """(status, body) for one API call."""
+        time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self._count('api_errors')
+            return 503, {'errorCode': '503.001.01', 'errorMessage': "Service is currently unavailable"}
+        if method == 'GET' and path == AUTH_PATH:
+            return self._issue_token()
+        if method == 'POST' and path in (STK_PUSH_PATH, QUERY_PATH):
+            if not self._authorized(authorization):
+                self._count('rejected')
+                return 401, {'errorCode': '404.001.03', 'errorMessage': "Invalid Access Token"}
+            return self._stk_push(request) if path == STK_PUSH_PATH else self._query(request)
+        return 404, {'errorCode': '404.001.01', 'errorMessage': "Resource not found"}
+
+    def _handler_class(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self):
+                path = self.path.split('?', 1)[0]
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    status, body = 400, {'errorCode': '400.002.01', 'errorMessage': "Invalid JSON"}
+                else:
+                    status, body = simulator._handle(self.command, path, self.headers.get('Authorization'), request)
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            do_GET = do_POST = reply
+
+        return Handler
+
+    # --- Callbacks ---
+
+    def _callback_payload(self, checkout_request_id, transaction):
+        callback = {
+            'MerchantRequestID': transaction['merchant_request_id'],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': int(transaction['result_code']),
+            'ResultDesc': RESULTS[transaction['result_code']],
+        }
+        if transaction['result_code'] == '0':
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': transaction['amount']},
+                {'Name': 'MpesaReceiptNumber', 'Value': transaction['receipt']},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(transaction['phone_number'])},
+            ]}
+        return {'Body': {'stkCallback': callback}}
+
+    def _schedule(self, delay, url, payload):
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._due, (time.time() + delay, self._sequence, url, payload))
+            self._due_changed.notify()
+
+    def _dispatch_callbacks(self):
+        while True:
+            with self._lock:
+                while not self._stopped and (not self._due or self._due[0][0] > time.time()):
+                    self._due_changed.wait(self._due[0][0] - time.time() if self._due else None)
+                if self._stopped:
+                    return
+                _, _, url, payload = heapq.heappop(self._due)
+            try:
+                self._sender.submit(self._send_callback, url, payload)
+            except RuntimeError:
+                # stop() shut the sender down meanwhile
+                return
+
+    def _send_callback(self, url, payload):
+        try:
+            response = self._session.post(url, json=payload, timeout=10)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            # Daraja doesn't retry a failed delivery either; the query endpoint still has the result
+            logger.warning(f"Simulated callback to {url} failed: {e}")
+            self._count('callbacks_failed')
+        else:
+            self._count('callbacks_sent')
@@ -1,3 +1,587 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from datetime import timedelta
+from decimal import Decimal
+
+from api.checkout_utils import place_order
+from api.inventory_utils import hold_for_payment
+from authentication.models import AppUser
+from cart.models import Cart, CartItem
+from orders.models import Order
+from product.models import Product
+from mitumbaesales import metrics
+from mitumbaesales.middleware import REQUEST_EXTERNAL_SECONDS, route_name
+from mitumbaesales.tracing import RotatingFileSpanExporter, configure_tracing, in_current_context, span_line, traced
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from .models import MpesaCallback, MpesaSTKPush
+from .mpesa_api import MpesaAPIClient, REQUESTS, TOKEN_FETCHES
+from .services import (
+    DuplicateReference, apply_stk_result, enqueue_callback, get_client, initiate_stk_push, pending_backlog,
+    process_callbacks, reconcile_pending_pushes,
+)
+from .simulator import DarajaSimulator
+
+
+class StubDaraja:
+    """
+    Local HTTP server standing in for Daraja. `script[path]` is a list of
+    (status, body, delay) replies used in order; the last one repeats.
+    Status queries for a CheckoutRequestID in `query_results` get that
+    (status, body) reply instead.
+    """
+
+    def __init__(self):
+        self.script = {
+            '/oauth': [(200, {'access_token': 'token-1', 'expires_in': '3599'}, 0)],
+            '/stkpush': [(200, {'CheckoutRequestID': 'ws_CO_1', 'ResponseCode': '0'}, 0)],
+            '/query': [(200, {'ResultCode': '0'}, 0)],
+        }
+        self.query_results = {}
+        self.calls = {}
+        self.connections = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request = json.loads(self.rfile.read(length) or b'{}')
+                count = stub.calls.get(self.path, 0)
+                stub.calls[self.path] = count + 1
+                stub.connections.add(self.client_address)
+                replies = stub.script[self.path]
+                status, body, delay = replies[min(count, len(replies) - 1)]
+                if self.path == '/query' and request.get('CheckoutRequestID') in stub.query_results:
+                    status, body = stub.query_results[request['CheckoutRequestID']]
+                time.sleep(delay)
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up (read timeout) before the reply
+                    pass
+
+            do_GET = do_POST = reply
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def settings(self):
+        return override_settings(
+            MPESA_USE_SANDBOX=None, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+            MPESA_SHORTCODE='174379', MPESA_PASSKEY='passkey', MPESA_CALLBACK_URL='https://shop.test/callback',
+            MPESA_AUTH_URL=f'{self.url}/oauth', MPESA_STK_PUSH_URL=f'{self.url}/stkpush', MPESA_QUERY_URL=f'{self.url}/query',
+            MPESA_READ_TIMEOUT=0.5, MPESA_RETRY_BACKOFF=0.01,
+        )
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubDarajaMixin:
+    def setUp(self):
+        cache.clear()
+        TOKEN_FETCHES.reset()
+        REQUESTS.reset()
+        self.daraja = StubDaraja()
+        self.addCleanup(self.daraja.close)
+        overrides = self.daraja.settings()
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.client = MpesaAPIClient()
+
+
+class StubDarajaTestCase(StubDarajaMixin, SimpleTestCase):
+    pass
+
+
+class SpanRecorderMixin:
+    """Turns tracing on and collects the spans finished during each test."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.span_exporter = InMemorySpanExporter()
+        configure_tracing(SimpleSpanProcessor(cls.span_exporter))
+
+    @classmethod
+    def tearDownClass(cls):
+        # The provider can't be uninstalled; a shut down exporter just drops later spans
+        cls.span_exporter.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.span_exporter.clear()
+
+    def finished_spans(self):
+        return {span.name: span for span in self.span_exporter.get_finished_spans()}
+
+
+class AccessTokenCacheTests(StubDarajaTestCase):
+    def test_token_reused_until_refresh_margin(self):
+        self.assertEqual(self.client._get_access_token(), 'token-1')
+        self.assertEqual(MpesaAPIClient()._get_access_token(), 'token-1')
+        self.assertEqual(self.daraja.calls['/oauth'], 1)
+
+        # Inside the refresh margin the next lookup fetches a new token
+        self.daraja.script['/oauth'] = [(200, {'access_token': 'token-2', 'expires_in': '3599'}, 0)]
+        with override_settings(MPESA_TOKEN_REFRESH_MARGIN=3600):
+            self.assertEqual(self.client._get_access_token(), 'token-2')
+        self.assertEqual(TOKEN_FETCHES.value(outcome='success'), 2)
+
+    def test_concurrent_lookups_fetch_once(self):
+        self.daraja.script['/oauth'] = [(200, {'access_token': 'only', 'expires_in': '3599'}, 0.2)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            tokens = list(pool.map(lambda _: MpesaAPIClient()._get_access_token(), range(8)))
+        self.assertEqual(tokens, ['only'] * 8)
+        self.assertEqual(self.daraja.calls['/oauth'], 1)
+
+    def test_rejected_token_is_dropped(self):
+        self.client._get_access_token()
+        self.daraja.script['/stkpush'] = [(401, {'errorMessage': 'Invalid Access Token'}, 0)]
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.client.initiate_stk_push('254700000000', 10, 'order', 'Payment')
+        self.assertIsNone(cache.get(self.client._token_cache_key))
+
+
+class DarajaHTTPTests(StubDarajaTestCase):
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.client.query_stk_push_status('ws_CO_1')
+        # Token + three queries over one keep-alive connection
+        self.assertEqual(len(self.daraja.connections), 1)
+
+    def test_status_query_retries_server_errors(self):
+        self.daraja.script['/query'] = [(503, {}, 0), (500, {}, 0), (200, {'ResultCode': '0'}, 0)]
+        self.assertEqual(self.client.query_stk_push_status('ws_CO_1'), {'ResultCode': '0'})
+        self.assertEqual(self.daraja.calls['/query'], 3)
+        self.assertEqual(REQUESTS.value(endpoint='stk_query', outcome='http_503'), 1)
+
+    def test_status_query_retries_timeouts(self):
+        self.daraja.script['/query'] = [(200, {}, 1), (200, {'ResultCode': '0'}, 0)]
+        self.assertEqual(self.client.query_stk_push_status('ws_CO_1'), {'ResultCode': '0'})
+        self.assertEqual(REQUESTS.value(endpoint='stk_query', outcome='timeout'), 1)
+
+    def test_stk_push_is_not_retried(self):
+        self.daraja.script['/stkpush'] = [(503, {}, 0), (200, {'ResponseCode': '0'}, 0)]
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.client.initiate_stk_push('254700000000', 10, 'order', 'Payment')
+        self.assertEqual(self.daraja.calls['/stkpush'], 1)
+
+        self.daraja.script['/stkpush'] = [(200, {}, 1)]
+        self.daraja.calls['/stkpush'] = 0
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.initiate_stk_push('254700000000', 10, 'order', 'Payment')
+        self.assertEqual(self.daraja.calls['/stkpush'], 1)
+
+
+class ReconciliationTests(StubDarajaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+
+    def push(self, checkout_request_id, age):
+        push = MpesaSTKPush.objects.create(user=self.user, phone_number='254700000000', amount=Decimal('10.00'), checkout_request_id=checkout_request_id)
+        MpesaSTKPush.objects.filter(pk=push.pk).update(created_at=timezone.now() - timedelta(seconds=age))
+        return push
+
+    def status(self, push):
+        return MpesaSTKPush.objects.values_list('status', flat=True).get(pk=push.pk)
+
+    def test_reconcile(self):
+        paid = self.push('ws_CO_paid', age=300)
+        cancelled = self.push('ws_CO_cancelled', age=300)
+        waiting = self.push('ws_CO_waiting', age=300)
+        stale = self.push('ws_CO_stale', age=7200)
+        recent = self.push('ws_CO_recent', age=10)
+        unsent = self.push(None, age=7200)
+        self.daraja.query_results = {
+            'ws_CO_paid': (200, {'ResponseCode': '0', 'ResultCode': '0', 'ResultDesc': 'Processed'}),
+            'ws_CO_cancelled': (200, {'ResponseCode': '0', 'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'}),
+            'ws_CO_waiting': (500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}),
+            'ws_CO_stale': (500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}),
+        }
+        self.assertEqual(pending_backlog(), 5)
+
+        outcomes = reconcile_pending_pushes(self.client, older_than=120, expire_after=3600, workers=2, rate=0)
+        self.assertEqual(
+            {outcome: count for outcome, count in outcomes.items() if count},
+            {'completed': 1, 'cancelled': 1, 'pending': 1, 'expired': 2},
+        )
+        self.assertEqual(
+            [self.status(push) for push in (paid, cancelled, waiting, stale, recent, unsent)],
+            ['Completed', 'Cancelled', 'Pending', 'Failed', 'Pending', 'Failed'],
+        )
+        self.assertEqual(pending_backlog(), 1)
+
+    def test_results_apply_once(self):
+        push = self.push('ws_CO_1', age=300)
+        self.assertTrue(apply_stk_result('ws_CO_1', 1, 'Insufficient balance'))
+        self.assertFalse(apply_stk_result('ws_CO_1', 1, 'Insufficient balance'))
+        self.assertFalse(apply_stk_result('ws_CO_1', 0, 'Processed', receipt_number='RCP1'))
+        self.assertEqual(self.status(push), 'Failed')
+
+    def test_payment_after_expiry_still_counts(self):
+        push = self.push('ws_CO_1', age=7200)
+        self.daraja.query_results = {'ws_CO_1': (500, {'errorMessage': 'The transaction is being processed'})}
+        reconcile_pending_pushes(self.client, older_than=120, expire_after=3600, rate=0)
+        self.assertEqual(self.status(push), 'Failed')
+        self.assertTrue(apply_stk_result('ws_CO_1', 0, 'Processed', receipt_number='RCP1'))
+        self.assertEqual(self.status(push), 'Completed')
+
+
+@override_settings(MPESA_CALLBACK_BACKGROUND=False)
+class STKPushInitiationTests(SpanRecorderMixin, StubDarajaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=5)
+        CartItem.objects.create(cart=Cart.objects.create(user=self.buyer), product=jacket, quantity=2)
+        self.order, _ = place_order(self.buyer, lambda order: None)
+        self.api = APIClient()
+        self.api.force_authenticate(self.buyer)
+
+    def pay(self, **data):
+        return self.api.post('/api/payments/stk-push/', {'phone_number': '254700000000', **data}, format='json')
+
+    def test_push_for_order_is_recorded_once(self):
+        # Claimed with a Pending row before Daraja, filled in once it answers
+        with self.assertNumQueries(10):
+            response = self.pay(order_id=str(self.order.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['checkout_request_id'], 'ws_CO_1')
+
+        push = MpesaSTKPush.objects.get()
+        self.assertEqual((push.status, push.amount, push.response_code, push.order), ('Pending', Decimal('200.00'), '0', self.order))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mpesa_checkout_id, 'ws_CO_1')
+
+    def test_second_push_for_order_is_refused(self):
+        self.daraja.script['/stkpush'] = [(200, {'CheckoutRequestID': f'ws_CO_{n}', 'ResponseCode': '0'}, 0) for n in (1, 2)]
+        self.assertEqual(self.pay(order_id=str(self.order.pk)).status_code, 200)
+        response = self.pay(order_id=str(self.order.pk))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 'A payment for this order is already in progress.')
+        self.assertEqual(self.daraja.calls['/stkpush'], 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.mpesa_checkout_id, 'ws_CO_1')
+
+        # Once paid, the order can't be pushed again either
+        apply_stk_result('ws_CO_1', 0, 'Processed', receipt_number='RCP1')
+        self.assertEqual(self.pay(order_id=str(self.order.pk)).json()['error'], 'This order has already been paid.')
+
+    def test_failed_push_request_frees_the_order(self):
+        self.daraja.script['/stkpush'] = [(503, {}, 0), (200, {'CheckoutRequestID': 'ws_CO_2', 'ResponseCode': '0'}, 0)]
+        self.assertEqual(self.pay(order_id=str(self.order.pk)).status_code, 500)
+        self.assertEqual(MpesaSTKPush.objects.get().status, 'Failed')
+        self.assertEqual(self.pay(order_id=str(self.order.pk)).status_code, 200)
+        self.assertEqual(MpesaSTKPush.objects.get(status='Pending').checkout_request_id, 'ws_CO_2')
+
+    def test_failed_push_does_not_cancel_a_paid_order(self):
+        self.pay(order_id=str(self.order.pk))
+        # A push left over from before the order was paid answers last
+        MpesaSTKPush.objects.create(
+            user=self.buyer, order=self.order, phone_number='254700000000', amount=Decimal('200.00'), checkout_request_id='ws_CO_0', status='Failed',
+        )
+        apply_stk_result('ws_CO_1', 0, 'Processed', receipt_number='RCP1')
+        MpesaSTKPush.objects.filter(checkout_request_id='ws_CO_0').update(status='Pending')
+        apply_stk_result('ws_CO_0', 1032, 'Request cancelled by user')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending')
+        self.assertFalse(self.order.reservations.filter(status='released').exists())
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0, SLOW_REQUEST_SAMPLE_RATE=1, METRICS_TOKEN='scrape')
+    def test_request_breakdown_is_recorded(self):
+        daraja_calls = REQUEST_EXTERNAL_SECONDS.value(route='initiate_stk_push', service='daraja')['count']
+        with self.assertLogs('mitumbaesales.performance', 'WARNING') as logs:
+            response = self.pay(order_id=str(self.order.pk))
+        self.assertEqual(route_name(response.wsgi_request), 'initiate_stk_push')
+        self.assertIn('POST /api/payments/stk-push/ (initiate_stk_push) -> 200', logs.output[0])
+        self.assertRegex(logs.output[0], r'\d+ SQL queries \d+ ms, daraja \d+ ms, other')
+        self.assertEqual(REQUEST_EXTERNAL_SECONDS.value(route='initiate_stk_push', service='daraja')['count'], daraja_calls + 1)
+
+        text = self.api.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape').content.decode()
+        self.assertIn('http_request_seconds_count{route="initiate_stk_push",method="POST",status="200"}', text)
+        self.assertIn('external_call_seconds_count{service="daraja"}', text)
+
+    def test_push_is_traced_under_the_callers_trace(self):
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        response = self.api.post(
+            '/api/payments/stk-push/', {'phone_number': '254700000000', 'order_id': str(self.order.pk)}, format='json',
+            HTTP_TRACEPARENT=f'00-{trace_id}-00f067aa0ba902b7-01',
+        )
+        self.assertEqual(response.status_code, 200)
+
+        spans = self.finished_spans()
+        request = spans['POST initiate_stk_push']
+        self.assertEqual(format(request.context.trace_id, '032x'), trace_id)
+        self.assertEqual(request.attributes['http.response.status_code'], 200)
+        self.assertEqual(spans['mpesa.initiate_stk_push'].parent.span_id, request.context.span_id)
+        self.assertEqual(spans['daraja stk_push'].parent.span_id, spans['mpesa.initiate_stk_push'].context.span_id)
+        self.assertEqual(spans['daraja stk_push'].attributes['http.response.status_code'], 200)
+        self.assertIn('db.INSERT', spans)
+        self.assertTrue(all(span.context.trace_id == request.context.trace_id for span in spans.values()))
+
+    def test_both_routes_share_the_view(self):
+        response = self.api.post('/api/payments/initiate-stk-push/', {'phone_number': '254700000000', 'amount': '50'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MpesaSTKPush.objects.get().amount, Decimal('50.00'))
+
+    def test_rejected_push_is_recorded_as_failed(self):
+        self.daraja.script['/stkpush'] = [(200, {'ResponseCode': '1', 'ResponseDescription': 'Invalid amount'}, 0)]
+        response = self.pay(amount='50')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['details'], 'Invalid amount')
+        self.assertEqual(MpesaSTKPush.objects.get().status, 'Failed')
+
+    def test_unreachable_daraja_records_nothing(self):
+        self.daraja.script['/stkpush'] = [(503, {}, 0)]
+        self.assertEqual(self.pay(amount='50').status_code, 500)
+        self.assertFalse(MpesaSTKPush.objects.exists())
+
+    def test_reference_is_claimed_before_daraja(self):
+        self.daraja.script['/stkpush'] = [(200, {'CheckoutRequestID': f'ws_CO_{n}', 'ResponseCode': '0'}, 0) for n in (1, 2)]
+        self.assertEqual(self.pay(amount='50', reference='INV-1').status_code, 200)
+        self.assertEqual(self.pay(amount='50', reference='INV-1').json(), {'reference': ['This reference has already been used.']})
+        # A request that passed validation before the first was recorded
+        with self.assertRaisesMessage(DuplicateReference, 'This reference has already been used.'):
+            initiate_stk_push(self.buyer, '254700000000', Decimal('50'), reference='INV-1')
+        self.assertEqual(self.daraja.calls['/stkpush'], 1)
+        self.assertEqual(MpesaSTKPush.objects.get().checkout_request_id, 'ws_CO_1')
+
+    def test_early_callback_is_applied(self):
+        # The buyer's callback beat our insert and was deferred
+        enqueue_callback(stk_callback('ws_CO_1'))
+        process_callbacks()
+        self.assertIsNotNone(MpesaCallback.objects.get().retry_at)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pay(order_id=str(self.order.pk))
+        process_callbacks()
+        self.assertEqual(MpesaSTKPush.objects.get().status, 'Completed')
+
+    def test_pushes_are_rate_limited_per_user(self):
+        self.daraja.script['/stkpush'] = [(200, {'CheckoutRequestID': f'ws_CO_{n}', 'ResponseCode': '0'}, 0) for n in range(3)]
+        rates = {'stk_push': '2/min'}
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+            remaining = [self.pay(amount='50')['X-RateLimit-Remaining'] for _ in range(2)]
+            refused = self.pay(amount='50')
+            self.api.force_authenticate(AppUser.objects.get(username='seller'))
+            other_user = self.pay(amount='50')
+        self.assertEqual(remaining, ['1', '0'])
+        self.assertEqual(refused.status_code, 429)
+        self.assertEqual(refused['X-RateLimit-Remaining'], '0')
+        self.assertIn('Retry-After', refused)
+        self.assertEqual(other_user.status_code, 200)
+        self.assertEqual(MpesaSTKPush.objects.count(), 3)
+
+    def test_client_follows_settings(self):
+        client = get_client()
+        self.assertIs(get_client(), client)
+        with override_settings(MPESA_STK_PUSH_URL='http://elsewhere.test/stkpush'):
+            self.assertEqual(get_client().stk_push_url, 'http://elsewhere.test/stkpush')
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='RCP123'):
+    callback = {'MerchantRequestID': 'm-1', 'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code, 'ResultDesc': 'Done'}
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 10},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20251019101500},
+            {'Name': 'PhoneNumber', 'Value': 254700000000},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+@override_settings(MPESA_CALLBACK_BACKGROUND=False)
+class CallbackInboxTests(TestCase):
+    def setUp(self):
+        seller = AppUser.objects.create_user(username='seller', email='seller@example.com', password='password', user_type='Seller')
+        self.buyer = AppUser.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+        self.jacket = Product.objects.create(seller=seller, name='Jacket', slug='jacket', price=Decimal('100.00'), stock_quantity=5)
+        CartItem.objects.create(cart=Cart.objects.create(user=self.buyer), product=self.jacket, quantity=2)
+        self.order, _ = place_order(self.buyer, lambda order: None)
+        hold_for_payment(self.order, 'ws_CO_1')
+
+    def push(self, checkout_request_id='ws_CO_1'):
+        return MpesaSTKPush.objects.create(
+            user=self.buyer, order=self.order, phone_number='254700000000', amount=Decimal('200.00'), checkout_request_id=checkout_request_id,
+        )
+
+    def test_retries_are_stored_once(self):
+        self.assertTrue(enqueue_callback(stk_callback('ws_CO_1')))
+        self.assertFalse(enqueue_callback(stk_callback('ws_CO_1')))
+        self.assertTrue(enqueue_callback(stk_callback('ws_CO_1', receipt='RCP999')))
+        self.assertEqual(MpesaCallback.objects.count(), 2)
+
+    def test_processing_settles_the_order(self):
+        push = self.push()
+        enqueue_callback(stk_callback('ws_CO_1'))
+        enqueue_callback(stk_callback('ws_CO_1', receipt='RCP999'))
+        self.assertEqual(process_callbacks(), 2)
+        self.assertEqual(process_callbacks(), 0)
+
+        push.refresh_from_db()
+        self.assertEqual((push.status, push.mpesa_receipt_number), ('Completed', 'RCP123'))
+        self.assertEqual(self.order.reservations.get().status, 'committed')
+        self.assertFalse(MpesaCallback.objects.filter(processed_at__isnull=True).exists())
+
+    def test_failed_payment_releases_stock(self):
+        self.push()
+        enqueue_callback(stk_callback('ws_CO_1', result_code=1032))
+        process_callbacks()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(Product.objects.get(pk=self.jacket.pk).stock_quantity, 5)
+
+    def test_callback_before_push_is_retried(self):
+        enqueue_callback(stk_callback('ws_CO_1'))
+        self.assertEqual(process_callbacks(), 1)
+        callback = MpesaCallback.objects.get()
+        self.assertIsNone(callback.processed_at)
+        self.assertEqual(callback.attempts, 1)
+        # Not picked up again until its retry is due
+        self.assertEqual(process_callbacks(), 0)
+
+        push = self.push()
+        MpesaCallback.objects.update(retry_at=timezone.now())
+        process_callbacks()
+        push.refresh_from_db()
+        self.assertEqual(push.status, 'Completed')
+
+
+class DarajaSimulatorTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.received = []
+        received = self.received
+
+        class Receiver(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.end_headers()
+
+        receiver = ThreadingHTTPServer(('127.0.0.1', 0), Receiver)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        self.addCleanup(receiver.server_close)
+        self.addCleanup(receiver.shutdown)
+        self.callback_url = f"http://127.0.0.1:{receiver.server_address[1]}/callback"
+
+    def simulate(self, **options):
+        simulator = DarajaSimulator(callback_delay=(0.05, 0.05), seed=1, **options).start()
+        self.addCleanup(simulator.stop)
+        overrides = override_settings(MPESA_CALLBACK_URL=self.callback_url, **simulator.settings())
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        return simulator
+
+    def wait_for_callbacks(self, count):
+        deadline = time.time() + 5
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_push_is_answered_by_a_callback(self):
+        self.simulate(duplicate_rate=1)
+        response = MpesaAPIClient().initiate_stk_push('254700000000', 10, 'order', 'Payment')
+        self.assertEqual(response['ResponseCode'], '0')
+
+        self.wait_for_callbacks(2)
+        # Sent twice, as Daraja does when it thinks the first delivery failed
+        self.assertEqual(self.received[0], self.received[1])
+        callback = self.received[0]['Body']['stkCallback']
+        self.assertEqual((callback['CheckoutRequestID'], callback['ResultCode']), (response['CheckoutRequestID'], 0))
+
+    def test_dropped_callback_is_found_by_query(self):
+        self.simulate(drop_rate=1, failure_rate=1)
+        client = MpesaAPIClient()
+        checkout_request_id = client.initiate_stk_push('254700000000', 10, 'order', 'Payment')['CheckoutRequestID']
+        time.sleep(0.1)
+        self.assertEqual(client.query_stk_push_status(checkout_request_id)['ResultCode'], '1032')
+        self.assertEqual(self.received, [])
+
+    def test_unknown_token_is_rejected(self):
+        simulator = self.simulate()
+        response = requests.post(simulator.stk_push_url, json={}, headers={'Authorization': 'Bearer nope'})
+        self.assertEqual(response.status_code, 401)
+
+
+class BackgroundTraceContextTests(SpanRecorderMixin, SimpleTestCase):
+    def test_job_runs_in_the_scheduling_trace(self):
+        with ThreadPoolExecutor(max_workers=1) as pool, traced('schedule') as parent:
+            pool.submit(in_current_context(lambda: None, 'job')).result()
+
+        job = self.finished_spans()['job']
+        self.assertEqual(job.parent.span_id, parent.get_span_context().span_id)
+
+    def test_file_exporter_is_capped(self):
+        with traced('upload'):
+            pass
+        span = self.finished_spans()['upload']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'traces.jsonl')
+            exporter = RotatingFileSpanExporter(path, max_bytes=len(span_line(span)) * 3, backups=1)
+            for _ in range(10):
+                exporter.export([span])
+            exporter.shutdown()
+            self.assertEqual(sorted(os.listdir(directory)), ['traces.jsonl', 'traces.jsonl.1'])
+            with open(path) as lines:
+                self.assertEqual(json.loads(lines.readline())['name'], 'upload')
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render(self):
+        requests_total = metrics.counter('test_requests_total', "Test requests.", ['route'])
+        latency = metrics.histogram('test_latency_seconds', "Test latency.", buckets=(0.1, 1))
+        requests_total.inc(route='/a')
+        latency.observe(0.5)
+        text = metrics.render()
+        self.assertIn('test_requests_total{route="/a"} 1', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 1', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 1', text)
+        self.assertEqual(latency.quantile(0.95), 1)
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_request_seconds histogram', response.content.decode())
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_endpoint_hidden_without_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
@@ -0,0 +1,74 @@
+from django.db import migrations
+
+
+POSTGRES_FORWARD = [
+    "ALTER TABLE product_product ADD COLUMN search_vector tsvector",
+    """
+    CREATE FUNCTION product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(NEW.condition_notes, '')), 'C');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, description, condition_notes ON product_product
+    FOR EACH ROW EXECUTE FUNCTION product_search_vector_update()
+    """,
+    # Touching the indexed columns fires the trigger and backfills existing rows
+    "UPDATE product_product SET name = name",
+    "CREATE INDEX product_search_vector_gin ON product_product USING GIN (search_vector)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS product_search_vector_gin",
+    "DROP TRIGGER IF EXISTS product_search_vector_trigger ON product_product",
+    "DROP FUNCTION IF EXISTS product_search_vector_update()",
+    "ALTER TABLE product_product DROP COLUMN IF EXISTS search_vector",
+]
+
+# SQLite rebuilds tables on most ALTERs, which would silently drop triggers,
+# so the FTS5 table is kept in sync from api.signals instead.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE product_product_fts USING fts5(
+        product_id UNINDEXED, name, description, condition_notes,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO product_product_fts (product_id, name, description, condition_notes)
+    SELECT id, coalesce(name, ''), coalesce(description, ''), coalesce(condition_notes, '')
+    FROM product_product
+    """,
+]
+
+SQLITE_BACKWARD = [
+    "DROP TABLE IF EXISTS product_product_fts",
+]
+
+
+def _run(statements):
+    def apply(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0005_mysterybox'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            _run({'postgresql': POSTGRES_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
@@ -45,6 +45,8 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock_quantity = models.PositiveIntegerField(default=1)
     image = models.ImageField(upload_to='products/')
+    # Manifest of resized WebP/JPEG copies written by api/image_utils.py
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     class Condition(models.TextChoices):
@@ -70,12 +72,8 @@ class MysteryBox(models.Model):
     items = models.ManyToManyField(Product, related_name='contained_in_box')
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.name} by {self.seller.email}"
 
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            # Add a random string to the end of the name for the slug
-            self.slug = slugify(self.name) + "-" + str(uuid.uuid4())[:8]
-        super().save(*args, **kwargs)